@@ -0,0 +1,463 @@
+# admission.py
+#
+# Admission control in front of every route, so one client cannot take the
+# service down by hammering an endpoint. Each request goes through two
+# checks before its handler runs:
+#
+#   1. Rate: a token bucket per identity and route. The identity is the
+#      session's role and subject (see sessions.py). A request finding the
+#      bucket empty is answered 429 with Retry-After set to when the next
+#      token arrives. Requests without a (valid) session are limited by
+#      client address. Behind proxies, set TAXI_TRUSTED_PROXIES to the
+#      number of proxies in front of the app that append to
+#      X-Forwarded-For, and the address is taken from that header rather
+#      than being the proxy's. TAXI_RATE_LIMIT_ADDRESSES=0 turns address
+#      limits off, for deployments where many clients share one address
+#      and no proxy reports theirs.
+#   2. Concurrency: a cap on requests in flight per route class. A request
+#      over the cap waits in the class's queue until a slot frees up or its
+#      deadline passes. A full queue or a passed deadline is answered 503
+#      with Retry-After.
+#
+# Route classes:
+#   read       cheap lookups, including the POST reads (logins, availability)
+#   analytics  dashboard summaries and bulk import/export
+#   write      every other POST
+#
+# Each class takes its limits from TAXI_ADMIT_<CLASS>_RATE (requests per
+# second per identity and route), _BURST, _CONCURRENCY, _QUEUE (waiting
+# requests) and _QUEUE_TIMEOUT (seconds). The concurrency defaults are
+# fractions of the connection pool, so the caps hold back requests before
+# they queue on the pool.
+#
+# Buckets live in memory per process. With TAXI_RATE_LIMIT_STORE=postgres
+# they live in the rate_limit_buckets table instead, so the limits hold
+# across workers and hosts. If that store fails, the process falls back to
+# its own buckets. Concurrency caps always apply per process, since they
+# protect the process's own pool. Set TAXI_ADMISSION=0 to turn it all off.
+
+import asyncio
+import logging
+import math
+import os
+import threading
+import time
+from collections import namedtuple
+
+from flask import g, jsonify, request
+
+import database
+import sessions
+from database import get_connection
+
+ADMISSION = os.environ.get('TAXI_ADMISSION', '1') != '0'
+RATE_LIMIT_STORE = os.environ.get('TAXI_RATE_LIMIT_STORE', 'memory')    # memory | postgres
+MAX_BUCKETS = int(os.environ.get('TAXI_RATE_LIMIT_MAX_BUCKETS', '100000'))
+RATE_LIMIT_ADDRESSES = os.environ.get('TAXI_RATE_LIMIT_ADDRESSES', '1') != '0'
+TRUSTED_PROXIES = int(os.environ.get('TAXI_TRUSTED_PROXIES', '0'))
+
+log = logging.getLogger('taxi.admission')
+
+Limits = namedtuple('Limits', 'rate burst concurrency queue queue_timeout')
+
+
+def _limits(route_class, rate, burst, concurrency, queue, queue_timeout):
+    def env(name, default, kind):
+        return kind(os.environ.get('TAXI_ADMIT_%s_%s' % (route_class.upper(), name), str(default)))
+    return Limits(env('RATE', rate, float), env('BURST', burst, float),
+                  env('CONCURRENCY', concurrency, int), env('QUEUE', queue, int),
+                  env('QUEUE_TIMEOUT', queue_timeout, float))
+
+
+CLASS_LIMITS = {
+    'read': _limits('read', 20, 40, database.POOL_MAX_SIZE, 4 * database.POOL_MAX_SIZE, 1.0),
+    'analytics': _limits('analytics', 1, 5, max(1, database.POOL_MAX_SIZE // 4), database.POOL_MAX_SIZE, 5.0),
+    'write': _limits('write', 10, 20, max(1, database.POOL_MAX_SIZE // 2), 2 * database.POOL_MAX_SIZE, 2.0),
+}
+
+ANALYTICS_ROUTES = frozenset([
+    '/manager/top_k_clients', '/manager/model_usage', '/manager/driver_stats',
+    '/manager/clients_by_city', '/manager/clients_by_cities',
+    '/manager/bulk/import/<entity>', '/manager/bulk/export/<entity>',
+])
+# POST routes that only read
+READ_ROUTES = frozenset([
+    '/manager/login', '/driver/login', '/client/login', '/session/logout',
+    '/client/view_available_models', '/client/available_models_range', '/client/view_rents',
+])
+EXEMPT_ROUTES = frozenset(['/', '/metrics'])
+
+
+def route_class(rule, method):
+    """The class of route rule for method, or None if it is not limited."""
+    if rule is None or rule in EXEMPT_ROUTES or method == 'OPTIONS':
+        return None
+    if rule in ANALYTICS_ROUTES:
+        return 'analytics'
+    if rule in READ_ROUTES or method in ('GET', 'HEAD'):
+        return 'read'
+    return 'write'
+
+
+def client_address(headers, address):
+    """The client's address: the peer's, or the one the trusted proxies saw."""
+    if not TRUSTED_PROXIES:
+        return address
+    # Each trusted proxy appends the address it got the request from; the
+    # entries before those could have been sent by the client itself.
+    hops = [hop.strip() for hop in headers.get('X-Forwarded-For', '').split(',') if hop.strip()]
+    hops.append(address)
+    return hops[max(len(hops) - 1 - TRUSTED_PROXIES, 0)]
+
+
+def identity(headers, address):
+    """The rate limit identity of a request, or None if it is not rate limited."""
+    token = sessions.bearer_token(headers)
+    if token:
+        try:
+            claims = sessions.verify(token)
+            return '%s:%s' % (claims['role'], claims['sub'])
+        except sessions.SessionError:
+            pass   # the route answers for the token
+    if not RATE_LIMIT_ADDRESSES:
+        return None
+    return 'addr:%s' % client_address(headers, address)
+
+
+class Rejected(Exception):
+    """A request turned away; status is 429 or 503."""
+
+    def __init__(self, status, message, retry_after):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+    def headers(self):
+        return {'Retry-After': str(max(1, math.ceil(self.retry_after)))}
+
+
+# -------------------- Token buckets --------------------
+
+class MemoryBuckets:
+    """Token buckets of this process."""
+
+    def __init__(self, max_buckets=MAX_BUCKETS):
+        self.max_buckets = max_buckets
+        self._lock = threading.Lock()
+        self._buckets = {}   # key -> [tokens, updated_at]
+
+    def take(self, key, rate, burst, cost=1.0):
+        """(True, 0) if key's bucket had cost tokens, else (False, seconds until it will)."""
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                if len(self._buckets) >= self.max_buckets:
+                    self._prune(now)
+                bucket = self._buckets[key] = [burst, now]
+            tokens = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+            if tokens >= cost:
+                bucket[0] = tokens - cost
+                return True, 0.0
+            bucket[0] = tokens
+            return False, (cost - tokens) / rate
+
+    def _prune(self, now):
+        # A bucket idle long enough to be full again is the same as no bucket.
+        # The buckets do not record their own rate, so assume the slowest.
+        refill = max(limits.burst / limits.rate for limits in CLASS_LIMITS.values())
+        self._buckets = {k: b for k, b in self._buckets.items() if now - b[1] < refill}
+        while len(self._buckets) >= self.max_buckets:
+            self._buckets.pop(next(iter(self._buckets)))
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class PostgresBuckets:
+    """Token buckets shared by every process through the rate_limit_buckets table."""
+
+    # Refill and take in one statement; no row back means the bucket is short
+    TAKE_SQL = """
+        INSERT INTO rate_limit_buckets AS b (key, tokens, updated_at)
+        VALUES (%(key)s, %(burst)s - %(cost)s, clock_timestamp())
+        ON CONFLICT (key) DO UPDATE
+            SET tokens = LEAST(%(burst)s, b.tokens + EXTRACT(EPOCH FROM clock_timestamp() - b.updated_at)
+                                                     * %(rate)s) - %(cost)s,
+                updated_at = clock_timestamp()
+            WHERE LEAST(%(burst)s, b.tokens + EXTRACT(EPOCH FROM clock_timestamp() - b.updated_at)
+                                              * %(rate)s) >= %(cost)s
+        RETURNING tokens
+    """
+    LEVEL_SQL = """
+        SELECT LEAST(%(burst)s, tokens + EXTRACT(EPOCH FROM clock_timestamp() - updated_at) * %(rate)s)
+        FROM rate_limit_buckets WHERE key = %(key)s
+    """
+    PURGE_SQL = "DELETE FROM rate_limit_buckets WHERE updated_at < now() - interval '1 hour'"
+
+    def __init__(self, purge_every=300):
+        self.purge_every = purge_every
+        self._next_purge = 0.0
+
+    def take(self, key, rate, burst, cost=1.0):
+        params = {'key': key, 'rate': rate, 'burst': burst, 'cost': cost}
+        conn = get_connection()
+        cur = conn.cursor()
+        try:
+            if time.monotonic() >= self._next_purge:
+                self._next_purge = time.monotonic() + self.purge_every
+                cur.execute(self.PURGE_SQL)
+            cur.execute(self.TAKE_SQL, params)
+            taken = cur.fetchone() is not None
+            tokens = None
+            if not taken:
+                cur.execute(self.LEVEL_SQL, params)
+                row = cur.fetchone()
+                tokens = float(row[0]) if row else 0.0
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cur.close()
+            conn.close()
+        return (True, 0.0) if taken else (False, max(cost - tokens, 0.0) / rate)
+
+
+RATE_LIMIT_TABLE = """
+    CREATE UNLOGGED TABLE IF NOT EXISTS rate_limit_buckets (
+        key TEXT PRIMARY KEY,
+        tokens DOUBLE PRECISION NOT NULL,
+        updated_at TIMESTAMPTZ NOT NULL
+    );
+"""
+
+
+# -------------------- Concurrency gates --------------------
+
+class Gate:
+    """Up to limit requests in flight; up to queue more wait for a slot."""
+
+    def __init__(self, name, limit, queue, queue_timeout):
+        self.name = name
+        self.limit = limit
+        self.queue = queue
+        self.queue_timeout = queue_timeout
+        self._cond = threading.Condition()
+        self.in_flight = 0
+        self.waiting = 0
+        # Counters
+        self.admitted = 0
+        self.queued = 0
+        self.shed_queue_full = 0
+        self.shed_deadline = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+
+    def enter(self):
+        """Take a slot, waiting up to queue_timeout; raises Rejected otherwise."""
+        with self._cond:
+            if self.in_flight < self.limit and not self.waiting:
+                self.in_flight += 1
+                self.admitted += 1
+                return
+            if self.waiting >= self.queue:
+                self.shed_queue_full += 1
+                raise Rejected(503, "Too many %s requests in progress, please retry" % self.name,
+                               self.queue_timeout)
+            self.waiting += 1
+            self.queued += 1
+            started = time.monotonic()
+            deadline = started + self.queue_timeout
+            try:
+                while self.in_flight >= self.limit:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.shed_deadline += 1
+                        raise Rejected(503, "Timed out waiting for a %s slot, please retry" % self.name,
+                                       self.queue_timeout)
+                    self._cond.wait(remaining)
+            finally:
+                self.waiting -= 1
+            self._waited(time.monotonic() - started)
+            self.in_flight += 1
+            self.admitted += 1
+
+    def leave(self):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify()
+
+    def _waited(self, elapsed):
+        self.wait_time_total += elapsed
+        self.wait_time_max = max(self.wait_time_max, elapsed)
+
+    def stats(self):
+        return {
+            'limit': self.limit,
+            'queue': self.queue,
+            'queue_timeout': self.queue_timeout,
+            'in_flight': self.in_flight,
+            'waiting': self.waiting,
+            'admitted': self.admitted,
+            'queued': self.queued,
+            'shed_queue_full': self.shed_queue_full,
+            'shed_deadline': self.shed_deadline,
+            'wait_time_avg_ms': round(self.wait_time_total / self.queued * 1000, 3) if self.queued else 0.0,
+            'wait_time_max_ms': round(self.wait_time_max * 1000, 3),
+        }
+
+
+class AsyncGate(Gate):
+    """Gate for the async handlers of asgi.py, which must not block the event loop."""
+
+    def __init__(self, name, limit, queue, queue_timeout):
+        super().__init__(name, limit, queue, queue_timeout)
+        self._slots = None   # created on first use, inside the running loop
+
+    async def enter(self):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.limit)
+        if self._slots.locked():
+            if self.waiting >= self.queue:
+                self.shed_queue_full += 1
+                raise Rejected(503, "Too many %s requests in progress, please retry" % self.name,
+                               self.queue_timeout)
+            self.waiting += 1
+            self.queued += 1
+            started = time.monotonic()
+            try:
+                await asyncio.wait_for(self._slots.acquire(), self.queue_timeout)
+            except asyncio.TimeoutError:
+                self.shed_deadline += 1
+                raise Rejected(503, "Timed out waiting for a %s slot, please retry" % self.name,
+                               self.queue_timeout)
+            finally:
+                self.waiting -= 1
+            self._waited(time.monotonic() - started)
+        else:
+            await self._slots.acquire()
+        self.in_flight += 1
+        self.admitted += 1
+
+    def leave(self):
+        self.in_flight -= 1
+        self._slots.release()
+
+
+# -------------------- Controller --------------------
+
+class Controller:
+    def __init__(self, buckets, shared=None):
+        self.buckets = buckets
+        self.shared = shared
+        self.gates = {name: Gate(name, limits.concurrency, limits.queue, limits.queue_timeout)
+                      for name, limits in CLASS_LIMITS.items()}
+        # The async handlers have their own connection pool, so their own caps
+        self.async_gates = {name: AsyncGate(name, limits.concurrency, limits.queue, limits.queue_timeout)
+                            for name, limits in CLASS_LIMITS.items()}
+        self._lock = threading.Lock()
+        self.rate_limited = {name: 0 for name in CLASS_LIMITS}
+        self.shared_failures = 0
+
+    def check_rate(self, route_class, route, who):
+        """Take a token for who on route; raises Rejected (429) if there is none."""
+        if who is None:
+            return
+        limits = CLASS_LIMITS[route_class]
+        key = '%s|%s' % (who, route)
+        allowed = None
+        if self.shared is not None:
+            try:
+                allowed, retry_after = self.shared.take(key, limits.rate, limits.burst)
+            except Exception as e:
+                # Keep limiting with this process's buckets while the shared store is down
+                with self._lock:
+                    self.shared_failures += 1
+                log.warning("Shared rate limit store unavailable: %s", e)
+        if allowed is None:
+            allowed, retry_after = self.buckets.take(key, limits.rate, limits.burst)
+        if not allowed:
+            with self._lock:
+                self.rate_limited[route_class] += 1
+            raise Rejected(429, "Too many requests, please slow down", retry_after)
+
+    def stats(self):
+        classes = {}
+        for name, limits in CLASS_LIMITS.items():
+            classes[name] = dict(self.gates[name].stats(), rate=limits.rate, burst=limits.burst,
+                                 rate_limited=self.rate_limited[name])
+            if self.async_gates[name].admitted:
+                classes[name]['async'] = self.async_gates[name].stats()
+        return {
+            'enabled': ADMISSION,
+            'rate_limit_addresses': RATE_LIMIT_ADDRESSES,
+            'store': 'postgres' if self.shared is not None else 'memory',
+            'buckets': len(self.buckets),
+            'shared_failures': self.shared_failures,
+            'classes': classes,
+        }
+
+
+controller = Controller(MemoryBuckets(), PostgresBuckets() if RATE_LIMIT_STORE == 'postgres' else None)
+
+
+def rejection_response(e):
+    response = jsonify({'error': str(e)})
+    response.status_code = e.status
+    response.headers.update(e.headers())
+    return response
+
+
+# -------------------- Flask hooks --------------------
+
+class _Slot:
+    def __init__(self, gate):
+        self.gate = gate
+        self.deferred = False
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self.gate.leave()
+
+
+def _before():
+    rule = request.url_rule
+    cls = route_class(rule.rule if rule is not None else None, request.method)
+    if cls is None:
+        return None
+    try:
+        controller.check_rate(cls, rule.rule, identity(request.headers, request.remote_addr))
+        gate = controller.gates[cls]
+        gate.enter()
+    except Rejected as e:
+        return rejection_response(e)
+    g.admission_slot = _Slot(gate)
+    return None
+
+
+def _after(response):
+    slot = g.get('admission_slot')
+    if slot is not None and response.is_streamed:
+        # Streamed responses hold their slot until the last byte is sent
+        slot.deferred = True
+        response.call_on_close(slot.release)
+    return response
+
+
+def _teardown(exc):
+    slot = g.get('admission_slot')
+    if slot is not None and not slot.deferred:
+        slot.release()
+
+
+def install(app):
+    """Rate limit and cap the concurrency of every route of app."""
+    if not ADMISSION:
+        return
+    app.before_request(_before)
+    app.after_request(_after)
+    app.teardown_request(_teardown)
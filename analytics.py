@@ -0,0 +1,457 @@
+# analytics.py
+#
+# Summary tables behind the manager dashboards. They are kept in sync by
+# statement-level triggers on Rent, Review, Driver and Model, so every write
+# path (single bookings, batches, cascading deletes) updates them in the
+# same transaction and the dashboards never re-aggregate history.
+#
+# Driver ratings are kept two ways: the all-time sum and count, and a recent
+# average that weighs each review by its age with a RATING_HALF_LIFE_DAYS
+# half-life. The recent sum and weight decay by the same factor, so their
+# ratio only changes when a review is written and reads stay O(1) with no
+# expiry job.
+#
+# driver_city_rent_stats counts each client's rents by the city of the
+# driver, the client x driver-city matrix behind /manager/clients_by_cities.
+# The client side of a city pair is resolved through Client_Address at read
+# time, so address changes need no upkeep; a driver moving city moves their
+# rents between rows (driver_city_on_update).
+#
+# The DDL is layered the way it shipped: create() is migration 3, and
+# add_rating_window() and add_city_matrix() replace the functions they
+# change on top of it. Do not edit a layer that has shipped.
+#
+#   python analytics.py --refresh     # rebuild the summaries from scratch
+
+import sys
+
+from database import get_connection
+
+# -------------------- Migration 3: summaries --------------------
+
+SUMMARY_TABLES = """
+    CREATE TABLE IF NOT EXISTS client_rent_stats (
+        client_email VARCHAR(100) PRIMARY KEY,
+        rent_count INTEGER NOT NULL DEFAULT 0,
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+    CREATE INDEX IF NOT EXISTS client_rent_stats_count_idx ON client_rent_stats (rent_count DESC);
+
+    CREATE TABLE IF NOT EXISTS model_rent_stats (
+        model_id INTEGER NOT NULL,
+        car_id INTEGER NOT NULL,
+        times_rented INTEGER NOT NULL DEFAULT 0,
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        PRIMARY KEY (model_id, car_id)
+    );
+
+    CREATE TABLE IF NOT EXISTS driver_rent_stats (
+        name VARCHAR(100) PRIMARY KEY,
+        total_rents INTEGER NOT NULL DEFAULT 0,
+        rating_sum BIGINT NOT NULL DEFAULT 0,
+        rating_count INTEGER NOT NULL DEFAULT 0,
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+"""
+
+TRIGGERS = """
+    -- Apply a set of Rent rows to the summaries with the given sign
+    CREATE OR REPLACE FUNCTION rent_stats_apply(
+        emails TEXT[], names TEXT[], model_ids INTEGER[], car_ids INTEGER[], sign INTEGER
+    ) RETURNS void LANGUAGE plpgsql AS $$
+    BEGIN
+        INSERT INTO client_rent_stats AS s (client_email, rent_count)
+        SELECT e, sign * COUNT(*) FROM unnest(emails) AS e GROUP BY e ORDER BY e
+        ON CONFLICT (client_email) DO UPDATE
+            SET rent_count = s.rent_count + EXCLUDED.rent_count, updated_at = now();
+
+        INSERT INTO model_rent_stats AS s (model_id, car_id, times_rented)
+        SELECT m, c, sign * COUNT(*) FROM unnest(model_ids, car_ids) AS r(m, c) GROUP BY m, c ORDER BY m, c
+        ON CONFLICT (model_id, car_id) DO UPDATE
+            SET times_rented = s.times_rented + EXCLUDED.times_rented, updated_at = now();
+
+        INSERT INTO driver_rent_stats AS s (name, total_rents)
+        SELECT n, sign * COUNT(*) FROM unnest(names) AS n GROUP BY n ORDER BY n
+        ON CONFLICT (name) DO UPDATE
+            SET total_rents = s.total_rents + EXCLUDED.total_rents, updated_at = now();
+    END $$;
+
+    CREATE OR REPLACE FUNCTION rent_stats_on_insert() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        PERFORM rent_stats_apply(array_agg(client_email::text), array_agg(name::text),
+                                 array_agg(model_id), array_agg(car_id), 1)
+        FROM new_rows HAVING COUNT(*) > 0;
+        RETURN NULL;
+    END $$;
+
+    CREATE OR REPLACE FUNCTION rent_stats_on_delete() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        PERFORM rent_stats_apply(array_agg(client_email::text), array_agg(name::text),
+                                 array_agg(model_id), array_agg(car_id), -1)
+        FROM old_rows HAVING COUNT(*) > 0;
+        RETURN NULL;
+    END $$;
+
+    CREATE OR REPLACE FUNCTION rent_stats_on_update() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        PERFORM rent_stats_apply(array_agg(client_email::text), array_agg(name::text),
+                                 array_agg(model_id), array_agg(car_id), -1)
+        FROM old_rows HAVING COUNT(*) > 0;
+        PERFORM rent_stats_apply(array_agg(client_email::text), array_agg(name::text),
+                                 array_agg(model_id), array_agg(car_id), 1)
+        FROM new_rows HAVING COUNT(*) > 0;
+        RETURN NULL;
+    END $$;
+
+    CREATE OR REPLACE FUNCTION review_stats_apply(names TEXT[], ratings INTEGER[], sign INTEGER)
+    RETURNS void LANGUAGE plpgsql AS $$
+    BEGIN
+        INSERT INTO driver_rent_stats AS s (name, rating_sum, rating_count)
+        SELECT n, sign * COALESCE(SUM(r), 0), sign * COUNT(r)
+        FROM unnest(names, ratings) AS x(n, r) GROUP BY n ORDER BY n
+        ON CONFLICT (name) DO UPDATE
+            SET rating_sum = s.rating_sum + EXCLUDED.rating_sum,
+                rating_count = s.rating_count + EXCLUDED.rating_count,
+                updated_at = now();
+    END $$;
+
+    CREATE OR REPLACE FUNCTION review_stats_on_insert() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        PERFORM review_stats_apply(array_agg(name::text), array_agg(rating::integer), 1)
+        FROM new_rows HAVING COUNT(*) > 0;
+        RETURN NULL;
+    END $$;
+
+    CREATE OR REPLACE FUNCTION review_stats_on_delete() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        PERFORM review_stats_apply(array_agg(name::text), array_agg(rating::integer), -1)
+        FROM old_rows HAVING COUNT(*) > 0;
+        RETURN NULL;
+    END $$;
+
+    CREATE OR REPLACE FUNCTION driver_stats_on_delete() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        DELETE FROM driver_rent_stats s USING old_rows o WHERE s.name = o.name;
+        RETURN NULL;
+    END $$;
+
+    CREATE OR REPLACE FUNCTION model_stats_on_delete() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        DELETE FROM model_rent_stats s USING old_rows o
+        WHERE s.model_id = o.model_id AND s.car_id = o.car_id;
+        RETURN NULL;
+    END $$;
+
+    DROP TRIGGER IF EXISTS rent_stats_insert ON Rent;
+    CREATE TRIGGER rent_stats_insert AFTER INSERT ON Rent
+        REFERENCING NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION rent_stats_on_insert();
+
+    DROP TRIGGER IF EXISTS rent_stats_delete ON Rent;
+    CREATE TRIGGER rent_stats_delete AFTER DELETE ON Rent
+        REFERENCING OLD TABLE AS old_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION rent_stats_on_delete();
+
+    DROP TRIGGER IF EXISTS rent_stats_update ON Rent;
+    CREATE TRIGGER rent_stats_update AFTER UPDATE ON Rent
+        REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION rent_stats_on_update();
+
+    DROP TRIGGER IF EXISTS review_stats_insert ON Review;
+    CREATE TRIGGER review_stats_insert AFTER INSERT ON Review
+        REFERENCING NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION review_stats_on_insert();
+
+    DROP TRIGGER IF EXISTS review_stats_delete ON Review;
+    CREATE TRIGGER review_stats_delete AFTER DELETE ON Review
+        REFERENCING OLD TABLE AS old_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION review_stats_on_delete();
+
+    DROP TRIGGER IF EXISTS driver_stats_delete ON Driver;
+    CREATE TRIGGER driver_stats_delete AFTER DELETE ON Driver
+        REFERENCING OLD TABLE AS old_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION driver_stats_on_delete();
+
+    DROP TRIGGER IF EXISTS model_stats_delete ON Model;
+    CREATE TRIGGER model_stats_delete AFTER DELETE ON Model
+        REFERENCING OLD TABLE AS old_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION model_stats_on_delete();
+"""
+
+# Backfill of freshly created summaries
+SUMMARY_BACKFILL = """
+    LOCK TABLE Rent, Review IN SHARE MODE;
+    TRUNCATE client_rent_stats, model_rent_stats, driver_rent_stats;
+
+    INSERT INTO client_rent_stats (client_email, rent_count)
+    SELECT client_email, COUNT(*) FROM Rent GROUP BY client_email;
+
+    INSERT INTO model_rent_stats (model_id, car_id, times_rented)
+    SELECT model_id, car_id, COUNT(*) FROM Rent GROUP BY model_id, car_id;
+
+    INSERT INTO driver_rent_stats (name, total_rents, rating_sum, rating_count)
+    SELECT d.name, COALESCE(r.total_rents, 0), COALESCE(rv.rating_sum, 0), COALESCE(rv.rating_count, 0)
+    FROM Driver d
+    LEFT JOIN (SELECT name, COUNT(*) AS total_rents FROM Rent GROUP BY name) r ON r.name = d.name
+    LEFT JOIN (
+        SELECT name, SUM(rating) AS rating_sum, COUNT(rating) AS rating_count FROM Review GROUP BY name
+    ) rv ON rv.name = d.name;
+"""
+
+# -------------------- Migration 6: recent rating average --------------------
+
+RATING_HALF_LIFE_DAYS = 30
+
+RATING_WINDOW = """
+    ALTER TABLE driver_rent_stats
+        ADD COLUMN IF NOT EXISTS recent_rating_sum DOUBLE PRECISION NOT NULL DEFAULT 0,
+        ADD COLUMN IF NOT EXISTS recent_rating_weight DOUBLE PRECISION NOT NULL DEFAULT 0,
+        ADD COLUMN IF NOT EXISTS recent_rating_at TIMESTAMPTZ NOT NULL DEFAULT now();
+"""
+
+RATING_TRIGGERS = """
+    -- Weight of a review of the given age in the recent rating average
+    CREATE OR REPLACE FUNCTION rating_decay(age INTERVAL) RETURNS DOUBLE PRECISION
+    LANGUAGE sql IMMUTABLE AS $$
+        SELECT power(0.5, GREATEST(extract(epoch FROM age), 0) / (%(half_life_days)s * 86400.0))
+    $$;
+
+    -- Drop the old two-argument version replaced below
+    DROP FUNCTION IF EXISTS review_stats_apply(TEXT[], INTEGER[], INTEGER);
+
+    CREATE OR REPLACE FUNCTION review_stats_apply(
+        names TEXT[], ratings INTEGER[], created TIMESTAMPTZ[], sign INTEGER
+    ) RETURNS void LANGUAGE plpgsql AS $$
+    BEGIN
+        -- Decay the stored recent sum and weight to now, then add this batch
+        INSERT INTO driver_rent_stats AS s (name, rating_sum, rating_count,
+                                            recent_rating_sum, recent_rating_weight, recent_rating_at)
+        SELECT n, sign * COALESCE(SUM(r), 0), sign * COUNT(r),
+               sign * COALESCE(SUM(r * rating_decay(now() - c)), 0),
+               sign * COALESCE(SUM(rating_decay(now() - c)) FILTER (WHERE r IS NOT NULL), 0),
+               now()
+        FROM unnest(names, ratings, created) AS x(n, r, c) GROUP BY n ORDER BY n
+        ON CONFLICT (name) DO UPDATE
+            SET rating_sum = s.rating_sum + EXCLUDED.rating_sum,
+                rating_count = s.rating_count + EXCLUDED.rating_count,
+                recent_rating_sum = GREATEST(
+                    s.recent_rating_sum * rating_decay(now() - s.recent_rating_at) + EXCLUDED.recent_rating_sum, 0),
+                recent_rating_weight = GREATEST(
+                    s.recent_rating_weight * rating_decay(now() - s.recent_rating_at) + EXCLUDED.recent_rating_weight, 0),
+                recent_rating_at = now(),
+                updated_at = now();
+    END $$;
+
+    CREATE OR REPLACE FUNCTION review_stats_on_insert() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        PERFORM review_stats_apply(array_agg(name::text), array_agg(rating::integer), array_agg(created_at), 1)
+        FROM new_rows HAVING COUNT(*) > 0;
+        RETURN NULL;
+    END $$;
+
+    CREATE OR REPLACE FUNCTION review_stats_on_delete() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        PERFORM review_stats_apply(array_agg(name::text), array_agg(rating::integer), array_agg(created_at), -1)
+        FROM old_rows HAVING COUNT(*) > 0;
+        RETURN NULL;
+    END $$;
+"""
+
+REVIEW_TOTALS = """
+    SELECT name, SUM(rating) AS rating_sum, COUNT(rating) AS rating_count,
+           SUM(rating * rating_decay(now() - created_at)) AS recent_rating_sum,
+           SUM(rating_decay(now() - created_at)) FILTER (WHERE rating IS NOT NULL) AS recent_rating_weight
+    FROM Review GROUP BY name
+"""
+
+RATING_WINDOW_BACKFILL = """
+    LOCK TABLE Review IN SHARE MODE;
+    UPDATE driver_rent_stats s
+    SET recent_rating_sum = COALESCE(rv.recent_rating_sum, 0),
+        recent_rating_weight = COALESCE(rv.recent_rating_weight, 0),
+        recent_rating_at = now()
+    FROM (%(review_totals)s) rv
+    WHERE rv.name = s.name;
+"""
+
+# -------------------- Migration 7: client x driver-city matrix --------------------
+
+CITY_MATRIX_TABLE = """
+    CREATE TABLE IF NOT EXISTS driver_city_rent_stats (
+        driver_city VARCHAR(50) NOT NULL,
+        client_email VARCHAR(100) NOT NULL,
+        rent_count INTEGER NOT NULL DEFAULT 0,
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        PRIMARY KEY (driver_city, client_email)
+    );
+    CREATE INDEX IF NOT EXISTS driver_city_rent_stats_client_idx
+        ON driver_city_rent_stats (client_email) INCLUDE (driver_city, rent_count);
+"""
+
+# Rent has no city, so a rent is counted under its driver's current city.
+# Rent writers share-lock their drivers' rows and a city change holds them
+# for update, so whichever comes second waits for the first to commit and
+# then sees its change: a booking reads the new city, and a move counts
+# the booking's rents. Only writers touching the moved drivers wait.
+CITY_MATRIX_TRIGGERS = """
+    CREATE OR REPLACE FUNCTION rent_stats_apply(
+        emails TEXT[], names TEXT[], model_ids INTEGER[], car_ids INTEGER[], sign INTEGER
+    ) RETURNS void LANGUAGE plpgsql AS $$
+    BEGIN
+        INSERT INTO client_rent_stats AS s (client_email, rent_count)
+        SELECT e, sign * COUNT(*) FROM unnest(emails) AS e GROUP BY e ORDER BY e
+        ON CONFLICT (client_email) DO UPDATE
+            SET rent_count = s.rent_count + EXCLUDED.rent_count, updated_at = now();
+
+        INSERT INTO model_rent_stats AS s (model_id, car_id, times_rented)
+        SELECT m, c, sign * COUNT(*) FROM unnest(model_ids, car_ids) AS r(m, c) GROUP BY m, c ORDER BY m, c
+        ON CONFLICT (model_id, car_id) DO UPDATE
+            SET times_rented = s.times_rented + EXCLUDED.times_rented, updated_at = now();
+
+        INSERT INTO driver_rent_stats AS s (name, total_rents)
+        SELECT n, sign * COUNT(*) FROM unnest(names) AS n GROUP BY n ORDER BY n
+        ON CONFLICT (name) DO UPDATE
+            SET total_rents = s.total_rents + EXCLUDED.total_rents, updated_at = now();
+
+        PERFORM 1 FROM Driver WHERE name = ANY(names) ORDER BY name FOR SHARE;
+        INSERT INTO driver_city_rent_stats AS s (driver_city, client_email, rent_count)
+        SELECT d.city, x.e, sign * COUNT(*)
+        FROM unnest(emails, names) AS x(e, n) JOIN Driver d ON d.name = x.n
+        GROUP BY d.city, x.e ORDER BY d.city, x.e
+        ON CONFLICT (driver_city, client_email) DO UPDATE
+            SET rent_count = s.rent_count + EXCLUDED.rent_count, updated_at = now();
+    END $$;
+
+    -- Move the rents of drivers who changed city to the new city
+    CREATE OR REPLACE FUNCTION driver_city_on_update() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        WITH moved AS (
+            SELECT o.name, o.city AS old_city, n.city AS new_city
+            FROM old_rows o JOIN new_rows n ON n.name = o.name
+            WHERE n.city IS DISTINCT FROM o.city
+        ),
+        rents AS (
+            SELECT m.old_city, m.new_city, r.client_email, COUNT(*) AS rent_count
+            FROM moved m JOIN Rent r ON r.name = m.name
+            GROUP BY m.old_city, m.new_city, r.client_email
+        ),
+        deltas AS (
+            SELECT old_city AS city, client_email, -rent_count AS rent_count FROM rents
+            UNION ALL
+            SELECT new_city, client_email, rent_count FROM rents
+        )
+        INSERT INTO driver_city_rent_stats AS s (driver_city, client_email, rent_count)
+        SELECT city, client_email, SUM(rent_count) FROM deltas
+        GROUP BY city, client_email ORDER BY city, client_email
+        ON CONFLICT (driver_city, client_email) DO UPDATE
+            SET rent_count = s.rent_count + EXCLUDED.rent_count, updated_at = now();
+        RETURN NULL;
+    END $$;
+
+    DROP TRIGGER IF EXISTS driver_city_update ON Driver;
+    CREATE TRIGGER driver_city_update AFTER UPDATE ON Driver
+        REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION driver_city_on_update();
+"""
+
+CITY_MATRIX = """
+    TRUNCATE driver_city_rent_stats;
+    INSERT INTO driver_city_rent_stats (driver_city, client_email, rent_count)
+    SELECT d.city, r.client_email, COUNT(*)
+    FROM Rent r JOIN Driver d ON d.name = r.name
+    GROUP BY d.city, r.client_email;
+"""
+
+# -------------------- Full rebuild --------------------
+
+# Recompute every summary from the base tables. Locks out writers to Rent,
+# Review and Driver for the duration so no trigger update is lost.
+REFRESH = """
+    LOCK TABLE Rent, Review, Driver IN SHARE MODE;
+    TRUNCATE client_rent_stats, model_rent_stats, driver_rent_stats;
+
+    INSERT INTO client_rent_stats (client_email, rent_count)
+    SELECT client_email, COUNT(*) FROM Rent GROUP BY client_email;
+
+    INSERT INTO model_rent_stats (model_id, car_id, times_rented)
+    SELECT model_id, car_id, COUNT(*) FROM Rent GROUP BY model_id, car_id;
+
+    INSERT INTO driver_rent_stats (name, total_rents, rating_sum, rating_count,
+                                   recent_rating_sum, recent_rating_weight)
+    SELECT d.name, COALESCE(r.total_rents, 0), COALESCE(rv.rating_sum, 0), COALESCE(rv.rating_count, 0),
+           COALESCE(rv.recent_rating_sum, 0), COALESCE(rv.recent_rating_weight, 0)
+    FROM Driver d
+    LEFT JOIN (SELECT name, COUNT(*) AS total_rents FROM Rent GROUP BY name) r ON r.name = d.name
+    LEFT JOIN (%(review_totals)s) rv ON rv.name = d.name;
+
+    %(city_matrix)s
+"""
+
+
+def _sql(template):
+    # Templates use %(name)s placeholders, filled in here rather than by the driver
+    return template % {'half_life_days': RATING_HALF_LIFE_DAYS, 'review_totals': REVIEW_TOTALS,
+                       'city_matrix': CITY_MATRIX}
+
+
+def create(cur):
+    """Create the summary tables and triggers; backfill them if they are new.
+
+    Runs as a schema.py migration.
+    """
+    cur.execute("SELECT to_regclass('driver_rent_stats') IS NULL")
+    is_new = cur.fetchone()[0]
+    cur.execute(SUMMARY_TABLES)
+    cur.execute(TRIGGERS)
+    if is_new:
+        cur.execute(SUMMARY_BACKFILL)
+
+
+def add_rating_window(cur):
+    """Add the recent rating average to existing summaries.
+
+    Runs as a schema.py migration, after Review gained created_at.
+    """
+    cur.execute(RATING_WINDOW)
+    cur.execute(_sql(RATING_TRIGGERS))
+    cur.execute(_sql(RATING_WINDOW_BACKFILL))
+
+
+def add_city_matrix(cur):
+    """Add the client x driver-city rent matrix to existing summaries.
+
+    Runs as a schema.py migration.
+    """
+    cur.execute(CITY_MATRIX_TABLE)
+    cur.execute(CITY_MATRIX_TRIGGERS)
+    cur.execute("LOCK TABLE Rent, Driver IN SHARE MODE")
+    cur.execute(CITY_MATRIX)
+
+
+def install(conn):
+    # Summaries are part of the versioned schema; bring it up to date
+    import schema
+    schema.migrate(conn)
+
+
+def refresh(conn):
+    cur = conn.cursor()
+    try:
+        cur.execute(_sql(REFRESH))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+
+
+if __name__ == '__main__':
+    conn = get_connection()
+    try:
+        install(conn)
+        if '--refresh' in sys.argv:
+            refresh(conn)
+        print("Analytics summaries are up to date")
+    finally:
+        conn.close()
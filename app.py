@@ -1,16 +1,116 @@
 # app.py
 
-from flask import Flask, request, jsonify
+import base64
+import json
+import os
+from datetime import date, datetime, timedelta, timezone
+
+from flask import Flask, Request, Response, request, jsonify
 from flask_cors import CORS
-from database import get_connection  
+from werkzeug.exceptions import BadRequest
+from database import get_connection, pool_stats, PoolTimeout
+import booking
+import bulk
+from availability import index as availability_index
+import assignment
+import schema
+from cache import catalog_cache
+import queries
+import metrics
+import request_log
+import reviews
+import offboarding
+import sessions
+import idempotency
+import outbox
+import admission
 
 app = Flask(__name__)
-CORS(app)
+CORS(app, expose_headers=['X-Data-As-Of', 'Retry-After', 'ETag', 'Idempotent-Replayed'])
+metrics.install(app)
+admission.install(app)
+request_log.install(app)
+outbox.install(app)
+
+# Keep this process's caches in step with writes made by every process;
+# each handler also updates them directly for its own writes.
+CATALOG_EVENTS = ['CarAdded', 'CarDeleted', 'ModelAdded', 'ModelDeleted', 'BulkImported']
+AVAILABILITY_EVENTS = ['RentBooked', 'RentDeleted', 'DriverModelDeclared', 'DriverModelRemoved',
+                       'DriverDeleted', 'ModelDeleted', 'CarDeleted', 'BulkImported']
+outbox.subscribe('catalog_cache', CATALOG_EVENTS, lambda events: catalog_cache.invalidate())
+outbox.subscribe('availability_index', AVAILABILITY_EVENTS, availability_index.apply_events)
+
+INVALID_JSON = "Request body must be a JSON object"
+
+
+class InvalidJSON(BadRequest):
+    description = INVALID_JSON
+
+
+class JSONRequest(Request):
+    def on_json_loading_failed(self, e):
+        # A malformed or empty body gets the API's JSON error shape instead
+        # of an HTML page; asgi.py answers its native routes the same way
+        if e is not None:
+            raise InvalidJSON()
+        return super().on_json_loading_failed(e)
+
+
+app.request_class = JSONRequest
+
+
+@app.errorhandler(InvalidJSON)
+def handle_invalid_json(e):
+    return jsonify({"error": INVALID_JSON}), 400
+
+@app.errorhandler(PoolTimeout)
+def handle_pool_timeout(e):
+    # Every connection is busy; tell the client to back off instead of queueing forever.
+    response = jsonify({"error": "Service busy, please retry", "details": str(e)})
+    response.status_code = 503
+    response.headers['Retry-After'] = '1'
+    return response
 
 @app.route('/')
 def home():
     return "Welcome to the server!"
 
+@app.route('/manager/pool_stats', methods=['GET'])
+@sessions.require('manager')
+def get_pool_stats():
+    return jsonify(pool_stats()), 200
+
+@app.route('/manager/query_stats', methods=['GET'])
+@sessions.require('manager')
+def get_query_stats():
+    return jsonify(queries.stats()), 200
+
+# -------------------- Sessions --------------------
+# The login routes issue the tokens (see sessions.py); these check and end
+# them without touching the database.
+
+@app.route('/session', methods=['GET'])
+def session_info():
+    token = sessions.bearer_token(request.headers)
+    if token is None:
+        return jsonify({"error": "No session token"}), 401
+    try:
+        claims = sessions.verify(token)
+    except sessions.SessionError as e:
+        return jsonify({"error": str(e)}), 401
+    return jsonify({'role': claims['role'], 'identity': claims['sub'], 'expires_at': claims['exp']})
+
+@app.route('/session/logout', methods=['POST'])
+def session_logout():
+    token = sessions.bearer_token(request.headers)
+    if token is None:
+        return jsonify({"error": "No session token"}), 401
+    try:
+        sessions.revoke(sessions.verify(token))
+    except sessions.SessionError as e:
+        return jsonify({"error": str(e)}), 401
+    return jsonify({"message": "Logged out"})
+
 # -------------------- Manager APIs --------------------
 
 @app.route('/manager/register', methods=['POST'])
@@ -19,7 +119,7 @@ def register_manager():
     conn = get_connection()
     cur = conn.cursor()
     try:
-        cur.execute("INSERT INTO Manager (ssn, name, email) VALUES (%s, %s, %s)", (data['ssn'], data['name'], data['email']))
+        queries.execute(cur, 'register_manager', (data['ssn'], data['name'], data['email']))
         conn.commit()
         return jsonify({'message': 'Manager registered successfully'})
     except Exception as e:
@@ -35,7 +135,7 @@ def login_manager():
     conn = get_connection()
     cur = conn.cursor()
     try:
-        cur.execute("SELECT * FROM Manager WHERE ssn = %s", (data['ssn'],))
+        queries.execute(cur, 'manager_login', (data['ssn'],))
         manager = cur.fetchone()
         if manager:
             manager_name = manager[1]  # assuming index 1 is name
@@ -44,7 +144,8 @@ def login_manager():
                 'success': True,
                 'message': 'Manager login successful',
                 'name': manager_name,
-                'ssn': ssn
+                'ssn': ssn,
+                **sessions.issue('manager', sessions.subject_id(ssn))
             })
         else:
             return jsonify({'success': False, 'error': 'Invalid SSN'}), 404
@@ -56,13 +157,16 @@ def login_manager():
 
 
 @app.route('/manager/remove_car', methods=['POST'])
+@sessions.require('manager')
 def remove_car():
     data = request.get_json()
     conn = get_connection()
     cur = conn.cursor()
     try:
-        cur.execute("DELETE FROM Car WHERE brand = %s", (data['brand'],))
+        queries.execute(cur, 'delete_car_brand', (data['brand'],))
         conn.commit()
+        availability_index.remove_brand(data['brand'])
+        catalog_cache.invalidate()
         return jsonify({'message': 'Car removed'})
     except Exception as e:
         conn.rollback()
@@ -72,6 +176,7 @@ def remove_car():
         conn.close()
 
 @app.route('/manager/add_car', methods=['POST'])
+@sessions.require('manager')
 def add_car():
     data = request.get_json()
     brand = data.get('brand')
@@ -79,8 +184,9 @@ def add_car():
     conn = get_connection()
     cur = conn.cursor()
     try:
-        cur.execute("INSERT INTO Car (brand) VALUES (%s)", (brand,))
+        queries.execute(cur, 'add_car', (brand,))
         conn.commit()
+        catalog_cache.invalidate()
         return jsonify({"message": "Car added successfully"})
     except Exception as e:
         conn.rollback()
@@ -91,6 +197,7 @@ def add_car():
 
 # Add a Model
 @app.route('/manager/add_model', methods=['POST'])
+@sessions.require('manager')
 def add_model():
     data = request.get_json()
     car_id = data.get('car_id')
@@ -101,11 +208,9 @@ def add_model():
     conn = get_connection()
     cur = conn.cursor()
     try:
-        cur.execute("""
-            INSERT INTO Model (car_id, color, construction_year, transmission_type)
-            VALUES (%s, %s, %s, %s)
-        """, (car_id, color, construction_year, transmission_type))
+        queries.execute(cur, 'add_model', (car_id, color, construction_year, transmission_type))
         conn.commit()
+        catalog_cache.invalidate()
         return jsonify({"message": "Model added successfully"})
     except Exception as e:
         conn.rollback()
@@ -116,6 +221,7 @@ def add_model():
 
 # Delete a Car
 @app.route('/manager/delete_car', methods=['POST'])
+@sessions.require('manager')
 def delete_car():
     data = request.get_json()
     car_id = data.get('car_id')
@@ -123,8 +229,10 @@ def delete_car():
     conn = get_connection()
     cur = conn.cursor()
     try:
-        cur.execute("DELETE FROM Car WHERE car_id = %s", (car_id,))
+        queries.execute(cur, 'delete_car', (car_id,))
         conn.commit()
+        availability_index.remove_car(car_id)
+        catalog_cache.invalidate()
         return jsonify({"message": "Car deleted successfully"})
     except Exception as e:
         conn.rollback()
@@ -135,6 +243,7 @@ def delete_car():
 
 # Delete a Model
 @app.route('/manager/delete_model', methods=['POST'])
+@sessions.require('manager')
 def delete_model():
     data = request.get_json()
     car_id = data.get('car_id')
@@ -143,8 +252,10 @@ def delete_model():
     conn = get_connection()
     cur = conn.cursor()
     try:
-        cur.execute("DELETE FROM Model WHERE car_id = %s AND model_id = %s", (car_id, model_id))
+        queries.execute(cur, 'delete_model', (car_id, model_id))
         conn.commit()
+        availability_index.remove_model(model_id, car_id)
+        catalog_cache.invalidate()
         return jsonify({"message": "Model deleted successfully"})
     except Exception as e:
         conn.rollback()
@@ -154,11 +265,13 @@ def delete_model():
         conn.close()
 
 @app.route('/manager/get_cars', methods=['GET'])
+@sessions.require('manager')
+@catalog_cache.cached
 def get_cars():
     conn = get_connection()
     cur = conn.cursor()
     try:
-        cur.execute("SELECT car_id, brand FROM Car ORDER BY car_id")
+        queries.execute(cur, 'get_cars')
         cars = cur.fetchall()
         result = [{"car_id": row[0], "brand": row[1]} for row in cars]
         return jsonify(result)
@@ -169,25 +282,13 @@ def get_cars():
         conn.close()
 
 @app.route('/manager/view_models', methods=['GET'])
+@sessions.require('manager')
+@catalog_cache.cached
 def view_models():
     conn = get_connection()
     cur = conn.cursor()
     try:
-        cur.execute("""
-            SELECT 
-                Car.car_id,
-                Model.model_id,
-                Car.brand,
-                Model.color,
-                Model.construction_year,
-                Model.transmission_type
-            FROM 
-                Car
-            INNER JOIN 
-                Model ON Car.car_id = Model.car_id
-            ORDER BY 
-                Car.car_id, Model.model_id
-        """)
+        queries.execute(cur, 'catalog_models')
         models = cur.fetchall()
         result = []
         for row in models:
@@ -209,6 +310,7 @@ def view_models():
 
 
 @app.route('/manager/insert_address', methods=['POST'])
+@sessions.require('manager')
 def insert_address():
     data = request.get_json()
     nameofroad = data.get('nameofroad')
@@ -218,10 +320,7 @@ def insert_address():
     conn = get_connection()
     cur = conn.cursor()
     try:
-        cur.execute("""
-            INSERT INTO Address (nameofroad, number, city)
-            VALUES (%s, %s, %s)
-        """, (nameofroad, number, city))
+        queries.execute(cur, 'insert_address', (nameofroad, number, city))
         conn.commit()
         return jsonify({"message": "Address inserted successfully"})
     except Exception as e:
@@ -233,6 +332,7 @@ def insert_address():
 
 
 @app.route('/manager/insert_driver', methods=['POST'])
+@sessions.require('manager')
 def insert_driver():
     data = request.get_json()
     name = data.get('name')
@@ -250,18 +350,10 @@ def insert_driver():
         conn.autocommit = False  # Start transaction
 
         # 1. Insert address if not exists
-        cur.execute("""
-            INSERT INTO Address (nameofroad, number, city)
-            VALUES (%s, %s, %s)
-            ON CONFLICT (nameofroad, number, city) DO NOTHING
-            RETURNING *
-        """, (nameofroad, number, city))
+        queries.execute(cur, 'ensure_address', (nameofroad, number, city))
 
         # 2. Insert driver (which references the address)
-        cur.execute("""
-            INSERT INTO Driver (name, nameofroad, number, city)
-            VALUES (%s, %s, %s, %s)
-        """, (name, nameofroad, number, city))
+        queries.execute(cur, 'insert_driver', (name, nameofroad, number, city))
 
         conn.commit()
 
@@ -284,8 +376,11 @@ def insert_driver():
 
 
 @app.route('/manager/delete_driver', methods=['POST'])
+@sessions.require('manager')
 def delete_driver():
     data = request.get_json()
+    if 'names' in data:
+        return delete_drivers(data.get('names'), bool(data.get('dry_run')))
     name = data.get('name')
     
     # Validate input
@@ -305,17 +400,13 @@ def delete_driver():
         conn.autocommit = False
         
         # Verify driver exists WITHIN the same transaction
-        cur.execute("SELECT 1 FROM Driver WHERE name = %s FOR UPDATE", (name.strip(),))
+        queries.execute(cur, 'lock_driver', (name.strip(),))
         if not cur.fetchone():
             conn.rollback()
             return jsonify({"error": "Driver not found"}), 404
         
         # Check for active rentals
-        cur.execute("""
-            SELECT rent_id FROM Rent 
-            WHERE name = %s AND rent_date >= CURRENT_DATE
-            LIMIT 1
-        """, (name.strip(),))
+        queries.execute(cur, 'driver_active_rent', (name.strip(),))
         if cur.fetchone():
             conn.rollback()
             return jsonify({
@@ -324,17 +415,17 @@ def delete_driver():
             }), 400
         
         # Delete related records
-        cur.execute("DELETE FROM Review WHERE name = %s", (name.strip(),))
+        queries.execute(cur, 'delete_driver_reviews', (name.strip(),))
         reviews_deleted = cur.rowcount
         
-        cur.execute("DELETE FROM Driver_Model WHERE name = %s", (name.strip(),))
+        queries.execute(cur, 'delete_driver_models', (name.strip(),))
         models_unlinked = cur.rowcount
         
-        cur.execute("DELETE FROM Rent WHERE name = %s", (name.strip(),))
+        queries.execute(cur, 'delete_driver_rents', (name.strip(),))
         rentals_deleted = cur.rowcount
         
         # Delete driver
-        cur.execute("DELETE FROM Driver WHERE name = %s", (name.strip(),))
+        queries.execute(cur, 'delete_driver', (name.strip(),))
         if cur.rowcount != 1:
             conn.rollback()
             return jsonify({
@@ -347,6 +438,8 @@ def delete_driver():
             }), 400
         
         conn.commit()
+        availability_index.remove_driver(name.strip())
+        assignment.counters.remove_driver(name.strip())
         
         return jsonify({
             "message": "Driver deleted successfully",
@@ -369,82 +462,222 @@ def delete_driver():
         if cur: cur.close()
         if conn: conn.close()
 
+def delete_drivers(names, dry_run):
+    # Bulk offboarding: {"names": [...], "dry_run": true}; see offboarding.py
+    if not isinstance(names, list) or not names:
+        return jsonify({"error": "A non-empty names list is required"}), 400
+    if len(names) > offboarding.MAX_BATCH_SIZE:
+        return jsonify({"error": f"At most {offboarding.MAX_BATCH_SIZE} drivers per batch"}), 400
+
+    conn = get_connection()
+    try:
+        results = offboarding.offboard_drivers(conn, names, dry_run)
+    except Exception as e:
+        return jsonify({
+            "error": "Operation failed",
+            "details": str(e),
+            "solution": "Check database consistency"
+        }), 500
+    finally:
+        conn.close()
+
+    removable = [r for r in results if 'stats' in r]
+    if not dry_run:
+        for result in removable:
+            availability_index.remove_driver(result['name'])
+            assignment.counters.remove_driver(result['name'])
+    response = {
+        "dry_run": dry_run,
+        "deleted": 0 if dry_run else len(removable),
+        "failed": len(results) - len(removable),
+        "stats": {key: sum(r['stats'][key] for r in removable)
+                  for key in ('reviews_deleted', 'models_unlinked', 'rentals_canceled')},
+        "results": results,
+    }
+    return jsonify(response), 200 if removable else 400
+
+def with_freshness(results, as_of):
+    # Dashboards read trigger-maintained summary tables (see analytics.py);
+    # as_of is the database time the summary was read at.
+    response = jsonify(results)
+    response.headers['X-Data-As-Of'] = (as_of or datetime.now(timezone.utc)).isoformat()
+    return response
+
+
+# Upper bound for the page size of paginated manager listings
+MAX_PAGE_SIZE = 1000
+
 @app.route('/manager/top_k_clients', methods=['GET'])
+@sessions.require('manager')
 def top_k_clients():
-    k = request.args.get('k', type=int)
+    k = request.args.get('k', default=MAX_PAGE_SIZE, type=int)
+    if not 0 < k <= MAX_PAGE_SIZE:
+        return jsonify({"error": f"k must be between 1 and {MAX_PAGE_SIZE}"}), 400
     conn = get_connection()
     cur = conn.cursor()
-    cur.execute("""
-        SELECT c.name, c.email_address, COUNT(r.rent_id) AS rent_count
-        FROM Client c
-        JOIN Rent r ON c.email_address = r.client_email
-        GROUP BY c.name, c.email_address
-        ORDER BY rent_count DESC
-        LIMIT %s
-    """, (k,))
-    rows = cur.fetchall()
-    cur.close()
-    conn.close()
+    try:
+        queries.execute(cur, 'top_k_clients', (k,))
+        rows = cur.fetchall()
+    finally:
+        cur.close()
+        conn.close()
     results = [{'name': row[0], 'email': row[1], 'rent_count': row[2]} for row in rows]
-    return jsonify(results), 200
+    return with_freshness(results, rows[0][3] if rows else None), 200
 
 @app.route('/manager/model_usage', methods=['GET'])
+@sessions.require('manager')
 def model_usage():
     conn = get_connection()
     cur = conn.cursor()
-    cur.execute("""
-        SELECT m.model_id, m.color, m.construction_year, COUNT(r.rent_id) AS times_rented
-        FROM Model m
-        LEFT JOIN Rent r ON m.model_id = r.model_id
-        GROUP BY m.model_id, m.color, m.construction_year
-        ORDER BY times_rented DESC
-    """)
-    rows = cur.fetchall()
-    cur.close()
-    conn.close()
+    try:
+        queries.execute(cur, 'model_usage')
+        rows = cur.fetchall()
+    finally:
+        cur.close()
+        conn.close()
     results = [{'model_id': row[0], 'color': row[1], 'year': row[2], 'times_rented': row[3]} for row in rows]
-    return jsonify(results), 200
+    return with_freshness(results, rows[0][4] if rows else None), 200
 
 @app.route('/manager/driver_stats', methods=['GET'])
+@sessions.require('manager')
 def driver_stats():
+    city = request.args.get('city') or None
+    limit = request.args.get('limit', type=int)
+    offset = request.args.get('offset', default=0, type=int)
+    try:
+        from_date = date.fromisoformat(request.args['from_date']) if request.args.get('from_date') else None
+        to_date = date.fromisoformat(request.args['to_date']) if request.args.get('to_date') else None
+    except ValueError:
+        return jsonify({"error": "from_date and to_date must be in YYYY-MM-DD format"}), 400
+    if limit is not None and not 0 < limit <= MAX_PAGE_SIZE:
+        return jsonify({"error": f"limit must be between 1 and {MAX_PAGE_SIZE}"}), 400
+    if offset < 0:
+        return jsonify({"error": "offset must not be negative"}), 400
+
+    # With a date window Rent is aggregated over just that window; otherwise
+    # the rent count comes from the summary table (see queries.py).
     conn = get_connection()
     cur = conn.cursor()
-    cur.execute("""
-        SELECT d.name, COUNT(r.rent_id) AS total_rents, 
-               ROUND(AVG(rv.rating), 2) AS avg_rating
-        FROM Driver d
-        LEFT JOIN Rent r ON d.name = r.name
-        LEFT JOIN Review rv ON d.name = rv.name
-        GROUP BY d.name
-        ORDER BY total_rents DESC
-    """)
-    rows = cur.fetchall()
-    cur.close()
-    conn.close()
-    results = [{'name': row[0], 'total_rents': row[1], 'avg_rating': float(row[2]) if row[2] else None} for row in rows]
-    return jsonify(results), 200
+    try:
+        queries.execute(cur, 'driver_stats_window' if from_date or to_date else 'driver_stats',
+                        {'city': city, 'from_date': from_date, 'to_date': to_date, 'limit': limit, 'offset': offset})
+        rows = cur.fetchall()
+    finally:
+        cur.close()
+        conn.close()
+    results = [{'name': row[0], 'total_rents': row[1], 'avg_rating': float(row[2]) if row[2] else None,
+                'recent_avg_rating': float(row[3]) if row[3] else None} for row in rows]
+    return with_freshness(results, rows[0][4] if rows else None), 200
 
 
 @app.route('/manager/clients_by_city', methods=['GET'])
+@sessions.require('manager')
 def clients_by_city():
     c1 = request.args.get('c1')
     c2 = request.args.get('c2')
     conn = get_connection()
     cur = conn.cursor()
-    cur.execute("""
-        SELECT DISTINCT cl.name, cl.email_address
-        FROM Client cl
-        JOIN Client_Address ca ON cl.email_address = ca.client_email
-        JOIN Rent r ON cl.email_address = r.client_email
-        JOIN Driver d ON r.name = d.name
-        WHERE ca.city = %s AND d.city = %s
-    """, (c1, c2))
-    rows = cur.fetchall()
-    cur.close()
-    conn.close()
+    try:
+        queries.execute(cur, 'clients_by_city', (c1, c2))
+        rows = cur.fetchall()
+    finally:
+        cur.close()
+        conn.close()
     result = [{'name': row[0], 'email': row[1]} for row in rows]
     return jsonify(result), 200
 
+# Upper bound for each city set of /manager/clients_by_cities
+MAX_CITIES = 100
+
+def city_list(key):
+    # Accepts ?key=a,b and ?key=a&key=b
+    cities = [c.strip() for value in request.args.getlist(key) for c in value.split(',')]
+    return list(dict.fromkeys(c for c in cities if c))
+
+@app.route('/manager/clients_by_cities', methods=['GET'])
+@sessions.require('manager')
+def clients_by_cities():
+    client_cities = city_list('client_cities')
+    driver_cities = city_list('driver_cities')
+    output = request.args.get('output', 'counts')
+    limit = request.args.get('limit', default=MAX_PAGE_SIZE, type=int)
+    offset = request.args.get('offset', default=0, type=int)
+    try:
+        from_date = date.fromisoformat(request.args['from_date']) if request.args.get('from_date') else None
+        to_date = date.fromisoformat(request.args['to_date']) if request.args.get('to_date') else None
+    except ValueError:
+        return jsonify({"error": "from_date and to_date must be in YYYY-MM-DD format"}), 400
+    if not client_cities or not driver_cities:
+        return jsonify({"error": "client_cities and driver_cities are required"}), 400
+    if len(client_cities) > MAX_CITIES or len(driver_cities) > MAX_CITIES:
+        return jsonify({"error": f"At most {MAX_CITIES} cities per set"}), 400
+    if output not in ('counts', 'clients'):
+        return jsonify({"error": "output must be counts or clients"}), 400
+    if not 0 < limit <= MAX_PAGE_SIZE:
+        return jsonify({"error": f"limit must be between 1 and {MAX_PAGE_SIZE}"}), 400
+    if offset < 0:
+        return jsonify({"error": "offset must not be negative"}), 400
+
+    # Every requested pair in one grouped query; see queries.py
+    name = 'city_pair_' + output + ('_window' if from_date or to_date else '')
+    conn = get_connection()
+    cur = conn.cursor()
+    try:
+        queries.execute(cur, name, {'client_cities': client_cities, 'driver_cities': driver_cities,
+                                    'from_date': from_date, 'to_date': to_date, 'limit': limit, 'offset': offset})
+        rows = cur.fetchall()
+    finally:
+        cur.close()
+        conn.close()
+    if output == 'counts':
+        results = [{'client_city': row[0], 'driver_city': row[1], 'clients': row[2], 'rents': row[3]}
+                   for row in rows]
+        as_of = rows[0][4] if rows else None
+    else:
+        results = [{'client_city': row[0], 'driver_city': row[1], 'name': row[2], 'email': row[3],
+                    'rents': row[4]} for row in rows]
+        as_of = rows[0][5] if rows else None
+    return with_freshness(results, as_of), 200
+
+
+# Bulk loading through COPY (see bulk.py). The request body is the raw CSV
+# (with a header row) or NDJSON file; ?format= overrides the Content-Type.
+def bulk_format():
+    fmt = request.args.get('format')
+    if fmt:
+        return fmt
+    return 'ndjson' if request.mimetype in ('application/x-ndjson', 'application/json') else 'csv'
+
+
+@app.route('/manager/bulk/import/<entity>', methods=['POST'])
+@sessions.require('manager')
+def bulk_import(entity):
+    conn = get_connection()
+    try:
+        result = bulk.import_rows(conn, entity, request.stream, bulk_format(),
+                                  request.args.get('on_conflict', 'skip'))
+    except bulk.BulkError as e:
+        return jsonify({"error": str(e)}), 400
+    finally:
+        conn.close()
+
+    catalog_cache.invalidate()
+    if entity != 'clients':
+        availability_index.invalidate()
+    return jsonify(result)
+
+
+@app.route('/manager/bulk/export/<entity>', methods=['GET'])
+@sessions.require('manager')
+def bulk_export(entity):
+    fmt = request.args.get('format', 'csv')
+    try:
+        bulk.export_sql(entity, fmt)
+    except bulk.BulkError as e:
+        return jsonify({"error": str(e)}), 400
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    return stream_from_connection(get_connection(), lambda conn: bulk.export_rows(conn, entity, fmt), mimetype)
+
 
 # -------------------- Driver APIs --------------------
 
@@ -454,10 +687,10 @@ def driver_login():
     conn = get_connection()
     cur = conn.cursor()
     try:
-        cur.execute("SELECT * FROM Driver WHERE name = %s", (data['name'],))
+        queries.execute(cur, 'driver_login', (data['name'],))
         driver = cur.fetchone()
         if driver:
-            return jsonify({'message': 'Driver login successful'})
+            return jsonify({'message': 'Driver login successful', **sessions.issue('driver', driver[0])})
         else:
             return jsonify({'error': 'Invalid driver name'}), 404
     except Exception as e:
@@ -467,6 +700,7 @@ def driver_login():
         conn.close()
 
 @app.route('/driver/update_driver_address', methods=['POST'])
+@sessions.require('driver', identity='name')
 def update_driver_address():
     data = request.get_json()
     name = data.get('name')
@@ -478,25 +712,15 @@ def update_driver_address():
     cur = conn.cursor()
     try:
         # Check if the address exists
-        cur.execute("""
-            SELECT * FROM Address
-            WHERE nameofroad = %s AND number = %s AND city = %s
-        """, (new_nameofroad, new_number, new_city))
+        queries.execute(cur, 'find_address', (new_nameofroad, new_number, new_city))
         address_exists = cur.fetchone()
 
         # If not, insert the new address
         if not address_exists:
-            cur.execute("""
-                INSERT INTO Address (nameofroad, number, city)
-                VALUES (%s, %s, %s)
-            """, (new_nameofroad, new_number, new_city))
+            queries.execute(cur, 'insert_address', (new_nameofroad, new_number, new_city))
 
         # Now update the driver's address
-        cur.execute("""
-            UPDATE Driver
-            SET nameofroad = %s, number = %s, city = %s
-            WHERE name = %s
-        """, (new_nameofroad, new_number, new_city, name))
+        queries.execute(cur, 'update_driver_address', (new_nameofroad, new_number, new_city, name))
 
         if cur.rowcount == 0:
             conn.rollback()
@@ -513,11 +737,13 @@ def update_driver_address():
 
 
 @app.route('/driver/list_models', methods=['GET'])
+@sessions.require('driver')
+@catalog_cache.cached
 def list_models():
     conn = get_connection()
     cur = conn.cursor()
     try:
-        cur.execute("SELECT * FROM Model")
+        queries.execute(cur, 'list_models')
         models = cur.fetchall()
         return jsonify(models)
     except Exception as e:
@@ -527,22 +753,13 @@ def list_models():
         conn.close()
 
 @app.route('/driver/view_driver_models', methods=['GET'])
+@sessions.require('driver')
+@catalog_cache.cached
 def view_driver_models():
     conn = get_connection()
     cur = conn.cursor()
     try:
-        cur.execute("""
-            SELECT 
-                c.car_id,
-                m.model_id,
-                c.brand,
-                m.color,
-                m.construction_year,
-                m.transmission_type
-            FROM Model m
-            JOIN Car c ON m.car_id = c.car_id
-            ORDER BY c.car_id, m.model_id
-        """)
+        queries.execute(cur, 'catalog_models')
         rows = cur.fetchall()
         result = [{
             "car_id": r[0],
@@ -561,6 +778,7 @@ def view_driver_models():
 
 
 @app.route('/driver/declare_driver_model', methods=['POST'])
+@sessions.require('driver', identity='driver_name')
 def declare_driver_model():
     data = request.get_json()
     driver_name = data.get('driver_name')
@@ -570,11 +788,9 @@ def declare_driver_model():
     conn = get_connection()
     cur = conn.cursor()
     try:
-        cur.execute("""
-            INSERT INTO Driver_Model (name, model_id, car_id)
-            VALUES (%s, %s, %s)
-        """, (driver_name, model_id, car_id))
+        queries.execute(cur, 'declare_driver_model', (driver_name, model_id, car_id))
         conn.commit()
+        availability_index.declare(driver_name, model_id, car_id)
         return jsonify({"message": "Driver model declaration added successfully"})
     except Exception as e:
         conn.rollback()
@@ -586,6 +802,7 @@ def declare_driver_model():
 # -------------------- Client APIs --------------------
 
 @app.route('/client/register', methods=['POST'])
+@idempotency.idempotent
 def register_client():
     data = request.get_json()
     email_address = data.get('email_address')
@@ -594,10 +811,7 @@ def register_client():
     conn = get_connection()
     cur = conn.cursor()
     try:
-        cur.execute("""
-            INSERT INTO Client (email_address, name)
-            VALUES (%s, %s)
-        """, (email_address, name))
+        queries.execute(cur, 'register_client', (email_address, name))
         conn.commit()
         return jsonify({"message": "Client registered successfully"})
     except Exception as e:
@@ -609,9 +823,9 @@ def register_client():
 
 
 @app.route('/client/add_address', methods=['POST'])
+@sessions.require('client', identity='client_email')
 def add_client_address():
     data = request.get_json()
-    print("Received address data:", data)  # Debug logging
     
     if not data:
         return jsonify({"error": "No data provided"}), 400
@@ -627,19 +841,10 @@ def add_client_address():
         conn.autocommit = False
         
         # 1. Insert address if not exists
-        cur.execute("""
-            INSERT INTO Address (nameofroad, number, city)
-            VALUES (%s, %s, %s)
-            ON CONFLICT (nameofroad, number, city) DO NOTHING
-        """, (data['nameofroad'], data['number'], data['city']))
+        queries.execute(cur, 'ensure_address', (data['nameofroad'], data['number'], data['city']))
         
         # 2. Link to client
-        cur.execute("""
-            INSERT INTO Client_Address (client_email, nameofroad, number, city)
-            VALUES (%s, %s, %s, %s)
-            ON CONFLICT (client_email, nameofroad, number, city) DO NOTHING
-            RETURNING *
-        """, (data['client_email'], data['nameofroad'], data['number'], data['city']))
+        queries.execute(cur, 'link_client_address', (data['client_email'], data['nameofroad'], data['number'], data['city']))
         
         conn.commit()
         
@@ -660,6 +865,8 @@ def add_client_address():
         conn.close()
 
 @app.route('/client/add_creditcard', methods=['POST'])
+@sessions.require('client', identity='client_email')
+@idempotency.idempotent
 def add_credit_card():
     data = request.get_json()
     ccnum = data.get('ccnum')
@@ -672,23 +879,15 @@ def add_credit_card():
     cur = conn.cursor()
     try:
         # Check if address exists
-        cur.execute("""
-            SELECT * FROM Address WHERE nameofroad = %s AND number = %s AND city = %s
-        """, (nameofroad, number, city))
+        queries.execute(cur, 'find_address', (nameofroad, number, city))
         address = cur.fetchone()
 
         # If not, insert the address
         if not address:
-            cur.execute("""
-                INSERT INTO Address (nameofroad, number, city)
-                VALUES (%s, %s, %s)
-            """, (nameofroad, number, city))
+            queries.execute(cur, 'insert_address', (nameofroad, number, city))
 
         # Now insert the credit card linked to the address
-        cur.execute("""
-            INSERT INTO CreditCard (ccnum, client_email, nameofroad, number, city)
-            VALUES (%s, %s, %s, %s, %s)
-        """, (ccnum, client_email, nameofroad, number, city))
+        queries.execute(cur, 'add_creditcard', (ccnum, client_email, nameofroad, number, city))
 
         conn.commit()
         return jsonify({"message": "Credit card added successfully, address linked to the credit card"})
@@ -709,7 +908,7 @@ def client_login():
     conn = get_connection()
     cur = conn.cursor()
     try:
-        cur.execute("SELECT * FROM Client WHERE email_address = %s", (email_address,))
+        queries.execute(cur, 'client_login', (email_address,))
         client = cur.fetchone()
 
         if client:
@@ -717,7 +916,8 @@ def client_login():
             return jsonify({
                 'success': True,
                 'message': 'Client login successful',
-                'name': client_name
+                'name': client_name,
+                **sessions.issue('client', client[0])
             })
         else:
             return jsonify({'success': False, 'error': 'Invalid client email'}), 404
@@ -732,56 +932,149 @@ def client_login():
 
 
 @app.route('/client/view_available_models', methods=['POST'])
+@sessions.require('client')
 def view_available_models():
     data = request.get_json()
     rent_date = data.get('rent_date')  # expecting format 'YYYY-MM-DD'
     
-    conn = get_connection()
-    cur = conn.cursor()
     try:
-        cur.execute("""
-            SELECT DISTINCT m.model_id, m.car_id, c.brand, m.color, m.construction_year, m.transmission_type
-            FROM Model m
-            JOIN Car c ON m.car_id = c.car_id
-            WHERE NOT EXISTS (
-                SELECT 1
-                FROM Rent r1
-                WHERE r1.model_id = m.model_id AND r1.car_id = m.car_id
-                  AND r1.rent_date = %s
-            )
-            AND EXISTS (
-                SELECT 1
-                FROM Driver_Model dm
-                WHERE dm.model_id = m.model_id AND dm.car_id = m.car_id
-                  AND NOT EXISTS (
-                    SELECT 1
-                    FROM Rent r2
-                    WHERE r2.name = dm.name
-                      AND r2.rent_date = %s
-                  )
-            )
-        """, (rent_date, rent_date))
-        
-        rows = cur.fetchall()
-        result = []
-        for row in rows:
-            result.append({
-                "model_id": row[0],
-                "car_id": row[1],
-                "brand": row[2],
-                "color": row[3],
-                "construction_year": row[4],
-                "transmission_type": row[5]
-            })
-        return jsonify(result)
+        # Answered from the in-memory availability index (see availability.py)
+        availability_index.ensure_loaded()
+        return jsonify(availability_index.available_models(rent_date))
+    except PoolTimeout:
+        raise
     except Exception as e:
         return jsonify({"error": str(e)}), 400
-    finally:
-        cur.close()
-        conn.close()
+
+
+def stream_from_connection(conn, generate, mimetype):
+    # Streams generate(conn) and hands conn back to the pool when the stream
+    # ends. The close hook covers responses that are never iterated, whose
+    # generator would otherwise never run its cleanup.
+    #
+    # The first chunk is produced before the response is returned, so an
+    # error up to then (a failing query) still gets an error status. Once
+    # the status is sent, generators must end their output well-formed
+    # themselves (see view_client_rents).
+    released = []
+
+    def release():
+        if not released:
+            released.append(True)
+            conn.close()   # the pool rolls back the read transaction
+
+    source = generate(conn)
+    try:
+        first = next(source, None)
+    except Exception as e:
+        source.close()
+        release()
+        return jsonify({"error": str(e)}), 400
+
+    def chunks():
+        try:
+            if first is not None:
+                yield first
+            yield from source
+        finally:
+            source.close()
+            release()
+
+    response = Response(chunks(), mimetype=mimetype)
+    response.call_on_close(release)
+    return response
+
+
+# Longest window /client/available_models_range will scan in one call
+MAX_RANGE_DAYS = 366
+
+@app.route('/client/available_models_range', methods=['POST'])
+@sessions.require('client')
+def available_models_range():
+    data = request.get_json()
+    try:
+        start_date = date.fromisoformat(data.get('start_date'))
+        end_date = date.fromisoformat(data.get('end_date'))
+    except (TypeError, ValueError):
+        return jsonify({"error": "start_date and end_date are required in YYYY-MM-DD format"}), 400
+    if end_date < start_date:
+        return jsonify({"error": "end_date must not be before start_date"}), 400
+    if (end_date - start_date).days >= MAX_RANGE_DAYS:
+        return jsonify({"error": f"Date range is limited to {MAX_RANGE_DAYS} days"}), 400
+
+    params = {
+        'start_date': start_date,
+        'end_date': end_date,
+        'brand': data.get('brand') or None,
+        'transmission_type': data.get('transmission_type') or None,
+        'color': data.get('color') or None,
+    }
+
+    def generate(conn):
+        cur = conn.cursor(name='available_models_range')
+        cur.itersize = 500
+        try:
+            queries.stream(cur, 'available_models_range', params)
+
+            # Emit one JSON line per day as soon as that day's rows are complete
+            day = start_date
+            models = []
+            for row in cur:
+                while row[0] > day:
+                    yield json.dumps({"date": day.isoformat(), "models": models}) + "\n"
+                    day += timedelta(days=1)
+                    models = []
+                models.append({
+                    "model_id": row[1],
+                    "car_id": row[2],
+                    "brand": row[3],
+                    "color": row[4],
+                    "construction_year": row[5],
+                    "transmission_type": row[6],
+                    "free_drivers": row[7]
+                })
+            while day <= end_date:
+                yield json.dumps({"date": day.isoformat(), "models": models}) + "\n"
+                day += timedelta(days=1)
+                models = []
+        except Exception as e:
+            yield json.dumps({"error": str(e)}) + "\n"
+        finally:
+            cur.close()
+
+    return stream_from_connection(get_connection(), generate, 'application/x-ndjson')
+
+
+@app.route('/manager/cache_stats', methods=['GET'])
+@sessions.require('manager')
+def cache_stats():
+    return jsonify(catalog_cache.stats()), 200
+
+
+@app.route('/manager/outbox_stats', methods=['GET'])
+@sessions.require('manager')
+def outbox_stats():
+    return jsonify(outbox.dispatcher.stats()), 200
+
+@app.route('/manager/admission_stats', methods=['GET'])
+@sessions.require('manager')
+def admission_stats():
+    return jsonify(admission.controller.stats()), 200
+
+@app.route('/manager/idempotency_stats', methods=['GET'])
+@sessions.require('manager')
+def idempotency_stats():
+    return jsonify(idempotency.store.stats()), 200
+
+@app.route('/manager/availability_index', methods=['GET'])
+@sessions.require('manager')
+def availability_index_stats():
+    return jsonify(availability_index.stats()), 200
 
 
 @app.route('/client/book_rent', methods=['POST'])
+@sessions.require('client', identity='client_email')
+@idempotency.idempotent
 def book_rent():
     data = request.get_json()
     rent_date = data.get('rent_date')
@@ -789,140 +1082,274 @@ def book_rent():
     model_id = data.get('model_id')
     car_id = data.get('car_id')
     
+    try:
+        # Rank the model's drivers with the configured assignment strategy
+        availability_index.ensure_loaded()
+        assignment.counters.ensure_loaded()
+        preferred = assignment.best_drivers(availability_index, rent_date, model_id, car_id)
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+
     conn = get_connection()
-    cur = conn.cursor()
     try:
-        # Step 1: Check if model is available
-        cur.execute("""
-            SELECT 1
-            FROM Model m
-            WHERE m.model_id = %s AND m.car_id = %s
-              AND NOT EXISTS (
-                  SELECT 1 FROM Rent r
-                  WHERE r.model_id = m.model_id AND r.car_id = m.car_id
-                    AND r.rent_date = %s
-              )
-        """, (model_id, car_id, rent_date))
-        model_available = cur.fetchone()
-
-        if not model_available:
-            return jsonify({"error": "Car model is not available on selected date"}), 400
-
-        # Step 2: Find an available driver who can drive it
-        cur.execute("""
-            SELECT dm.name
-            FROM Driver_Model dm
-            WHERE dm.model_id = %s AND dm.car_id = %s
-              AND NOT EXISTS (
-                  SELECT 1 FROM Rent r
-                  WHERE r.name = dm.name
-                    AND r.rent_date = %s
-              )
-            LIMIT 1
-        """, (model_id, car_id, rent_date))
-        driver = cur.fetchone()
+        # Model check, driver pick and insert happen in a single statement
+        result = booking.book_rent(conn, rent_date, client_email, model_id, car_id, preferred)
 
-        if not driver:
-            return jsonify({"error": "No available driver for this model on selected date"}), 400
+        if not result['booked']:
+            status = 409 if result['reason'] == 'contention' else 400
+            return jsonify({"error": result['error'], "reason": result['reason']}), status
 
-        driver_name = driver[0]
+        driver_name = result['driver_name']
+        availability_index.record_rent(rent_date, driver_name, model_id, car_id)
+        assignment.counters.record_rent(driver_name, result['rent_id'], rent_date, model_id, car_id)
+        return jsonify({
+            "message": f"Rent booked successfully! Driver assigned: {driver_name}",
+            "rent_id": result['rent_id'],
+            "driver_name": driver_name
+        })
 
-        # Step 3: Insert rent
-        cur.execute("""
-            INSERT INTO Rent (rent_date, client_email, name, model_id, car_id)
-            VALUES (%s, %s, %s, %s, %s)
-        """, (rent_date, client_email, driver_name, model_id, car_id))
+    except Exception as e:
+        conn.rollback()
+        return jsonify({"error": str(e)}), 400
+    finally:
+        conn.close()
 
-        conn.commit()
-        return jsonify({"message": f"Rent booked successfully! Driver assigned: {driver_name}"})
+
+@app.route('/client/book_rents_batch', methods=['POST'])
+@sessions.require('client', identity='client_email')
+@idempotency.idempotent
+def book_rents_batch():
+    data = request.get_json()
+    client_email = data.get('client_email')
+    rents = data.get('rents')
+    mode = data.get('mode', 'all_or_nothing')
+
+    if not client_email or not isinstance(rents, list) or not rents:
+        return jsonify({"error": "client_email and a non-empty rents list are required"}), 400
+    if len(rents) > booking.MAX_BATCH_SIZE:
+        return jsonify({"error": f"At most {booking.MAX_BATCH_SIZE} rents per batch"}), 400
+    if mode not in ('all_or_nothing', 'best_effort'):
+        return jsonify({"error": "mode must be 'all_or_nothing' or 'best_effort'"}), 400
+
+    assignment.counters.ensure_loaded()
+    conn = get_connection()
+    try:
+        results = booking.book_batch(conn, client_email, rents, all_or_nothing=(mode == 'all_or_nothing'),
+                                     rank=assignment.rank_drivers)
+
+        for rent, result in zip(rents, results):
+            if result['booked']:
+                availability_index.record_rent(rent['rent_date'], result['driver_name'], rent['model_id'], rent['car_id'])
+                assignment.counters.record_rent(result['driver_name'], result['rent_id'], rent['rent_date'],
+                                                rent['model_id'], rent['car_id'])
+
+        booked = sum(1 for r in results if r['booked'])
+        response = {
+            "mode": mode,
+            "booked": booked,
+            "failed": len(results) - booked,
+            "results": results
+        }
+        if booked:
+            return jsonify(response)
+        if any(r['reason'] == 'contention' for r in results):
+            return jsonify(response), 409
+        return jsonify(response), 400
 
     except Exception as e:
         conn.rollback()
         return jsonify({"error": str(e)}), 400
     finally:
-        cur.close()
         conn.close()
 
 
+# Default and maximum page size for keyset-paginated /client/view_rents
+RENTS_PAGE_SIZE = 50
+MAX_RENTS_PAGE_SIZE = 500
+RENTS_STREAM_BATCH = 500     # rows per fetch when streaming a full history
+
+RENT_HISTORY_SQL = """
+    SELECT r.rent_id, r.rent_date, r.name AS driver_name,
+           c.brand, m.model_id, m.color, m.construction_year, m.transmission_type
+    FROM Rent r
+    JOIN Model m ON r.model_id = m.model_id AND r.car_id = m.car_id
+    JOIN Car c ON m.car_id = c.car_id
+    WHERE r.client_email = %(client_email)s
+      AND (%(after_date)s::date IS NULL OR (r.rent_date, r.rent_id) < (%(after_date)s, %(after_id)s))
+    ORDER BY r.rent_date DESC, r.rent_id DESC
+    LIMIT %(limit)s
+"""
+queries.register('rent_history', RENT_HISTORY_SQL)
+
+
+def rent_to_dict(row):
+    return {
+        "rent_id": row[0],
+        "rent_date": row[1].strftime("%Y-%m-%d"),
+        "driver_name": row[2],
+        "brand": row[3],
+        "model_id": row[4],
+        "color": row[5],
+        "construction_year": row[6],
+        "transmission_type": row[7]
+    }
+
+def encode_rent_cursor(rent_date, rent_id):
+    return base64.urlsafe_b64encode(f"{rent_date.isoformat()}|{rent_id}".encode()).decode()
+
+def decode_rent_cursor(cursor):
+    rent_date, rent_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+    return date.fromisoformat(rent_date), int(rent_id)
+
+
 @app.route('/client/view_rents', methods=['POST'])
+@sessions.require('client', identity='client_email')
 def view_client_rents():
     data = request.get_json()
     client_email = data.get('client_email')
+    params = {'client_email': client_email, 'after_date': None, 'after_id': None, 'limit': None}
+
+    # Paginated mode: one keyset page on (rent_date, rent_id) plus the cursor
+    # for the next one.
+    if 'limit' in data or 'cursor' in data:
+        try:
+            params['limit'] = int(data.get('limit') or RENTS_PAGE_SIZE)
+            if data.get('cursor'):
+                params['after_date'], params['after_id'] = decode_rent_cursor(data['cursor'])
+        except (TypeError, ValueError):
+            return jsonify({"error": "Invalid limit or cursor"}), 400
+        if not 0 < params['limit'] <= MAX_RENTS_PAGE_SIZE:
+            return jsonify({"error": f"limit must be between 1 and {MAX_RENTS_PAGE_SIZE}"}), 400
+
+        conn = get_connection()
+        cur = conn.cursor()
+        try:
+            queries.execute(cur, 'rent_history', params)
+            rows = cur.fetchall()
+            next_cursor = None
+            if len(rows) == params['limit']:
+                next_cursor = encode_rent_cursor(rows[-1][1], rows[-1][0])
+            return jsonify({"rents": [rent_to_dict(row) for row in rows], "next_cursor": next_cursor})
+        except Exception as e:
+            return jsonify({"error": str(e)}), 400
+        finally:
+            cur.close()
+            conn.close()
+
+    # Full history: stream the JSON array from a server-side cursor so memory
+    # stays flat however long the history is. The first page is fetched
+    # before anything is sent, so a failing query still answers 400; a
+    # failure after that ends the array with an {"error": ...} element
+    # rather than cutting the JSON short.
+    def generate(conn):
+        cur = conn.cursor(name='view_client_rents')
+        try:
+            queries.stream(cur, 'rent_history', params)
+            rows = cur.fetchmany(RENTS_STREAM_BATCH)
+            yield "["
+            separator = ""
+            try:
+                while rows:
+                    for row in rows:
+                        yield separator + json.dumps(rent_to_dict(row))
+                        separator = ","
+                    rows = cur.fetchmany(RENTS_STREAM_BATCH)
+            except Exception as e:
+                yield separator + json.dumps({"error": str(e)})
+            yield "]"
+        finally:
+            try:
+                cur.close()
+            except Exception:
+                pass   # the connection failed mid-stream; the pool discards it
+
+    return stream_from_connection(get_connection(), generate, 'application/json')
+
+
+@app.route('/client/add_review', methods=['POST'])
+@sessions.require('client', identity='client_email')
+@idempotency.idempotent
+def add_review():
+    data = request.get_json()
+    review = {
+        'client_email': data.get('client_email'),
+        'driver_name': data.get('driver_name'),
+        'message': data.get('message'),
+        'rating': data.get('rating'),
+    }
 
     conn = get_connection()
-    cur = conn.cursor()
     try:
-        cur.execute("""
-            SELECT r.rent_id, r.rent_date, r.name AS driver_name,
-                   c.brand, m.model_id, m.color, m.construction_year, m.transmission_type
-            FROM Rent r
-            JOIN Model m ON r.model_id = m.model_id AND r.car_id = m.car_id
-            JOIN Car c ON m.car_id = c.car_id
-            WHERE r.client_email = %s
-            ORDER BY r.rent_date DESC
-        """, (client_email,))
-        
-        rents = cur.fetchall()
-        result = []
-        for row in rents:
-            result.append({
-                "rent_id": row[0],
-                "rent_date": row[1].strftime("%Y-%m-%d"),
-                "driver_name": row[2],
-                "brand": row[3],
-                "model_id": row[4],
-                "color": row[5],
-                "construction_year": row[6],
-                "transmission_type": row[7]
-            })
-        return jsonify(result)
+        # Eligibility check and insert are one statement (see reviews.py)
+        result = reviews.add_reviews(conn, [review])[0]
+        if not result['added']:
+            return jsonify({"error": result['error']}), 400
+        assignment.counters.record_review(result['driver_name'], result['rating'])
+        return jsonify({"message": "Review added successfully"})
     except Exception as e:
         return jsonify({"error": str(e)}), 400
     finally:
-        cur.close()
         conn.close()
 
 
-@app.route('/client/add_review', methods=['POST'])
-def add_review():
+@app.route('/client/add_reviews_batch', methods=['POST'])
+@sessions.require('client', identity='client_email')
+@idempotency.idempotent
+def add_reviews_batch():
     data = request.get_json()
-    client_email = data.get('client_email')
-    driver_name = data.get('driver_name')
-    message = data.get('message')
-    rating = data.get('rating')
+    items = data.get('reviews')
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "A non-empty reviews list is required"}), 400
+    if len(items) > reviews.MAX_BATCH_SIZE:
+        return jsonify({"error": f"At most {reviews.MAX_BATCH_SIZE} reviews per batch"}), 400
+    # A top-level client_email applies to every review that does not name one
+    if data.get('client_email'):
+        items = [dict({'client_email': data['client_email']}, **item) if isinstance(item, dict) else item
+                 for item in items]
+    session = sessions.current()
+    if session:
+        items = [dict({'client_email': session['sub']}, **item) if isinstance(item, dict) else item
+                 for item in items]
+        if any(isinstance(item, dict) and item['client_email'] != session['sub'] for item in items):
+            return jsonify({"error": "Every review must be by the logged in client"}), 403
 
     conn = get_connection()
-    cur = conn.cursor()
     try:
-        # Step 1: Check if client rented this driver before
-        cur.execute("""
-            SELECT 1
-            FROM Rent
-            WHERE client_email = %s
-              AND name = %s
-            LIMIT 1
-        """, (client_email, driver_name))
-        rent_exists = cur.fetchone()
-
-        if not rent_exists:
-            return jsonify({"error": "You cannot review this driver. No previous rent found."}), 400
-
-        # Step 2: Insert review
-        cur.execute("""
-            INSERT INTO Review (name, client_email, message, rating)
-            VALUES (%s, %s, %s, %s)
-        """, (driver_name, client_email, message, rating))
-
-        conn.commit()
-        return jsonify({"message": "Review added successfully"})
+        results = reviews.add_reviews(conn, items)
     except Exception as e:
-        conn.rollback()
         return jsonify({"error": str(e)}), 400
     finally:
-        cur.close()
+        conn.close()
+
+    for result in results:
+        if result['added']:
+            assignment.counters.record_review(result['driver_name'], result['rating'])
+    added = sum(1 for r in results if r['added'])
+    response = {"added": added, "failed": len(results) - added, "results": results}
+    return jsonify(response), 200 if added else 400
+
+
+def install_schema():
+    # Apply pending schema migrations (tables, booking constraints, dashboard
+    # summaries, indexes); see schema.py.
+    conn = get_connection()
+    try:
+        schema.migrate(conn)
+    except Exception as e:
+        print("⚠️ Could not install database objects:", e)
+    finally:
         conn.close()
 
 
 if __name__ == '__main__':
+    install_schema()
+    outbox.dispatcher.ensure_started()
+    try:
+        availability_index.rebuild()
+        assignment.counters.rebuild()
+    except Exception as e:
+        print("⚠️ Could not build in-memory indexes:", e)
+    # Development server only; use serve.py in production. Set TAXI_DEBUG=1
+    # for the Werkzeug debugger and reloader.
     print("✅ Server is running fine at http://127.0.0.1:5050 🚀")
-    app.run(debug=True, port=5050)
+    app.run(debug=os.environ.get('TAXI_DEBUG') == '1', port=5050)
@@ -0,0 +1,506 @@
+# asgi.py
+#
+# Async serving mode. The high-concurrency client paths (availability,
+# booking, rent history) and the logins run as async handlers on an asyncpg
+# connection pool, so a single process can keep hundreds of them in flight
+# while they wait on Postgres. Every other route falls through to the Flask
+# app from app.py, mounted underneath, so the API surface is identical. The
+# async handlers bypass Flask's hooks, so each one is wrapped in the async
+# counterparts of admission, metrics and request_log (and idempotency for
+# writes).
+#
+#   uvicorn asgi:app --port 5050
+#
+# Needs the optional packages listed in requirements.txt (asyncpg, starlette,
+# a2wsgi, uvicorn).
+
+import asyncio
+import contextlib
+import functools
+import json
+import time
+
+import asyncpg
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.background import BackgroundTask, BackgroundTasks
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Mount, Route
+
+import admission
+import assignment
+import booking
+import idempotency
+import metrics
+import outbox
+import request_log
+import sessions
+from app import (app as flask_app, INVALID_JSON, RENT_HISTORY_SQL, RENTS_PAGE_SIZE, MAX_RENTS_PAGE_SIZE,
+                 RENTS_STREAM_BATCH, rent_to_dict, encode_rent_cursor, decode_rent_cursor)
+from availability import index as availability_index, to_date
+from database import DB_CONFIG, POOL_MIN_SIZE, POOL_MAX_SIZE, POOL_TIMEOUT
+from queries import to_numbered
+
+# asyncpg takes $n parameters and keeps its own per-connection cache of
+# prepared statements, so the shared SQL only needs its placeholders converted
+BOOK_RENT_SQL, BOOK_RENT_PARAMS = to_numbered(booking.BOOK_RENT_SQL)
+RENT_HISTORY, RENT_HISTORY_PARAMS = to_numbered(RENT_HISTORY_SQL)
+
+RETRYABLE_ERRORS = (
+    asyncpg.exceptions.SerializationError,
+    asyncpg.exceptions.DeadlockDetectedError,
+    asyncpg.exceptions.UniqueViolationError,
+)
+
+pool = None
+
+
+class Busy(Exception):
+    pass
+
+
+async def acquire():
+    started = time.perf_counter()
+    try:
+        return await pool.acquire(timeout=POOL_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise Busy(f"No database connection available within {POOL_TIMEOUT:.1f}s")
+    finally:
+        metrics.checkout_listener(time.perf_counter() - started)
+
+
+def busy_response(e):
+    return JSONResponse({"error": "Service busy, please retry", "details": str(e)}, 503,
+                        headers={'Retry-After': '1'})
+
+
+async def json_body(request):
+    # The request's JSON object, or None if the body is empty, malformed or
+    # not an object; answer that with invalid_json()
+    try:
+        data = await request.json()
+    except ValueError:   # json.JSONDecodeError and UnicodeDecodeError included
+        return None
+    return data if isinstance(data, dict) else None
+
+
+def invalid_json():
+    return JSONResponse({"error": INVALID_JSON}, 400)
+
+
+def session_error(request, role, identity=None, data=None):
+    # The async counterpart of sessions.require; None if the request may proceed
+    claims, error = sessions.authorize(role, sessions.bearer_token(request.headers), identity, data,
+                                       request.query_params)
+    if error:
+        return JSONResponse({'error': error[0]}, error[1],
+                            headers={'WWW-Authenticate': 'Bearer'} if error[1] == 401 else None)
+    return None
+
+
+def admitted(route_class):
+    """The async counterpart of admission.install, for a handler of route_class."""
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(request):
+            if not admission.ADMISSION:
+                return await handler(request)
+            controller = admission.controller
+            who = admission.identity(request.headers, request.client.host if request.client else None)
+            gate = controller.async_gates[route_class]
+            try:
+                if controller.shared is None:
+                    controller.check_rate(route_class, request.url.path, who)
+                else:
+                    await run_in_threadpool(controller.check_rate, route_class, request.url.path, who)
+                await gate.enter()
+            except admission.Rejected as e:
+                return JSONResponse({'error': str(e)}, e.status, headers=e.headers())
+            try:
+                response = await handler(request)
+            except BaseException:
+                gate.leave()
+                raise
+            if isinstance(response, StreamingResponse):
+                # Hold the slot until the last byte is sent
+                tasks = BackgroundTasks([response.background] if response.background else [])
+                tasks.add_task(gate.leave)
+                response.background = tasks
+            else:
+                gate.leave()
+            return response
+        return wrapper
+    return decorator
+
+
+def idempotent(handler):
+    # The async counterpart of idempotency.idempotent. The shared tier talks
+    # to Postgres through psycopg2, so it runs in the thread pool.
+    async def call(method, *args):
+        if idempotency.store.shared is None:
+            return method(*args)
+        return await run_in_threadpool(method, *args)
+
+    @functools.wraps(handler)
+    async def wrapper(request):
+        key = request.headers.get(idempotency.HEADER)
+        if not key:
+            return await handler(request)
+        if len(key) > idempotency.MAX_KEY_LENGTH:
+            return JSONResponse({'error': f"{idempotency.HEADER} must be at most "
+                                          f"{idempotency.MAX_KEY_LENGTH} characters"}, 400)
+        try:
+            subject = sessions.verify(sessions.bearer_token(request.headers) or '')['sub']
+        except sessions.SessionError:
+            subject = None   # the handler answers for the token
+        path = request.url.path
+        key = idempotency.scope_key(key, path, subject)
+        req_hash = idempotency.request_hash(request.method, path, await request.body())
+        outcome, entry = await call(idempotency.store.begin, key, req_hash)
+        if outcome == 'replay':
+            return Response(entry.body, entry.status, headers={'Idempotent-Replayed': 'true'},
+                            media_type=entry.mimetype)
+        if outcome in idempotency.OUTCOME_ERRORS:
+            status, message = idempotency.OUTCOME_ERRORS[outcome]
+            return JSONResponse({'error': message}, status,
+                                headers={'Retry-After': '1'} if outcome == 'in_progress' else None)
+
+        try:
+            response = await handler(request)
+        except BaseException:
+            await call(idempotency.store.abandon, key)
+            raise
+        await call(idempotency.store.finish, key, req_hash, response.status_code, response.body,
+                   response.media_type)
+        return response
+
+    return wrapper
+
+
+def instrumented(handler):
+    """The async counterpart of metrics.install and request_log.install."""
+    @functools.wraps(handler)
+    async def wrapper(request):
+        started = (time.time(), time.perf_counter())
+        timer = metrics.start_request(request.url.path, request.method)
+        try:
+            response = await handler(request)
+        except BaseException:
+            metrics.finish_request(timer, 500)
+            raise
+        status = response.status_code
+        if request_log.LOG_PATH:
+            try:
+                body = await request.json()
+            except ValueError:
+                body = None
+            captured = None
+            if (not isinstance(response, StreamingResponse) and response.media_type == 'application/json'
+                    and len(response.body) <= request_log.MAX_BODY):
+                captured = json.loads(response.body)
+            request_log.record(started, request.method, request.url.path, request.url.query, body, status,
+                               captured)
+        # Like Flask's call_on_close: the request is finished once the last byte is sent
+        tasks = BackgroundTasks([response.background] if response.background else [])
+        tasks.add_task(metrics.finish_request, timer, status)
+        response.background = tasks
+        return response
+    return wrapper
+
+
+# -------------------- Manager / Driver / Client logins --------------------
+
+@instrumented
+@admitted('read')
+async def login_manager(request):
+    data = await json_body(request)
+    if data is None:
+        return invalid_json()
+    try:
+        conn = await acquire()
+        try:
+            manager = await conn.fetchrow("SELECT * FROM Manager WHERE ssn = $1", data['ssn'])
+        finally:
+            await pool.release(conn)
+        if manager:
+            return JSONResponse({
+                'success': True,
+                'message': 'Manager login successful',
+                'name': manager[1],
+                'ssn': manager[0],
+                **sessions.issue('manager', sessions.subject_id(manager[0]))
+            })
+        return JSONResponse({'success': False, 'error': 'Invalid SSN'}, 404)
+    except Busy as e:
+        return busy_response(e)
+    except Exception as e:
+        return JSONResponse({'success': False, 'error': str(e)}, 400)
+
+
+@instrumented
+@admitted('read')
+async def driver_login(request):
+    data = await json_body(request)
+    if data is None:
+        return invalid_json()
+    try:
+        conn = await acquire()
+        try:
+            driver = await conn.fetchrow("SELECT * FROM Driver WHERE name = $1", data['name'])
+        finally:
+            await pool.release(conn)
+        if driver:
+            return JSONResponse({'message': 'Driver login successful', **sessions.issue('driver', driver[0])})
+        return JSONResponse({'error': 'Invalid driver name'}, 404)
+    except Busy as e:
+        return busy_response(e)
+    except Exception as e:
+        return JSONResponse({'error': str(e)}, 400)
+
+
+@instrumented
+@admitted('read')
+async def client_login(request):
+    data = await json_body(request)
+    if data is None:
+        return invalid_json()
+    try:
+        conn = await acquire()
+        try:
+            client = await conn.fetchrow("SELECT * FROM Client WHERE email_address = $1", data.get('email_address'))
+        finally:
+            await pool.release(conn)
+        if client:
+            return JSONResponse({
+                'success': True,
+                'message': 'Client login successful',
+                'name': client[1],
+                **sessions.issue('client', client[0])
+            })
+        return JSONResponse({'success': False, 'error': 'Invalid client email'}, 404)
+    except Busy as e:
+        return busy_response(e)
+    except Exception as e:
+        return JSONResponse({'success': False, 'error': str(e)}, 400)
+
+
+# -------------------- Availability and booking --------------------
+
+@instrumented
+@admitted('read')
+async def view_available_models(request):
+    data = await json_body(request)
+    if data is None:
+        return invalid_json()
+    denied = session_error(request, 'client')
+    if denied:
+        return denied
+    try:
+        # ensure_loaded() also rebuilds an index older than MAX_AGE
+        if availability_index.stale():
+            await run_in_threadpool(availability_index.ensure_loaded)
+        return JSONResponse(availability_index.available_models(data.get('rent_date')))
+    except Exception as e:
+        return JSONResponse({"error": str(e)}, 400)
+
+
+async def book_rent_async(conn, params):
+    # Same statement and retry rules as booking.book_rent
+    args = [params[name] for name in BOOK_RENT_PARAMS]
+    for attempt in range(1, booking.MAX_ATTEMPTS + 1):
+        try:
+            async with conn.transaction():
+                row = await conn.fetchrow(BOOK_RENT_SQL, *args)
+            result = booking.booking_outcome(*row, attempt)
+        except RETRYABLE_ERRORS:
+            result = None
+        if result is not None:
+            return result
+        await asyncio.sleep(booking.backoff_delay(attempt))
+    return booking.contention_result(booking.MAX_ATTEMPTS)
+
+
+@instrumented
+@admitted('write')
+@idempotent
+async def book_rent(request):
+    data = await json_body(request)
+    if data is None:
+        return invalid_json()
+    denied = session_error(request, 'client', 'client_email', data)
+    if denied:
+        return denied
+    try:
+        params = {
+            'rent_date': to_date(data.get('rent_date')),
+            'client_email': data.get('client_email'),
+            'model_id': int(data.get('model_id')),
+            'car_id': int(data.get('car_id')),
+        }
+        if not (availability_index.loaded and assignment.counters.loaded):
+            await run_in_threadpool(availability_index.ensure_loaded)
+            await run_in_threadpool(assignment.counters.ensure_loaded)
+        params['preferred_drivers'] = assignment.best_drivers(
+            availability_index, params['rent_date'], params['model_id'], params['car_id'])
+    except (TypeError, ValueError) as e:
+        return JSONResponse({"error": str(e)}, 400)
+
+    try:
+        conn = await acquire()
+        try:
+            result = await book_rent_async(conn, params)
+        finally:
+            await pool.release(conn)
+    except Busy as e:
+        return busy_response(e)
+    except Exception as e:
+        return JSONResponse({"error": str(e)}, 400)
+
+    if not result['booked']:
+        status = 409 if result['reason'] == 'contention' else 400
+        return JSONResponse({"error": result['error'], "reason": result['reason']}, status)
+
+    driver_name = result['driver_name']
+    availability_index.record_rent(params['rent_date'], driver_name, params['model_id'], params['car_id'])
+    assignment.counters.record_rent(driver_name, result['rent_id'], params['rent_date'],
+                                    params['model_id'], params['car_id'])
+    return JSONResponse({
+        "message": f"Rent booked successfully! Driver assigned: {driver_name}",
+        "rent_id": result['rent_id'],
+        "driver_name": driver_name
+    })
+
+
+# -------------------- Rent history --------------------
+
+@instrumented
+@admitted('read')
+async def view_client_rents(request):
+    data = await json_body(request)
+    if data is None:
+        return invalid_json()
+    denied = session_error(request, 'client', 'client_email', data)
+    if denied:
+        return denied
+    params = {'client_email': data.get('client_email'), 'after_date': None, 'after_id': None, 'limit': None}
+
+    if 'limit' in data or 'cursor' in data:
+        try:
+            params['limit'] = int(data.get('limit') or RENTS_PAGE_SIZE)
+            if data.get('cursor'):
+                params['after_date'], params['after_id'] = decode_rent_cursor(data['cursor'])
+        except (TypeError, ValueError):
+            return JSONResponse({"error": "Invalid limit or cursor"}, 400)
+        if not 0 < params['limit'] <= MAX_RENTS_PAGE_SIZE:
+            return JSONResponse({"error": f"limit must be between 1 and {MAX_RENTS_PAGE_SIZE}"}, 400)
+        try:
+            conn = await acquire()
+            try:
+                rows = await conn.fetch(RENT_HISTORY, *[params[name] for name in RENT_HISTORY_PARAMS])
+            finally:
+                await pool.release(conn)
+        except Busy as e:
+            return busy_response(e)
+        except Exception as e:
+            return JSONResponse({"error": str(e)}, 400)
+        next_cursor = None
+        if len(rows) == params['limit']:
+            next_cursor = encode_rent_cursor(rows[-1][1], rows[-1][0])
+        return JSONResponse({"rents": [rent_to_dict(row) for row in rows], "next_cursor": next_cursor})
+
+    # Full history, streamed from a server-side cursor. As in app.py, the
+    # first page is fetched before the response starts, and a later failure
+    # ends the array with an {"error": ...} element.
+    try:
+        conn = await acquire()
+    except Busy as e:
+        return busy_response(e)
+    released = []
+
+    async def release():
+        if not released:
+            released.append(True)
+            try:
+                if conn.is_in_transaction():
+                    await conn.execute("ROLLBACK")
+            except Exception:
+                pass   # a broken connection is discarded by the pool
+            await pool.release(conn)
+
+    try:
+        await conn.execute("BEGIN READ ONLY")
+        cursor = await conn.cursor(RENT_HISTORY, *[params[name] for name in RENT_HISTORY_PARAMS])
+        first = await cursor.fetch(RENTS_STREAM_BATCH)
+    except Exception as e:
+        await release()
+        return JSONResponse({"error": str(e)}, 400)
+
+    async def generate():
+        rows = first
+        try:
+            yield "["
+            separator = ""
+            try:
+                while rows:
+                    for row in rows:
+                        yield separator + json.dumps(rent_to_dict(row))
+                        separator = ","
+                    rows = await cursor.fetch(RENTS_STREAM_BATCH)
+            except Exception as e:
+                yield separator + json.dumps({"error": str(e)})
+            yield "]"
+        finally:
+            await release()
+
+    return StreamingResponse(generate(), media_type='application/json', background=BackgroundTask(release))
+
+
+# -------------------- Application --------------------
+
+async def init_connection(conn):
+    # Statement timings go to the same per-route metrics as psycopg2's
+    conn.add_query_logger(metrics.query_logger)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    global pool
+    pool = await asyncpg.create_pool(
+        database=DB_CONFIG['dbname'], user=DB_CONFIG['user'], password=DB_CONFIG['password'],
+        host=DB_CONFIG['host'], port=DB_CONFIG['port'],
+        min_size=POOL_MIN_SIZE, max_size=POOL_MAX_SIZE,
+        init=init_connection,
+    )
+    # The dispatcher takes its start position before the rebuild, see outbox.py
+    await run_in_threadpool(outbox.dispatcher.ensure_started)
+    try:
+        await run_in_threadpool(availability_index.rebuild)
+        await run_in_threadpool(assignment.counters.rebuild)
+    except Exception as e:
+        print("⚠️ Could not build in-memory indexes:", e)
+    try:
+        yield
+    finally:
+        await pool.close()
+
+
+app = Starlette(
+    routes=[
+        Route('/manager/login', login_manager, methods=['POST']),
+        Route('/driver/login', driver_login, methods=['POST']),
+        Route('/client/login', client_login, methods=['POST']),
+        Route('/client/view_available_models', view_available_models, methods=['POST']),
+        Route('/client/book_rent', book_rent, methods=['POST']),
+        Route('/client/view_rents', view_client_rents, methods=['POST']),
+        # Everything else is served by the synchronous Flask handlers
+        Mount('/', app=WSGIMiddleware(flask_app)),
+    ],
+    middleware=[
+        Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*'],
+                   expose_headers=['X-Data-As-Of', 'Retry-After', 'ETag', 'Idempotent-Replayed']),
+    ],
+    lifespan=lifespan,
+)
@@ -0,0 +1,292 @@
+# assignment.py
+
+import heapq
+import os
+import threading
+from bisect import bisect_right
+
+from availability import to_date
+from database import get_connection
+
+DEFAULT_STRATEGY = os.environ.get('TAXI_ASSIGNMENT_STRATEGY', 'least_recent')
+# How many free drivers, best first, a booking passes to BOOK_RENT_SQL. If a
+# concurrent booking takes them all, the statement falls back to the model's
+# other free drivers, alphabetically.
+CANDIDATES = int(os.environ.get('TAXI_ASSIGNMENT_CANDIDATES', '8'))
+
+# Rating used for drivers nobody has reviewed yet, so new drivers are neither
+# starved nor preferred by the highest_rated strategy.
+NEUTRAL_RATING = 3.0
+
+
+def week_of(rent_date):
+    iso = to_date(rent_date).isocalendar()
+    return (iso[0], iso[1])
+
+
+class DriverCounters:
+    """Per-driver counters the strategies rank by, kept up to date on write.
+
+    For each model and strategy that has been booked, the model's capable
+    drivers are also kept ordered (see _Ranking and _Rotation), so a booking
+    finds its best free drivers without sorting all k of them: an update
+    pushes the driver's new key into the orderings they belong to, in
+    O(log k) each.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.loaded = False
+        self._reset()
+
+    def _reset(self):
+        self.last_rent_id = {}     # driver -> rent_id of their latest booking
+        self.week_rents = {}       # (driver, (iso year, iso week)) -> rents that week
+        self.rating_sum = {}       # driver -> sum of review ratings
+        self.rating_count = {}     # driver -> number of reviews
+        self.round_robin = {}      # (model_id, car_id) -> driver assigned last
+        self._orderings = {}       # (strategy, model key, week or None) -> _Ranking or _Rotation
+        self._memberships = {}     # driver -> [(strategy, _Ranking)] they are ordered in
+        self._generation = None    # availability index generation the orderings were built from
+
+    def rebuild(self):
+        with self._lock:
+            conn = get_connection()
+            cur = conn.cursor()
+            try:
+                cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY")
+                cur.execute("SELECT name, MAX(rent_id) FROM Rent GROUP BY name")
+                last_rents = cur.fetchall()
+                cur.execute("""
+                    SELECT name, rent_date, COUNT(*)
+                    FROM Rent
+                    WHERE rent_date >= date_trunc('week', CURRENT_DATE)
+                    GROUP BY name, rent_date
+                """)
+                upcoming = cur.fetchall()
+                # Rating totals come from the summary kept by analytics.py, not a Review scan
+                cur.execute("SELECT name, rating_sum, rating_count FROM driver_rent_stats WHERE rating_count > 0")
+                ratings = cur.fetchall()
+                conn.commit()
+            finally:
+                cur.close()
+                conn.close()
+
+            self._reset()
+            for name, rent_id in last_rents:
+                self.last_rent_id[name] = rent_id
+            for name, rent_date, count in upcoming:
+                key = (name, week_of(rent_date))
+                self.week_rents[key] = self.week_rents.get(key, 0) + count
+            for name, total, count in ratings:
+                self.rating_sum[name] = total or 0
+                self.rating_count[name] = count
+            self.loaded = True
+
+    def ensure_loaded(self):
+        if not self.loaded:
+            with self._lock:
+                if not self.loaded:
+                    self.rebuild()
+
+    def record_rent(self, name, rent_id, rent_date, model_id, car_id):
+        with self._lock:
+            if not self.loaded:
+                return
+            self.last_rent_id[name] = max(rent_id, self.last_rent_id.get(name, 0))
+            key = (name, week_of(rent_date))
+            self.week_rents[key] = self.week_rents.get(key, 0) + 1
+            self.round_robin[(int(model_id), int(car_id))] = name
+            self._touch(name, ('least_recent', 'fewest_week'))
+
+    def record_review(self, name, rating):
+        with self._lock:
+            if not self.loaded or rating is None:
+                return
+            self.rating_sum[name] = self.rating_sum.get(name, 0) + int(rating)
+            self.rating_count[name] = self.rating_count.get(name, 0) + 1
+            self._touch(name, ('highest_rated',))
+
+    def remove_driver(self, name):
+        with self._lock:
+            self.last_rent_id.pop(name, None)
+            self.rating_sum.pop(name, None)
+            self.rating_count.pop(name, None)
+            for key in [key for key in self.week_rents if key[0] == name]:
+                del self.week_rents[key]
+            self._orderings.clear()
+            self._memberships.clear()
+
+    def average_rating(self, name):
+        count = self.rating_count.get(name)
+        if not count:
+            return NEUTRAL_RATING
+        return self.rating_sum[name] / count
+
+    def ordering(self, index, strategy, model_key, week):
+        """The ordering of model_key's capable drivers for strategy, built on first use.
+
+        Caller holds the lock. All orderings are dropped when the index's
+        capabilities change.
+        """
+        if self._generation != index.generation:
+            self._orderings.clear()
+            self._memberships.clear()
+            self._generation = index.generation
+        if strategy != 'fewest_week':
+            week = None
+        ordering = self._orderings.get((strategy, model_key, week))
+        if ordering is None:
+            drivers = index.capable_drivers(*model_key)
+            if strategy in ('first', 'round_robin'):
+                ordering = _Rotation(drivers)
+            else:
+                ordering = _Ranking(KEYS[strategy](self, week), drivers)
+                for name in drivers:
+                    self._memberships.setdefault(name, []).append((strategy, ordering))
+            self._orderings[(strategy, model_key, week)] = ordering
+        return ordering
+
+    def _touch(self, name, strategies):
+        # The driver's key changed for these strategies: reposition them
+        for strategy, ranking in self._memberships.get(name, ()):
+            if strategy in strategies:
+                ranking.push(name)
+
+
+class _Ranking:
+    """A model's capable drivers in a min-heap of (key, name).
+
+    A driver whose key changes is pushed again instead of being moved;
+    entries whose key is no longer the driver's current one are dropped
+    when they reach the top.
+    """
+
+    def __init__(self, key, drivers):
+        self.key = key
+        self.drivers = drivers
+        self._heapify()
+
+    def _heapify(self):
+        self.heap = [(self.key(name), name) for name in self.drivers]
+        heapq.heapify(self.heap)
+
+    def push(self, name):
+        heapq.heappush(self.heap, (self.key(name), name))
+        if len(self.heap) > 2 * len(self.drivers) + 16:
+            self._heapify()   # shed the outdated entries
+
+    def take(self, is_free, limit):
+        """Up to limit free drivers, best first."""
+        taken = []
+        kept = []
+        seen = set()
+        while self.heap and len(taken) < limit:
+            entry = heapq.heappop(self.heap)
+            key, name = entry
+            if name in seen or key != self.key(name):
+                continue   # a duplicate or outdated entry
+            seen.add(name)
+            kept.append(entry)
+            if is_free(name):
+                taken.append(name)
+        for entry in kept:
+            heapq.heappush(self.heap, entry)
+        return taken
+
+
+class _Rotation:
+    """A model's capable drivers in name order, for first and round_robin."""
+
+    def __init__(self, drivers):
+        self.drivers = sorted(drivers)
+
+    def take(self, is_free, limit, after=None):
+        """Up to limit free drivers in name order, starting just after after."""
+        start = bisect_right(self.drivers, after) if after is not None else 0
+        taken = []
+        for i in range(len(self.drivers)):
+            name = self.drivers[(start + i) % len(self.drivers)]
+            if is_free(name):
+                taken.append(name)
+                if len(taken) == limit:
+                    break
+        return taken
+
+
+# -------------------- Strategies --------------------
+# Each strategy orders a model's capable drivers, best first. The booking
+# statement then takes the first of them that is free on the rent date.
+# KEYS gives the sort key of the counter-based ones, for rent_date's week.
+
+KEYS = {
+    'least_recent': lambda counters, week: lambda d: (counters.last_rent_id.get(d, 0), d),
+    'fewest_week': lambda counters, week: lambda d: (counters.week_rents.get((d, week), 0), d),
+    'highest_rated': lambda counters, week: lambda d: (-counters.average_rating(d), d),
+}
+
+
+def rank_first(counters, drivers, rent_date, model_key):
+    # The original behaviour: alphabetical order
+    return sorted(drivers)
+
+
+def rank_least_recent(counters, drivers, rent_date, model_key):
+    return sorted(drivers, key=KEYS['least_recent'](counters, None))
+
+
+def rank_fewest_week(counters, drivers, rent_date, model_key):
+    return sorted(drivers, key=KEYS['fewest_week'](counters, week_of(rent_date)))
+
+
+def rank_highest_rated(counters, drivers, rent_date, model_key):
+    return sorted(drivers, key=KEYS['highest_rated'](counters, None))
+
+
+def rank_round_robin(counters, drivers, rent_date, model_key):
+    # Start just after whoever got this model last
+    ordered = sorted(drivers)
+    last = counters.round_robin.get(model_key)
+    if last is None:
+        return ordered
+    start = next((i for i, d in enumerate(ordered) if d > last), 0)
+    return ordered[start:] + ordered[:start]
+
+
+STRATEGIES = {
+    'first': rank_first,
+    'least_recent': rank_least_recent,
+    'fewest_week': rank_fewest_week,
+    'highest_rated': rank_highest_rated,
+    'round_robin': rank_round_robin,
+}
+
+counters = DriverCounters()
+
+
+def rank_drivers(drivers, rent_date, model_id, car_id, strategy=None):
+    """Order all of drivers; used by batch booking, whose matching needs every candidate."""
+    strategy = strategy or DEFAULT_STRATEGY
+    if strategy not in STRATEGIES:
+        raise ValueError(f"Unknown assignment strategy: {strategy}")
+    with counters._lock:
+        return STRATEGIES[strategy](counters, drivers, rent_date, (int(model_id), int(car_id)))
+
+
+def best_drivers(index, rent_date, model_id, car_id, strategy=None, limit=None):
+    """The first limit (CANDIDATES) drivers of the model free on rent_date, best first.
+
+    Same order as rank_drivers, read from the model's kept ordering
+    instead of sorting its capable drivers.
+    """
+    strategy = strategy or DEFAULT_STRATEGY
+    if strategy not in STRATEGIES:
+        raise ValueError(f"Unknown assignment strategy: {strategy}")
+    rent_date = to_date(rent_date)
+    model_key = (int(model_id), int(car_id))
+    with counters._lock:
+        ordering = counters.ordering(index, strategy, model_key, week_of(rent_date))
+        is_free = lambda name: index.is_free(rent_date, name)
+        if strategy == 'round_robin':
+            return ordering.take(is_free, limit or CANDIDATES, counters.round_robin.get(model_key))
+        return ordering.take(is_free, limit or CANDIDATES)
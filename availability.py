@@ -0,0 +1,349 @@
+# availability.py
+
+import datetime
+import os
+import threading
+import time
+
+from database import get_connection
+
+# Rebuild the index from the database when it is older than this many
+# seconds. 0 disables periodic rebuilds (the index is then only rebuilt at
+# startup or after invalidate()).
+MAX_AGE = float(os.environ.get('TAXI_AVAILABILITY_MAX_AGE', '0'))
+
+
+def to_date(value):
+    if isinstance(value, datetime.date):
+        return value
+    return datetime.date.fromisoformat(value)
+
+
+def _bits(mask):
+    # Positions of the set bits of mask, lowest first. One pass over its
+    # binary digits: peeling bits off with mask & -mask copies the whole
+    # int per bit, which is quadratic for a busy day's booked models.
+    digits = bin(mask)[:1:-1]
+    bit = digits.find('1')
+    while bit != -1:
+        yield bit
+        bit = digits.find('1', bit + 1)
+
+
+class _Day:
+    __slots__ = ('booked_models', 'busy_drivers', 'rents')
+
+    def __init__(self):
+        self.booked_models = 0   # bitset of model bits rented that day
+        self.busy_drivers = 0    # bitset of driver bits driving that day
+        self.rents = {}          # driver bit -> model bit, to undo bookings on deletes
+
+
+class AvailabilityIndex:
+    """Per-day bitsets of booked models and busy drivers.
+
+    Models and drivers are each assigned a bit position. For every model we
+    keep the bitset of drivers who declared it, so "is this model available
+    on day d" is two bit operations against that day's bitsets.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.loaded = False
+        self.loaded_at = None
+        # Bumped whenever which drivers can drive which model may have
+        # changed, so orderings built from capable_drivers() know to rebuild
+        self.generation = 0
+        self._reset()
+
+    def _reset(self):
+        self._model_bits = {}    # (model_id, car_id) -> bit
+        self._models = {}        # bit -> model row, in (model_id, car_id) order
+        self._driver_bits = {}   # driver name -> bit
+        self._driver_names = {}  # bit -> driver name
+        self._capable = {}       # model bit -> bitset of drivers who can drive it
+        self._days = {}          # date -> _Day
+        self._next_model_bit = 0
+        self._next_driver_bit = 0
+        self.generation += 1
+
+    # -------------------- Loading --------------------
+
+    def rebuild(self):
+        # Holding the lock while reading keeps concurrent incremental updates
+        # from being lost: they are applied after the swap and are idempotent.
+        with self._lock:
+            conn = get_connection()
+            cur = conn.cursor()
+            try:
+                cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY")
+                cur.execute("""
+                    SELECT m.model_id, m.car_id, c.brand, m.color, m.construction_year, m.transmission_type
+                    FROM Model m
+                    JOIN Car c ON m.car_id = c.car_id
+                    ORDER BY m.model_id, m.car_id
+                """)
+                models = cur.fetchall()
+                cur.execute("SELECT name FROM Driver ORDER BY name")
+                drivers = cur.fetchall()
+                cur.execute("SELECT name, model_id, car_id FROM Driver_Model")
+                declarations = cur.fetchall()
+                cur.execute("SELECT rent_date, name, model_id, car_id FROM Rent")
+                rents = cur.fetchall()
+                conn.commit()
+            finally:
+                cur.close()
+                conn.close()
+
+            self._reset()
+            for row in models:
+                self._add_model(row)
+            for (name,) in drivers:
+                self._driver_bit(name)
+            for name, model_id, car_id in declarations:
+                self._declare(name, model_id, car_id)
+            for rent_date, name, model_id, car_id in rents:
+                self._record_rent(rent_date, name, model_id, car_id)
+            self.loaded = True
+            self.loaded_at = time.time()
+
+    def stale(self):
+        return not self.loaded or (MAX_AGE and time.time() - self.loaded_at > MAX_AGE)
+
+    def ensure_loaded(self):
+        if self.stale():
+            with self._lock:
+                # Requests that queued behind a rebuild find it done
+                if self.stale():
+                    self.rebuild()
+
+    def invalidate(self):
+        with self._lock:
+            self.loaded = False
+
+    # -------------------- Queries --------------------
+
+    def available_models(self, rent_date):
+        rent_date = to_date(rent_date)
+        with self._lock:
+            day = self._days.get(rent_date)
+            booked = set(_bits(day.booked_models)) if day else ()
+            busy = day.busy_drivers if day else 0
+            # Only models someone declared; model bits follow _models order.
+            # Some capable driver is free when masking out the busy ones
+            # changes the set (no ~busy: a negative mask costs its full width).
+            return [
+                dict(self._models[bit])
+                for bit, drivers in sorted(self._capable.items())
+                if bit not in booked and (drivers & busy) != drivers
+            ]
+
+    def capable_drivers(self, model_id, car_id):
+        with self._lock:
+            model_bit = self._model_bits.get((int(model_id), int(car_id)))
+            drivers = self._capable.get(model_bit, 0)
+            return [self._driver_names[bit] for bit in _bits(drivers)]
+
+    def is_free(self, rent_date, name):
+        """Whether driver name has no rent on rent_date (a datetime.date)."""
+        with self._lock:
+            day = self._days.get(rent_date)
+            return day is None or self._driver_bits.get(name) not in day.rents
+
+    def stats(self):
+        with self._lock:
+            return {
+                'loaded': self.loaded,
+                'loaded_at': self.loaded_at,
+                'models': len(self._models),
+                'drivers': len(self._driver_bits),
+                'days': len(self._days),
+            }
+
+    # -------------------- Incremental updates --------------------
+    # Called by the write handlers after their transaction commits. Updates
+    # are skipped while the index is not loaded; the next rebuild sees them.
+
+    def record_rent(self, rent_date, name, model_id, car_id):
+        with self._lock:
+            if self.loaded:
+                self._record_rent(to_date(rent_date), name, int(model_id), int(car_id))
+
+    def declare(self, name, model_id, car_id):
+        with self._lock:
+            if self.loaded:
+                self._declare(name, int(model_id), int(car_id))
+
+    def remove_rent(self, rent_date, name, model_id, car_id):
+        with self._lock:
+            if not self.loaded:
+                return
+            day = self._days.get(to_date(rent_date))
+            driver_bit = self._driver_bits.get(name)
+            model_bit = self._model_bits.get((int(model_id), int(car_id)))
+            # Already freed, e.g. by remove_driver or remove_model
+            if day is None or driver_bit is None or day.rents.get(driver_bit) != model_bit:
+                return
+            del day.rents[driver_bit]
+            day.busy_drivers &= ~(1 << driver_bit)
+            day.booked_models &= ~(1 << model_bit)
+
+    def undeclare(self, name, model_id, car_id):
+        with self._lock:
+            if not self.loaded:
+                return
+            driver_bit = self._driver_bits.get(name)
+            model_bit = self._model_bits.get((int(model_id), int(car_id)))
+            if driver_bit is None or model_bit not in self._capable:
+                return
+            drivers = self._capable[model_bit] & ~(1 << driver_bit)
+            self.generation += 1
+            if drivers:
+                self._capable[model_bit] = drivers
+            else:
+                del self._capable[model_bit]
+
+    def remove_driver(self, name):
+        with self._lock:
+            if not self.loaded:
+                return
+            bit = self._driver_bits.pop(name, None)
+            if bit is None:
+                return
+            del self._driver_names[bit]
+            self.generation += 1
+            mask = ~(1 << bit)
+            for model_bit in self._capable:
+                self._capable[model_bit] &= mask
+            # The driver's rents are deleted with them, which frees the models.
+            for day in self._days.values():
+                model_bit = day.rents.pop(bit, None)
+                if model_bit is not None:
+                    day.busy_drivers &= mask
+                    day.booked_models &= ~(1 << model_bit)
+
+    def remove_model(self, model_id, car_id):
+        with self._lock:
+            if self.loaded:
+                self._remove_models([(int(model_id), int(car_id))])
+
+    def remove_car(self, car_id):
+        with self._lock:
+            if self.loaded:
+                car_id = int(car_id)
+                self._remove_models([key for key in self._model_bits if key[1] == car_id])
+
+    def remove_brand(self, brand):
+        with self._lock:
+            if self.loaded:
+                self._remove_models([key for key, bit in self._model_bits.items()
+                                     if self._models[bit]['brand'] == brand])
+
+    def apply_events(self, events):
+        """Outbox subscriber: apply writes made by any process (see outbox.py).
+
+        Each update is idempotent, so this process's own writes, already
+        applied by their handlers, can be applied again.
+        """
+        # Rents cascading from a delete in the same batch are freed by the
+        # remove_* call for it, so skip them rather than look each one up
+        deleted_drivers = set()
+        deleted_models = set()
+        deleted_cars = set()
+        for event in events:
+            if event.event_type == 'DriverDeleted':
+                deleted_drivers.add(event.payload['name'])
+            elif event.event_type == 'ModelDeleted':
+                deleted_models.add((event.payload['model_id'], event.payload['car_id']))
+            elif event.event_type == 'CarDeleted':
+                deleted_cars.add(event.payload['car_id'])
+        for event in events:
+            row = event.payload
+            if event.event_type == 'RentBooked':
+                self.record_rent(row['rent_date'], row['name'], row['model_id'], row['car_id'])
+            elif event.event_type == 'RentDeleted':
+                if (row['name'] not in deleted_drivers and row['car_id'] not in deleted_cars
+                        and (row['model_id'], row['car_id']) not in deleted_models):
+                    self.remove_rent(row['rent_date'], row['name'], row['model_id'], row['car_id'])
+            elif event.event_type == 'DriverModelDeclared':
+                self.declare(row['name'], row['model_id'], row['car_id'])
+            elif event.event_type == 'DriverModelRemoved':
+                self.undeclare(row['name'], row['model_id'], row['car_id'])
+            elif event.event_type == 'DriverDeleted':
+                self.remove_driver(row['name'])
+            elif event.event_type == 'ModelDeleted':
+                self.remove_model(row['model_id'], row['car_id'])
+            elif event.event_type == 'CarDeleted':
+                self.remove_car(row['car_id'])
+            elif event.event_type == 'BulkImported':
+                # Too many rows to apply one by one; rebuild on next use
+                self.invalidate()
+
+    # -------------------- Internals (caller holds the lock) --------------------
+
+    def _add_model(self, row):
+        model_id, car_id, brand, color, construction_year, transmission_type = row
+        bit = self._next_model_bit
+        self._next_model_bit += 1
+        self._model_bits[(model_id, car_id)] = bit
+        self._models[bit] = {
+            "model_id": model_id,
+            "car_id": car_id,
+            "brand": brand,
+            "color": color,
+            "construction_year": construction_year,
+            "transmission_type": transmission_type
+        }
+
+    def _driver_bit(self, name):
+        bit = self._driver_bits.get(name)
+        if bit is None:
+            bit = self._next_driver_bit
+            self._next_driver_bit += 1
+            self._driver_bits[name] = bit
+            self._driver_names[bit] = name
+        return bit
+
+    def _declare(self, name, model_id, car_id):
+        model_bit = self._model_bits.get((model_id, car_id))
+        if model_bit is None:
+            # A model we have not seen yet; reload the catalog lazily.
+            self.loaded = False
+            return
+        driver_bit = self._driver_bit(name)
+        self._capable[model_bit] = self._capable.get(model_bit, 0) | (1 << driver_bit)
+        self.generation += 1
+
+    def _record_rent(self, rent_date, name, model_id, car_id):
+        model_bit = self._model_bits.get((model_id, car_id))
+        if model_bit is None:
+            self.loaded = False
+            return
+        driver_bit = self._driver_bit(name)
+        day = self._days.get(rent_date)
+        if day is None:
+            day = self._days[rent_date] = _Day()
+        day.booked_models |= 1 << model_bit
+        day.busy_drivers |= 1 << driver_bit
+        day.rents[driver_bit] = model_bit
+
+    def _remove_models(self, keys):
+        for key in keys:
+            bit = self._model_bits.pop(key, None)
+            if bit is None:
+                continue
+            del self._models[bit]
+            self._capable.pop(bit, None)
+            self.generation += 1
+            # Rents of a deleted model cascade away, which frees their drivers.
+            for day in self._days.values():
+                if not (day.booked_models >> bit) & 1:
+                    continue
+                day.booked_models &= ~(1 << bit)
+                for driver_bit, model_bit in list(day.rents.items()):
+                    if model_bit == bit:
+                        del day.rents[driver_bit]
+                        day.busy_drivers &= ~(1 << driver_bit)
+
+
+index = AvailabilityIndex()
@@ -0,0 +1,114 @@
+# bench/assignment_strategies.py
+#
+# Compares the driver assignment strategies in assignment.py on a synthetic
+# fleet, entirely in memory (no database needed). For every strategy the same
+# stream of booking requests is replayed; we report how long ranking takes
+# and how evenly the rents end up spread across drivers.
+#
+#   python bench/assignment_strategies.py --drivers 1000 --models 200 --days 28
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import assignment
+
+
+def build_fleet(n_drivers, n_models, models_per_driver, rng):
+    drivers = ["driver_%05d" % i for i in range(n_drivers)]
+    models = [(m, 1 + m % 20) for m in range(1, n_models + 1)]
+    capable = {model: [] for model in models}
+    for name in drivers:
+        for model in rng.sample(models, models_per_driver):
+            capable[model].append(name)
+    ratings = {name: [rng.randint(1, 5) for _ in range(rng.randint(0, 10))] for name in drivers}
+    return drivers, models, capable, ratings
+
+
+def build_requests(models, days, per_day, rng):
+    start = date(2030, 1, 7)
+    requests = []
+    for offset in range(days):
+        rent_date = start + timedelta(days=offset)
+        for model in rng.sample(models, min(per_day, len(models))):
+            requests.append((rent_date, model))
+    return requests
+
+
+def gini(values):
+    values = sorted(values)
+    total = sum(values)
+    if not total:
+        return 0.0
+    cumulative = sum((i + 1) * v for i, v in enumerate(values))
+    return (2 * cumulative) / (len(values) * total) - (len(values) + 1) / len(values)
+
+
+def run(strategy, drivers, capable, ratings, requests):
+    counters = assignment.DriverCounters()
+    counters.loaded = True
+    for name, scores in ratings.items():
+        for score in scores:
+            counters.record_review(name, score)
+
+    busy = set()
+    load = {name: 0 for name in drivers}
+    latencies = []
+    unassigned = 0
+    rank = assignment.STRATEGIES[strategy]
+    for rent_id, (rent_date, model) in enumerate(requests, start=1):
+        started = time.perf_counter()
+        ranked = rank(counters, capable[model], rent_date, model)
+        driver = next((d for d in ranked if (rent_date, d) not in busy), None)
+        latencies.append(time.perf_counter() - started)
+        if driver is None:
+            unassigned += 1
+            continue
+        busy.add((rent_date, driver))
+        load[driver] += 1
+        counters.record_rent(driver, rent_id, rent_date, model[0], model[1])
+
+    latencies.sort()
+    rents = list(load.values())
+    return {
+        'p50_us': latencies[len(latencies) // 2] * 1e6,
+        'p99_us': latencies[int(len(latencies) * 0.99)] * 1e6,
+        'unassigned': unassigned,
+        'max': max(rents),
+        'idle': sum(1 for r in rents if r == 0),
+        'stdev': statistics.pstdev(rents),
+        'gini': gini(rents),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare driver assignment strategies on a synthetic fleet")
+    parser.add_argument('--drivers', type=int, default=1000)
+    parser.add_argument('--models', type=int, default=200)
+    parser.add_argument('--models-per-driver', type=int, default=5)
+    parser.add_argument('--days', type=int, default=28)
+    parser.add_argument('--per-day', type=int, default=150, help="Booking requests per day")
+    parser.add_argument('--seed', type=int, default=7)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    drivers, models, capable, ratings = build_fleet(args.drivers, args.models, args.models_per_driver, rng)
+    requests = build_requests(models, args.days, args.per_day, rng)
+
+    print("drivers=%d models=%d requests=%d" % (len(drivers), len(models), len(requests)))
+    print("%-14s %9s %9s %10s %5s %5s %7s %6s" % (
+        'strategy', 'p50(us)', 'p99(us)', 'unassigned', 'max', 'idle', 'stdev', 'gini'))
+    for strategy in assignment.STRATEGIES:
+        r = run(strategy, drivers, capable, ratings, requests)
+        print("%-14s %9.1f %9.1f %10d %5d %5d %7.2f %6.3f" % (
+            strategy, r['p50_us'], r['p99_us'], r['unassigned'], r['max'], r['idle'], r['stdev'], r['gini']))
+
+
+if __name__ == '__main__':
+    main()
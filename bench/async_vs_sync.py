@@ -0,0 +1,159 @@
+# bench/async_vs_sync.py
+#
+# Side-by-side throughput and latency of the synchronous Flask handlers
+# (threaded Werkzeug server) and the async serving mode (asgi.py on uvicorn)
+# against the same database. Each server is started in a subprocess and hit
+# with the same read-only mix of logins, availability lookups and rent
+# history pages at a fixed concurrency. The servers run with admission
+# control off (TAXI_ADMISSION=0), since the requests carry no session; any
+# 429 or 503 would otherwise be shed load, and counts as an error.
+#
+#   python bench/async_vs_sync.py --concurrency 64 --duration 20
+
+import argparse
+import http.client
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from datetime import timedelta
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from database import get_connection
+
+SERVERS = {
+    'sync': [sys.executable, '-c',
+             "import sys; from werkzeug.serving import run_simple; from app import app; "
+             "run_simple('127.0.0.1', int(sys.argv[1]), app, threaded=True)"],
+    'async': [sys.executable, '-m', 'uvicorn', 'asgi:app', '--host', '127.0.0.1', '--log-level', 'warning',
+              '--port'],
+}
+
+
+def load_fixture():
+    conn = get_connection()
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT email_address FROM Client ORDER BY random() LIMIT 200")
+        clients = [row[0] for row in cur.fetchall()]
+        cur.execute("SELECT MIN(rent_date), MAX(rent_date) FROM Rent")
+        first, last = cur.fetchone()
+        return clients, first, last
+    finally:
+        cur.close()
+        conn.close()
+
+
+def make_requests(clients, first, last, rng):
+    span = max((last - first).days, 1) if first else 1
+
+    def request():
+        roll = rng.random()
+        if roll < 0.4 and first:
+            day = first + timedelta(days=rng.randrange(span))
+            return '/client/view_available_models', {'rent_date': day.isoformat()}
+        if roll < 0.8:
+            return '/client/view_rents', {'client_email': rng.choice(clients), 'limit': 20}
+        return '/client/login', {'email_address': rng.choice(clients)}
+
+    return request
+
+
+def wait_until_up(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            conn.request('GET', '/')
+            conn.getresponse().read()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"Server on port {port} did not start")
+
+
+def worker(port, next_request, deadline, latencies, errors):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    while time.time() < deadline:
+        path, body = next_request()
+        started = time.perf_counter()
+        try:
+            conn.request('POST', path, json.dumps(body), {'Content-Type': 'application/json'})
+            response = conn.getresponse()
+            response.read()
+            if response.status == 429 or response.status >= 500:
+                errors.append(response.status)
+        except (OSError, http.client.HTTPException):
+            errors.append('io')
+            conn.close()
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+            continue
+        latencies.append(time.perf_counter() - started)
+    conn.close()
+
+
+def run(mode, port, concurrency, duration, clients, first, last, seed):
+    server = subprocess.Popen(SERVERS[mode] + [str(port)], cwd=ROOT, env=dict(os.environ, TAXI_ADMISSION='0'))
+    try:
+        wait_until_up(port)
+        rng = random.Random(seed)
+        lock = threading.Lock()
+        make = make_requests(clients, first, last, rng)
+
+        def next_request():
+            with lock:
+                return make()
+
+        latencies, errors = [], []
+        deadline = time.time() + duration
+        threads = [threading.Thread(target=worker, args=(port, next_request, deadline, latencies, errors))
+                   for _ in range(concurrency)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    finally:
+        server.terminate()
+        server.wait()
+
+    latencies.sort()
+    count = len(latencies)
+    return {
+        'requests': count,
+        'rps': count / duration,
+        'p50_ms': latencies[count // 2] * 1000 if count else 0,
+        'p99_ms': latencies[int(count * 0.99)] * 1000 if count else 0,
+        'errors': len(errors),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare sync and async serving modes")
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--duration', type=float, default=20)
+    parser.add_argument('--port', type=int, default=5090)
+    parser.add_argument('--modes', nargs='+', default=['sync', 'async'], choices=list(SERVERS))
+    parser.add_argument('--seed', type=int, default=11)
+    args = parser.parse_args()
+
+    clients, first, last = load_fixture()
+    if not clients:
+        print("Need at least one Client row to run")
+        return 2
+
+    print("concurrency=%d duration=%.0fs" % (args.concurrency, args.duration))
+    print("%-6s %9s %9s %9s %9s %7s" % ('mode', 'requests', 'req/s', 'p50(ms)', 'p99(ms)', 'errors'))
+    for i, mode in enumerate(args.modes):
+        r = run(mode, args.port + i, args.concurrency, args.duration, clients, first, last, args.seed)
+        print("%-6s %9d %9.1f %9.2f %9.2f %7d" % (
+            mode, r['requests'], r['rps'], r['p50_ms'], r['p99_ms'], r['errors']))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
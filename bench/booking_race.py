@@ -0,0 +1,145 @@
+# bench/booking_race.py
+#
+# Concurrent booking load test. N parallel clients race to book every
+# bookable model on the same date; afterwards the Rent table is checked for
+# double-booked models and double-booked drivers.
+#
+#   python bench/booking_race.py --clients 32 --date 2031-01-01
+
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import booking
+import schema
+from database import get_connection
+
+
+def load_fixture(max_clients):
+    conn = get_connection()
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT DISTINCT model_id, car_id FROM Driver_Model ORDER BY model_id, car_id")
+        models = cur.fetchall()
+        cur.execute("SELECT email_address FROM Client ORDER BY email_address LIMIT %s", (max_clients,))
+        clients = [row[0] for row in cur.fetchall()]
+        cur.execute("SELECT COUNT(DISTINCT name) FROM Driver_Model")
+        drivers = cur.fetchone()[0]
+        return models, clients, drivers
+    finally:
+        cur.close()
+        conn.close()
+
+
+def run_client(client_email, rent_date, models, results, barrier):
+    order = list(models)
+    random.shuffle(order)
+    barrier.wait()
+    for model_id, car_id in order:
+        conn = get_connection()
+        try:
+            started = time.perf_counter()
+            result = booking.book_rent(conn, rent_date, client_email, model_id, car_id)
+            result['latency'] = time.perf_counter() - started
+            results.append(result)
+        finally:
+            conn.close()
+
+
+def check_double_bookings(rent_date):
+    conn = get_connection()
+    cur = conn.cursor()
+    try:
+        cur.execute("""
+            SELECT model_id, car_id, COUNT(*) FROM Rent
+            WHERE rent_date = %s GROUP BY model_id, car_id HAVING COUNT(*) > 1
+        """, (rent_date,))
+        models = cur.fetchall()
+        cur.execute("""
+            SELECT name, COUNT(*) FROM Rent
+            WHERE rent_date = %s GROUP BY name HAVING COUNT(*) > 1
+        """, (rent_date,))
+        drivers = cur.fetchall()
+        cur.execute("SELECT COUNT(*) FROM Rent WHERE rent_date = %s", (rent_date,))
+        total = cur.fetchone()[0]
+        return models, drivers, total
+    finally:
+        cur.close()
+        conn.close()
+
+
+def cleanup(rent_date):
+    conn = get_connection()
+    cur = conn.cursor()
+    try:
+        cur.execute("DELETE FROM Rent WHERE rent_date = %s", (rent_date,))
+        conn.commit()
+    finally:
+        cur.close()
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Race N clients against book_rent and check for double bookings")
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--date', default='2031-01-01', help="Date to book; should have no existing rents")
+    parser.add_argument('--keep', action='store_true', help="Keep the rents created by the run")
+    args = parser.parse_args()
+
+    conn = get_connection()
+    try:
+        schema.migrate(conn)
+    finally:
+        conn.close()
+
+    models, clients, drivers = load_fixture(args.clients)
+    if not models or not clients:
+        print("Need at least one Driver_Model row and one Client row to run")
+        return 2
+
+    threads = []
+    results = []
+    barrier = threading.Barrier(args.clients)
+    for i in range(args.clients):
+        email = clients[i % len(clients)]
+        threads.append(threading.Thread(target=run_client, args=(email, args.date, models, results, barrier)))
+
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    try:
+        dup_models, dup_drivers, total = check_double_bookings(args.date)
+    finally:
+        if not args.keep:
+            cleanup(args.date)
+
+    booked = sum(1 for r in results if r['booked'])
+    reasons = Counter(r['reason'] for r in results if not r['booked'])
+    latencies = sorted(r['latency'] for r in results)
+    retries = sum(r['attempts'] - 1 for r in results)
+
+    print("clients=%d attempts=%d elapsed=%.3fs" % (args.clients, len(results), elapsed))
+    print("bookable models=%d drivers=%d booked=%d rows=%d retries=%d" % (len(models), drivers, booked, total, retries))
+    print("conflicts:", dict(reasons))
+    print("latency p50=%.2fms p99=%.2fms" % (
+        latencies[len(latencies) // 2] * 1000, latencies[int(len(latencies) * 0.99)] * 1000))
+
+    if dup_models or dup_drivers or booked != total:
+        print("FAIL: double bookings detected", dup_models, dup_drivers)
+        return 1
+    print("OK: no double bookings")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
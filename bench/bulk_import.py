@@ -0,0 +1,113 @@
+# bench/bulk_import.py
+#
+# Bulk import throughput. Builds an empty scratch schema with schema.py's
+# migrations and imports --rows synthetic cars' models, drivers, driver
+# model declarations and clients through bulk.import_rows, from CSV or
+# NDJSON generated in memory beforehand. Reports rows per second for each
+# entity against the 100k rows/s target, then imports the drivers again to
+# check that skipped rows create no addresses. Exits non-zero if either
+# check fails.
+#
+#   python bench/bulk_import.py --rows 500000 --format ndjson
+
+import argparse
+import io
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import bulk
+import schema
+from database import get_connection
+
+SCRATCH_SCHEMA = 'bench_bulk_import'
+TARGET_ROWS_PER_SEC = 100000
+CARS = 100
+
+
+def generate(entity, rows, fmt):
+    """The import file for entity, as bytes; rows share a quarter as many addresses."""
+    if entity == 'cars':
+        records = [{'car_id': i, 'brand': 'brand_%d' % i} for i in range(1, CARS + 1)]
+    elif entity == 'models':
+        records = [{'model_id': i, 'car_id': i % CARS + 1, 'color': 'black', 'construction_year': 2020,
+                    'transmission_type': 'automatic'} for i in range(rows)]
+    elif entity == 'drivers':
+        records = [{'name': 'driver_%d' % i, 'nameofroad': 'road_%d' % (i % (rows // 4 + 1)), 'number': i % 7,
+                    'city': 'city_%d' % (i % 200)} for i in range(rows)]
+    elif entity == 'driver_models':
+        records = [{'name': 'driver_%d' % i, 'model_id': i, 'car_id': i % CARS + 1} for i in range(rows)]
+    else:
+        records = [{'email_address': 'client_%d' % i, 'name': 'Client %d' % i,
+                    'nameofroad': 'street_%d' % (i % (rows // 4 + 1)), 'number': i % 7,
+                    'city': 'city_%d' % (i % 200)} for i in range(rows)]
+    if fmt == 'ndjson':
+        return ''.join(json.dumps(record) + '\n' for record in records).encode()
+    columns = list(records[0])
+    lines = [','.join(columns)] + [','.join(str(record[c]) for c in columns) for record in records]
+    return ('\n'.join(lines) + '\n').encode()
+
+
+def timed_import(conn, entity, data, fmt):
+    started = time.perf_counter()
+    result = bulk.import_rows(conn, entity, io.BytesIO(data), fmt)
+    return result, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure bulk import rows per second")
+    parser.add_argument('--rows', type=int, default=200000, help="Rows per entity")
+    parser.add_argument('--format', choices=bulk.FORMATS, default='csv')
+    parser.add_argument('--keep', action='store_true', help="Keep the scratch schema after the run")
+    args = parser.parse_args()
+
+    files = {entity: generate(entity, args.rows, args.format)
+             for entity in ('cars', 'models', 'drivers', 'driver_models', 'clients')}
+
+    conn = get_connection()
+    cur = conn.cursor()
+    failures = 0
+    try:
+        cur.execute(f"DROP SCHEMA IF EXISTS {SCRATCH_SCHEMA} CASCADE")
+        cur.execute(f"CREATE SCHEMA {SCRATCH_SCHEMA}")
+        cur.execute(f"SET search_path TO {SCRATCH_SCHEMA}")
+        conn.commit()
+        # SET (not SET LOCAL) survives the per-migration commits
+        schema.migrate(conn)
+
+        print("%-14s %9s %9s %12s" % ('entity', 'rows', 'seconds', 'rows/s'))
+        for entity, data in files.items():
+            result, elapsed = timed_import(conn, entity, data, args.format)
+            rate = result['staged'] / elapsed
+            slow = entity != 'cars' and rate < TARGET_ROWS_PER_SEC
+            failures += slow
+            print("%-14s %9d %9.2f %12.0f%s" % (entity, result['staged'], elapsed, rate,
+                                                '  below target' if slow else ''))
+
+        # Every driver exists now, so all are skipped and no address is created
+        result, _ = timed_import(conn, 'drivers', files['drivers'], args.format)
+        orphans = result['addresses_created']
+        failures += bool(orphans)
+        print("drivers again: %d skipped, %d addresses created" % (result['skipped'], orphans))
+    finally:
+        conn.rollback()
+        if not args.keep:
+            cur.execute(f"DROP SCHEMA IF EXISTS {SCRATCH_SCHEMA} CASCADE")
+        # Pooled connections are reused; do not hand this one back pointed at the scratch schema
+        cur.execute("RESET search_path")
+        conn.commit()
+        cur.close()
+        conn.close()
+
+    if failures:
+        print("FAIL: %d checks failed (target %d rows/s)" % (failures, TARGET_ROWS_PER_SEC))
+        return 1
+    print("OK: every entity imports at %d rows/s or more" % TARGET_ROWS_PER_SEC)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
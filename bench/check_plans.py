@@ -0,0 +1,178 @@
+# bench/check_plans.py
+#
+# Index regression check. Builds a scratch schema with schema.py's
+# migrations, seeds it with seed.py's synthetic fleet and EXPLAINs every
+# hot lookup the handlers make. Exits non-zero if any plan contains a
+# sequential scan of a large table, so a query or migration change that
+# loses its index is caught before it reaches production. Scanning a table
+# smaller than --min-rows (Car, say) is often the right plan and is allowed.
+#
+#   python bench/check_plans.py --rents 1000000
+
+import argparse
+import json
+import os
+import sys
+from datetime import date
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import app  # noqa: F401  registers the handlers' statements
+import queries
+import schema
+import seed
+from database import get_connection
+
+SCRATCH_SCHEMA = 'bench_check_plans'
+
+DRIVERS = 5000
+CITIES = 200
+FIRST_DAY = date(2030, 1, 1)
+
+NAMES = {'names': ['driver_42', 'driver_7']}
+
+# (label, registered statement, params). The SQL is read from queries.py's
+# registry, so it is exactly what the handlers run. Full-catalog listings
+# (list_models, catalog_models, model_usage, unfiltered driver_stats) read
+# every row by design and are not listed, nor is available_models_range,
+# which hash joins every driver declaration against the window's days.
+HOT_QUERIES = [
+    ('manager_login', 'manager_login', ('ssn_42',)),
+    ('driver_login', 'driver_login', ('driver_42',)),
+    ('client_login', 'client_login', ('client_42',)),
+    ('book_rent', 'book_rent', {
+        'rent_date': date(2030, 1, 1), 'client_email': 'client_42', 'model_id': 42, 'car_id': 43,
+        'preferred_drivers': ['driver_42', 'driver_7'],
+    }),
+    ('batch_existing_models', 'batch_existing_models', ([42], [43])),
+    ('batch_capable_drivers', 'batch_capable_drivers', ([42], [43])),
+    ('batch_booked', 'batch_booked', ([date(2030, 1, 1)],)),
+    ('view_rents_first_page', 'rent_history', {
+        'client_email': 'client_42', 'after_date': None, 'after_id': None, 'limit': 50,
+    }),
+    ('view_rents_next_page', 'rent_history', {
+        'client_email': 'client_42', 'after_date': date(2030, 1, 1), 'after_id': 1000, 'limit': 50,
+    }),
+    ('add_reviews', 'add_reviews', {
+        'positions': [0], 'client_emails': ['client_42'], 'driver_names': ['driver_42'],
+        'messages': ['ok'], 'ratings': [5],
+    }),
+    ('lock_driver', 'lock_driver', ('driver_42',)),
+    ('driver_active_rent', 'driver_active_rent', ('driver_42',)),
+    ('delete_driver_reviews', 'delete_driver_reviews', ('driver_42',)),
+    ('delete_driver_models', 'delete_driver_models', ('driver_42',)),
+    ('delete_driver_rents', 'delete_driver_rents', ('driver_42',)),
+    ('offboard_lock', 'offboard_lock', NAMES),
+    ('offboard_counts', 'offboard_counts', NAMES),
+    ('offboard_rents', 'offboard_rents', NAMES),
+    ('offboard_reviews', 'offboard_reviews', NAMES),
+    ('offboard_models', 'offboard_models', NAMES),
+    ('delete_car_brand', 'delete_car_brand', ('brand_7',)),
+    ('clients_by_city', 'clients_by_city', ('city_3', 'city_5')),
+    ('city_pair_counts', 'city_pair_counts', {
+        'client_cities': ['city_3', 'city_4', 'city_5'], 'driver_cities': ['city_5', 'city_6'],
+    }),
+    ('city_pair_clients_window', 'city_pair_clients_window', {
+        'client_cities': ['city_3', 'city_4'], 'driver_cities': ['city_5', 'city_6'],
+        'from_date': date(2030, 1, 1), 'to_date': date(2030, 1, 31), 'limit': 100, 'offset': 0,
+    }),
+    ('driver_stats_city', 'driver_stats', {'city': 'city_3', 'limit': 50, 'offset': 0}),
+    ('driver_stats_city_window', 'driver_stats_window', {
+        'city': 'city_3', 'from_date': date(2030, 1, 1), 'to_date': date(2030, 1, 7), 'limit': 50, 'offset': 0,
+    }),
+    ('top_k_clients', 'top_k_clients', (10,)),
+]
+
+# Lookups no handler statement makes: Postgres's own for ON DELETE CASCADE
+# and foreign key checks, and the assignment counters' weekly rebuild
+INTERNAL_LOOKUPS = [
+    ('cascade_car_models', "SELECT 1 FROM Model WHERE car_id = %(car_id)s", {'car_id': 43}),
+    ('cascade_model_drivers', """
+        SELECT 1 FROM Driver_Model WHERE model_id = %(model_id)s AND car_id = %(car_id)s
+    """, {'model_id': 42, 'car_id': 43}),
+    ('cascade_model_rents', """
+        SELECT 1 FROM Rent WHERE model_id = %(model_id)s AND car_id = %(car_id)s
+    """, {'model_id': 42, 'car_id': 43}),
+    ('weekly_assignment_counts', """
+        SELECT name, rent_date, COUNT(*) FROM Rent
+        WHERE rent_date >= date_trunc('week', %(today)s::date)
+        GROUP BY name, rent_date
+    """, {'today': '2030-03-01'}),
+]
+
+
+def large_tables(cur, min_rows):
+    cur.execute("""
+        SELECT c.relname FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = %s AND c.relkind = 'r' AND c.reltuples >= %s
+    """, (SCRATCH_SCHEMA, min_rows))
+    return {row[0] for row in cur.fetchall()}
+
+
+def seq_scans(plan):
+    found = []
+    if plan.get('Node Type') == 'Seq Scan':
+        found.append(plan.get('Relation Name'))
+    for child in plan.get('Plans', []):
+        found.extend(seq_scans(child))
+    return found
+
+
+def explain(cur, sql, params):
+    cur.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+    plan = cur.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]['Plan']
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fail if a hot query plans a sequential scan")
+    parser.add_argument('--rents', type=int, default=500000)
+    parser.add_argument('--clients', type=int, default=100000)
+    parser.add_argument('--reviews', type=int, default=100000)
+    parser.add_argument('--min-rows', type=int, default=10000,
+                        help="Only fail on sequential scans of tables with at least this many rows")
+    parser.add_argument('--keep', action='store_true', help="Keep the scratch schema after the run")
+    args = parser.parse_args()
+
+    conn = get_connection()
+    cur = conn.cursor()
+    failures = 0
+    try:
+        cur.execute(f"DROP SCHEMA IF EXISTS {SCRATCH_SCHEMA} CASCADE")
+        cur.execute(f"CREATE SCHEMA {SCRATCH_SCHEMA}")
+        cur.execute(f"SET search_path TO {SCRATCH_SCHEMA}")
+        conn.commit()
+        # SET (not SET LOCAL) survives the per-migration commits
+        schema.migrate(conn)
+        seed.seed(conn, seed.scale(drivers=DRIVERS, clients=args.clients, rents=args.rents, reviews=args.reviews,
+                                   cities=CITIES, brands=100, managers=10000), first_day=FIRST_DAY)
+
+        print("schema migrated, %d rents seeded" % args.rents)
+        large = large_tables(cur, args.min_rows)
+        plans = [(label, queries.sql(name), params) for label, name, params in HOT_QUERIES] + INTERNAL_LOOKUPS
+        for name, sql, params in plans:
+            scans = [table for table in seq_scans(explain(cur, sql, params)) if table in large]
+            failures += bool(scans)
+            print("%-30s %s" % (name, 'FAIL seq scan on ' + ', '.join(scans) if scans else 'ok'))
+        conn.rollback()
+    finally:
+        conn.rollback()
+        if not args.keep:
+            cur.execute(f"DROP SCHEMA IF EXISTS {SCRATCH_SCHEMA} CASCADE")
+        # Pooled connections are reused; do not hand this one back pointed at the scratch schema
+        cur.execute("RESET search_path")
+        conn.commit()
+        cur.close()
+        conn.close()
+
+    if failures:
+        print("%d hot queries plan a sequential scan" % failures)
+        return 1
+    print("OK: every hot query uses an index")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,138 @@
+# bench/driver_stats_plan.py
+#
+# Regression benchmark for /manager/driver_stats. Seeds a scratch schema with
+# synthetic drivers, rents and reviews at several sizes and compares the old
+# Driver x Rent x Review fan-out query with the pre-aggregated query and the
+# summary-table lookup the endpoint uses now. For each it reports the largest
+# intermediate row count in the plan, execution time, and how many drivers
+# got a wrong total_rents.
+#
+#   python bench/driver_stats_plan.py --sizes 10000 100000 1000000
+
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from database import get_connection
+
+SCHEMA = 'bench_driver_stats'
+
+QUERIES = {
+    'fan_out': """
+        SELECT d.name, COUNT(r.rent_id) AS total_rents, ROUND(AVG(rv.rating), 2) AS avg_rating
+        FROM Driver d
+        LEFT JOIN Rent r ON d.name = r.name
+        LEFT JOIN Review rv ON d.name = rv.name
+        GROUP BY d.name
+    """,
+    'pre_aggregated': """
+        SELECT d.name, COALESCE(r.total_rents, 0) AS total_rents, rv.avg_rating
+        FROM Driver d
+        LEFT JOIN (SELECT name, COUNT(*) AS total_rents FROM Rent GROUP BY name) r ON r.name = d.name
+        LEFT JOIN (SELECT name, ROUND(AVG(rating), 2) AS avg_rating FROM Review GROUP BY name) rv ON rv.name = d.name
+    """,
+    'summary_table': """
+        SELECT d.name, COALESCE(s.total_rents, 0) AS total_rents,
+               ROUND(s.rating_sum::numeric / NULLIF(s.rating_count, 0), 2) AS avg_rating
+        FROM Driver d
+        LEFT JOIN driver_rent_stats s ON s.name = d.name
+    """,
+}
+
+
+def seed(cur, rents, drivers, reviews_per_driver):
+    cur.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+    cur.execute(f"CREATE SCHEMA {SCHEMA}")
+    cur.execute(f"SET search_path TO {SCHEMA}")
+    cur.execute("""
+        CREATE TABLE Driver (name VARCHAR(100) PRIMARY KEY, city VARCHAR(50));
+        CREATE TABLE Rent (rent_id SERIAL PRIMARY KEY, rent_date DATE, name VARCHAR(100));
+        CREATE TABLE Review (review_id SERIAL PRIMARY KEY, name VARCHAR(100), rating INTEGER);
+        CREATE TABLE driver_rent_stats (
+            name VARCHAR(100) PRIMARY KEY, total_rents INTEGER, rating_sum BIGINT, rating_count INTEGER
+        );
+    """)
+    cur.execute("""
+        INSERT INTO Driver (name, city)
+        SELECT 'driver_' || i, 'city_' || (i %% 20) FROM generate_series(1, %s) i
+    """, (drivers,))
+    cur.execute("""
+        INSERT INTO Rent (rent_date, name)
+        SELECT DATE '2020-01-01' + (i %% 2000), 'driver_' || (1 + (i::bigint * 7919) %% %s)
+        FROM generate_series(1, %s) i
+    """, (drivers, rents))
+    cur.execute("""
+        INSERT INTO Review (name, rating)
+        SELECT 'driver_' || (1 + i %% %s), 1 + i %% 5
+        FROM generate_series(1, %s) i
+    """, (drivers, drivers * reviews_per_driver))
+    cur.execute("""
+        INSERT INTO driver_rent_stats
+        SELECT d.name, COALESCE(r.c, 0), COALESCE(rv.s, 0), COALESCE(rv.c, 0)
+        FROM Driver d
+        LEFT JOIN (SELECT name, COUNT(*) c FROM Rent GROUP BY name) r ON r.name = d.name
+        LEFT JOIN (SELECT name, SUM(rating) s, COUNT(*) c FROM Review GROUP BY name) rv ON rv.name = d.name
+    """)
+    cur.execute("CREATE INDEX ON Rent (name)")
+    cur.execute("CREATE INDEX ON Review (name)")
+    cur.execute("ANALYZE")
+
+
+def peak_rows(plan):
+    rows = plan.get('Actual Rows', 0) * plan.get('Actual Loops', 1)
+    return max([rows] + [peak_rows(child) for child in plan.get('Plans', [])])
+
+
+def measure(cur, sql):
+    cur.execute("EXPLAIN (ANALYZE, FORMAT JSON) " + sql)
+    plan = cur.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    plan = plan[0]
+    return peak_rows(plan['Plan']), plan['Execution Time']
+
+
+def wrong_totals(cur, sql):
+    cur.execute(f"""
+        SELECT COUNT(*) FROM ({sql}) q
+        JOIN (SELECT name, COUNT(*) AS c FROM Rent GROUP BY name) t ON t.name = q.name
+        WHERE q.total_rents <> t.c
+    """)
+    return cur.fetchone()[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare driver_stats query plans at several data sizes")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--drivers', type=int, default=1000)
+    parser.add_argument('--reviews-per-driver', type=int, default=20)
+    parser.add_argument('--keep', action='store_true', help="Keep the scratch schema after the run")
+    args = parser.parse_args()
+
+    conn = get_connection()
+    cur = conn.cursor()
+    try:
+        print("%10s %-15s %14s %12s %13s" % ('rents', 'query', 'peak rows', 'time (ms)', 'wrong totals'))
+        for size in args.sizes:
+            seed(cur, size, args.drivers, args.reviews_per_driver)
+            conn.commit()
+            for name, sql in QUERIES.items():
+                rows, elapsed = measure(cur, sql)
+                print("%10d %-15s %14d %12.1f %13d" % (size, name, rows, elapsed, wrong_totals(cur, sql)))
+            conn.rollback()
+    finally:
+        conn.rollback()
+        if not args.keep:
+            cur.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+        # Pooled connections are reused; do not hand this one back pointed at the scratch schema
+        cur.execute("RESET search_path")
+        conn.commit()
+        cur.close()
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+# bench/prepared_statements.py
+#
+# Per-call latency of registered statements sent as SQL text versus run as
+# server-side prepared statements (queries.py). Read-only statements only;
+# each is run --iterations times on one connection in both modes.
+#
+#   python bench/prepared_statements.py --iterations 5000
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import app  # noqa: F401  registers the route statements
+import queries
+from database import get_connection
+
+
+def cases(cur):
+    cur.execute("SELECT email_address FROM Client LIMIT 1")
+    client = cur.fetchone()
+    cur.execute("SELECT model_id, car_id FROM Model LIMIT 1")
+    model = cur.fetchone()
+    if not client or not model:
+        return []
+    return [
+        ('client_login', (client[0],)),
+        ('rent_history', {'client_email': client[0], 'after_date': None, 'after_id': None, 'limit': 50}),
+        ('batch_capable_drivers', ([model[0]], [model[1]])),
+        ('driver_stats', {'city': None, 'from_date': None, 'to_date': None, 'limit': 20, 'offset': 0}),
+    ]
+
+
+def run(cur, name, params, iterations, prepared):
+    queries.PREPARE_STATEMENTS = prepared
+    queries.execute(cur, name, params)   # warm up (and prepare)
+    cur.fetchall()
+    started = time.perf_counter()
+    for _ in range(iterations):
+        queries.execute(cur, name, params)
+        cur.fetchall()
+    return (time.perf_counter() - started) / iterations * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare SQL text and prepared statement latency")
+    parser.add_argument('--iterations', type=int, default=5000)
+    args = parser.parse_args()
+
+    conn = get_connection()
+    cur = conn.cursor()
+    try:
+        todo = cases(cur)
+        if not todo:
+            print("Need at least one Client and one Model row to run")
+            return 2
+        print("%-24s %12s %14s %8s" % ('statement', 'text (us)', 'prepared (us)', 'saved'))
+        for name, params in todo:
+            text = run(cur, name, params, args.iterations, False)
+            prepared = run(cur, name, params, args.iterations, True)
+            print("%-24s %12.1f %14.1f %7.0f%%" % (name, text, prepared, (1 - prepared / text) * 100))
+        conn.rollback()
+    finally:
+        cur.close()
+        conn.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
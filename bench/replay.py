@@ -0,0 +1,324 @@
+# bench/replay.py
+#
+# Replays a request log captured with TAXI_REQUEST_LOG (see request_log.py)
+# against the app, either in-process through the Flask test client or over
+# HTTP, and reports per-route latency and every response that differs from
+# the recorded one.
+#
+#   python bench/replay.py day.jsonl                        # original timing, in-process
+#   python bench/replay.py day.jsonl --speed 10             # ten times faster
+#   python bench/replay.py day.jsonl --max --concurrency 32 --url http://127.0.0.1:5050
+#   python bench/replay.py day.jsonl --max --json after.json --baseline before.json
+#
+# Replaying writes (bookings, registrations, deletes) changes the database,
+# so replay against a restored copy of the database the log was captured
+# on, or filter the log with --only/--exclude. Fields that legitimately
+# change between runs (new rent ids, cursors, session tokens) are ignored
+# when diffing; add more with --ignore.
+#
+# With --baseline, the run is compared to an earlier --json summary and
+# exits non-zero if any route's p95 got more than --max-regression slower.
+#
+# Replayed requests have no live sessions, so in-process replay runs with
+# admission control off, and a --url server should be started with
+# TAXI_ADMISSION=0. Responses shed by it (429, 503), 5xx and connection
+# failures are counted per route as errors.
+
+import argparse
+import http.client
+import json
+import os
+import queue
+import re
+import sys
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from workload import is_error, percentile
+
+DEFAULT_IGNORE = 'rent_id,next_cursor,loaded_at,token,expires_at'
+
+
+def load(path, only=None, exclude=None):
+    entries = []
+    with open(path) as f:
+        for line_no, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if 'method' not in entry or 'path' not in entry:
+                raise ValueError(f"{path}:{line_no} is not a request log entry (no method/path); "
+                                 "capture one with TAXI_REQUEST_LOG")
+            if only and not only.search(entry['path']):
+                continue
+            if exclude and exclude.search(entry['path']):
+                continue
+            entry['line'] = line_no
+            entries.append(entry)
+    entries.sort(key=lambda e: e.get('ts') or 0)
+    return entries
+
+
+# ----- Targets -----
+# send(entry) returns (status, response bytes); one instance per worker thread
+
+class InProcessTarget:
+    def __init__(self, flask_app):
+        self.client = flask_app.test_client()
+
+    def send(self, entry):
+        kwargs = {'method': entry['method'], 'query_string': entry.get('query') or None}
+        if entry.get('body') is not None:
+            kwargs['json'] = entry['body']
+        response = self.client.open(entry['path'], **kwargs)
+        try:
+            return response.status_code, response.get_data()
+        finally:
+            response.close()
+
+
+class HttpTarget:
+    def __init__(self, url, timeout):
+        self.url = urlsplit(url)
+        self.timeout = timeout
+        self.conn = None
+
+    def send(self, entry):
+        if self.conn is None:
+            self.conn = http.client.HTTPConnection(self.url.hostname, self.url.port or 80, timeout=self.timeout)
+        path = entry['path'] + ('?' + entry['query'] if entry.get('query') else '')
+        try:
+            if entry.get('body') is None:
+                self.conn.request(entry['method'], path)
+            else:
+                self.conn.request(entry['method'], path, json.dumps(entry['body']),
+                                  {'Content-Type': 'application/json'})
+            response = self.conn.getresponse()
+            return response.status, response.read()
+        except (OSError, http.client.HTTPException):
+            self.conn.close()
+            self.conn = None
+            return 'io', b''
+
+
+# ----- Diffing -----
+
+def differences(recorded, replayed, ignore, path='$', limit=5):
+    """JSON paths where replayed differs from recorded, skipping ignored keys."""
+    found = []
+    if isinstance(recorded, dict) and isinstance(replayed, dict):
+        for key in sorted(set(recorded) | set(replayed)):
+            if key in ignore:
+                continue
+            if key not in recorded or key not in replayed:
+                found.append(f'{path}.{key}')
+            else:
+                found += differences(recorded[key], replayed[key], ignore, f'{path}.{key}', limit)
+            if len(found) >= limit:
+                break
+    elif isinstance(recorded, list) and isinstance(replayed, list):
+        if len(recorded) != len(replayed):
+            found.append(f'{path}[len {len(recorded)} -> {len(replayed)}]')
+        else:
+            for i, (a, b) in enumerate(zip(recorded, replayed)):
+                found += differences(a, b, ignore, f'{path}[{i}]', limit)
+                if len(found) >= limit:
+                    break
+    elif recorded != replayed:
+        found.append(path)
+    return found[:limit]
+
+
+def compare(entry, status, payload, ignore):
+    if 'status' in entry and entry['status'] != status:
+        return 'status', [f"{entry['status']} -> {status}"]
+    if entry.get('response') is None:
+        return None, []
+    try:
+        replayed = json.loads(payload)
+    except ValueError:
+        return 'body', ['$ (not JSON)']
+    paths = differences(entry['response'], replayed, ignore)
+    return ('body', paths) if paths else (None, [])
+
+
+# ----- Replay -----
+
+class Results:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.status_diffs = defaultdict(int)
+        self.errors = defaultdict(int)
+        self.body_diffs = defaultdict(int)
+        self.examples = []
+        self.max_lag = 0.0
+
+    def record(self, entry, status, latency, lag, kind, detail, keep):
+        route = entry['path']
+        with self.lock:
+            self.latencies[route].append(latency)
+            if is_error(status):
+                self.errors[route] += 1
+            self.max_lag = max(self.max_lag, lag)
+            if kind == 'status':
+                self.status_diffs[route] += 1
+            elif kind == 'body':
+                self.body_diffs[route] += 1
+            if kind and len(self.examples) < keep:
+                self.examples.append((entry['line'], entry['method'], route, kind, detail))
+
+
+def worker(make_target, jobs, results, args, ignore):
+    target = make_target()
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        scheduled, entry = job
+        lag = 0.0
+        if scheduled is not None:
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            lag = max(-delay, 0.0)
+        started = time.perf_counter()
+        status, payload = target.send(entry)
+        latency = time.perf_counter() - started
+        kind, detail = compare(entry, status, payload, ignore) if args.diff else (None, [])
+        results.record(entry, status, latency, lag, kind, detail, args.show_diffs)
+
+
+def replay(entries, make_target, args):
+    ignore = frozenset(key for key in args.ignore.split(',') if key)
+    jobs = queue.Queue()
+    results = Results()
+    threads = [threading.Thread(target=worker, args=(make_target, jobs, results, args, ignore), daemon=True)
+               for _ in range(args.concurrency)]
+    for t in threads:
+        t.start()
+
+    started = time.perf_counter()
+    first_ts = entries[0].get('ts') or 0
+    for entry in entries:
+        scheduled = None
+        if not args.max:
+            scheduled = started + ((entry.get('ts') or first_ts) - first_ts) / args.speed
+            # Stay at most a second ahead of the schedule so the queue stays short
+            ahead = scheduled - time.perf_counter() - 1.0
+            if ahead > 0:
+                time.sleep(ahead)
+        jobs.put((scheduled, entry))
+    for _ in threads:
+        jobs.put(None)
+    for t in threads:
+        t.join()
+    return results, time.perf_counter() - started
+
+
+def summarize(results, elapsed):
+    routes = {}
+    for route, latencies in sorted(results.latencies.items()):
+        latencies.sort()
+        routes[route] = {
+            'requests': len(latencies),
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p95_ms': percentile(latencies, 95) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+            'max_ms': latencies[-1] * 1000,
+            'errors': results.errors[route],
+            'status_diffs': results.status_diffs[route],
+            'body_diffs': results.body_diffs[route],
+        }
+    total = sum(r['requests'] for r in routes.values())
+    return {'elapsed_s': elapsed, 'requests': total, 'rps': total / elapsed if elapsed else 0.0,
+            'max_lag_ms': results.max_lag * 1000, 'routes': routes}
+
+
+def report(summary, results):
+    print("%d requests in %.1fs (%.1f req/s), max schedule lag %.1fms" % (
+        summary['requests'], summary['elapsed_s'], summary['rps'], summary['max_lag_ms']))
+    print("%-34s %8s %9s %9s %9s %9s %7s %8s %8s" % (
+        'route', 'requests', 'p50(ms)', 'p95(ms)', 'p99(ms)', 'max(ms)', 'errors', 'status!=', 'body!='))
+    for route, r in summary['routes'].items():
+        print("%-34s %8d %9.2f %9.2f %9.2f %9.2f %7d %8d %8d" % (
+            route, r['requests'], r['p50_ms'], r['p95_ms'], r['p99_ms'], r['max_ms'],
+            r['errors'], r['status_diffs'], r['body_diffs']))
+    for line_no, method, route, kind, detail in results.examples:
+        print("  line %d %s %s: %s differs at %s" % (line_no, method, route, kind, ', '.join(detail)))
+
+
+def regressions(summary, baseline, max_regression):
+    found = []
+    for route, r in summary['routes'].items():
+        before = baseline.get('routes', {}).get(route)
+        if before and before['p95_ms'] > 0 and r['p95_ms'] > before['p95_ms'] * (1 + max_regression):
+            found.append((route, before['p95_ms'], r['p95_ms']))
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a captured request log against the app")
+    parser.add_argument('log', help="JSONL request log written with TAXI_REQUEST_LOG")
+    parser.add_argument('--url', help="Replay over HTTP to this server instead of in-process")
+    timing = parser.add_mutually_exclusive_group()
+    timing.add_argument('--speed', type=float, default=1.0,
+                        help="Replay the original timing this many times faster (default: original timing)")
+    timing.add_argument('--max', action='store_true', help="Ignore timing and replay as fast as possible")
+    parser.add_argument('--concurrency', type=int, default=16, help="Requests in flight at most")
+    parser.add_argument('--only', type=re.compile, help="Replay only paths matching this regex")
+    parser.add_argument('--exclude', type=re.compile, help="Skip paths matching this regex")
+    parser.add_argument('--no-diff', dest='diff', action='store_false', help="Do not compare responses")
+    parser.add_argument('--ignore', default=DEFAULT_IGNORE, help="Comma-separated keys to ignore when diffing")
+    parser.add_argument('--show-diffs', type=int, default=20, help="Print this many differing responses")
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--json', metavar='PATH', help="Also write the summary as JSON")
+    parser.add_argument('--baseline', metavar='PATH', help="Earlier --json summary to compare p95 against")
+    parser.add_argument('--max-regression', type=float, default=0.2,
+                        help="Allowed p95 slowdown per route against --baseline (default 20%%)")
+    args = parser.parse_args()
+    if args.speed <= 0:
+        parser.error("--speed must be positive")
+
+    try:
+        entries = load(args.log, args.only, args.exclude)
+    except ValueError as e:
+        print(e)
+        return 2
+    if not entries:
+        print("Nothing to replay")
+        return 2
+
+    if args.url:
+        def make_target():
+            return HttpTarget(args.url, args.timeout)
+    else:
+        os.environ.setdefault('TAXI_ADMISSION', '0')
+        from app import app as flask_app
+
+        def make_target():
+            return InProcessTarget(flask_app)
+
+    results, elapsed = replay(entries, make_target, args)
+    summary = summarize(results, elapsed)
+    report(summary, results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(summary, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            slower = regressions(summary, json.load(f), args.max_regression)
+        for route, before, after in slower:
+            print("REGRESSION %s p95 %.2fms -> %.2fms" % (route, before, after))
+        if slower:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,213 @@
+# bench/seed.py
+#
+# Synthetic fleet generator. Fills Manager, Address, Car, Model, Driver,
+# Driver_Model, Client, Client_Address, Rent and Review at a chosen scale,
+# entirely inside Postgres (generate_series), so 10M rents take minutes and
+# no data crosses the network.
+#
+#   python bench/seed.py --drivers 1000 --rents 10000000 --reset
+#
+# The data respects every constraint the app relies on: each driver drives
+# one of their declared models at most once a day, each model is rented at
+# most once a day, and every review is for a driver the client rented.
+# History ends yesterday, so dates from today on are free to book.
+#
+# Names are predictable (driver_<n>, client_<n>, brand_<n>, city_<n>) so the
+# workload driver and the plan check can address rows directly.
+
+import argparse
+import math
+import os
+import sys
+import time
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import analytics
+import schema
+from database import get_connection
+
+TABLES = ('Review', 'Rent', 'CreditCard', 'Client_Address', 'Client', 'Driver_Model', 'Driver',
+          'Model', 'Car', 'Address', 'Manager')
+
+
+def scale(drivers=1000, models=None, models_per_driver=3, clients=10000, rents=100000, reviews=None,
+          cities=20, brands=20, managers=10):
+    """Seeding parameters, with the derived defaults filled in."""
+    models = models or drivers
+    if models < drivers:
+        raise ValueError("Need at least as many models as drivers")
+    params = {
+        'drivers': drivers,
+        'models': models,
+        'models_per_driver': min(models_per_driver, models),
+        'cars': max(models // 10, 1),
+        'brands': brands,
+        'clients': clients,
+        'rents': rents,
+        'reviews': rents // 10 if reviews is None else reviews,
+        'cities': cities,
+        'managers': managers,
+    }
+    params['days'] = max(math.ceil(rents / drivers), 1)
+    return params
+
+
+def seed_catalog(cur, params):
+    cur.execute("""
+        INSERT INTO Manager (ssn, name, email)
+        SELECT 'ssn_' || i, 'Manager ' || i, 'manager_' || i || '@example.com'
+        FROM generate_series(1, %(managers)s) i;
+
+        INSERT INTO Address (nameofroad, number, city)
+        SELECT 'road_' || i, i, 'city_' || (i %% %(cities)s)
+        FROM generate_series(1, %(drivers)s) i;
+
+        INSERT INTO Driver (name, nameofroad, number, city)
+        SELECT 'driver_' || i, 'road_' || i, i, 'city_' || (i %% %(cities)s)
+        FROM generate_series(1, %(drivers)s) i;
+
+        INSERT INTO Car (car_id, brand)
+        SELECT i, 'brand_' || (i %% %(brands)s) FROM generate_series(1, %(cars)s) i;
+
+        -- model m belongs to car 1 + m %% cars
+        INSERT INTO Model (model_id, car_id, color, construction_year, transmission_type)
+        SELECT m, 1 + m %% %(cars)s, (ARRAY['black', 'white', 'red', 'blue', 'silver'])[1 + m %% 5],
+               2005 + m %% 20, CASE WHEN m %% 3 = 0 THEN 'manual' ELSE 'automatic' END
+        FROM generate_series(1, %(models)s) m;
+
+        -- driver d (0-based) declares models d + 1 .. d + models_per_driver, wrapping
+        INSERT INTO Driver_Model (name, model_id, car_id)
+        SELECT 'driver_' || (d + 1), m, 1 + m %% %(cars)s
+        FROM generate_series(0, %(drivers)s - 1) d,
+             LATERAL (SELECT 1 + (d + j) %% %(models)s AS m FROM generate_series(0, %(models_per_driver)s - 1) j) x;
+
+        INSERT INTO Client (email_address, name)
+        SELECT 'client_' || i, 'Client ' || i FROM generate_series(1, %(clients)s) i;
+
+        INSERT INTO Client_Address (client_email, nameofroad, number, city)
+        SELECT 'client_' || i, 'road_' || a, a, 'city_' || (a %% %(cities)s)
+        FROM generate_series(1, %(clients)s) i, LATERAL (SELECT 1 + i %% %(drivers)s AS a) x;
+
+        SELECT setval(pg_get_serial_sequence('car', 'car_id'), %(cars)s);
+        SELECT setval(pg_get_serial_sequence('model', 'model_id'), %(models)s);
+    """, params)
+
+
+# Rent i (0-based): driver d = i %% drivers on day i / drivers, driving their
+# declared model (d + day %% models_per_driver) %% models. Distinct drivers on
+# the same day get distinct models, so both booking constraints hold.
+RENTS_SQL = """
+    INSERT INTO Rent (rent_date, client_email, name, model_id, car_id)
+    SELECT %(first_day)s::date + (i / %(drivers)s)::int,
+           'client_' || (1 + (i * 7919) %% %(clients)s),
+           'driver_' || (1 + i %% %(drivers)s),
+           m, 1 + m %% %(cars)s
+    FROM generate_series(%(start)s::bigint, %(stop)s::bigint - 1) i,
+         LATERAL (SELECT 1 + (i %% %(drivers)s + (i / %(drivers)s) %% %(models_per_driver)s) %% %(models)s AS m) x
+"""
+
+# Review k is for rent k * step, by that rent's client about that rent's driver,
+# written on the evening of the ride
+REVIEWS_SQL = """
+    INSERT INTO Review (name, client_email, message, rating, created_at)
+    SELECT 'driver_' || (1 + i %% %(drivers)s),
+           'client_' || (1 + (i * 7919) %% %(clients)s),
+           'Synthetic review', 1 + (i * 31 + i / 7) %% 5,
+           %(first_day)s::date + (i / %(drivers)s)::int + time '18:00'
+    FROM generate_series(0::bigint, %(reviews)s - 1) k, LATERAL (SELECT k * %(step)s AS i) x
+"""
+
+
+def seed(conn, params, first_day=None, chunk=500000, progress=None):
+    """Insert the synthetic fleet described by params (see scale()).
+
+    Rents go in chunks so each statement-level summary trigger only sees a
+    chunk's transition table. Commits after every chunk.
+    """
+    params = dict(params)
+    params['first_day'] = first_day or date.today() - timedelta(days=params['days'])
+    cur = conn.cursor()
+    try:
+        # A fresh dataset, not a stream of changes: no outbox events
+        cur.execute("SET taxi.outbox_suppress = 'on'")
+        seed_catalog(cur, params)
+        conn.commit()
+        for start in range(0, params['rents'], chunk):
+            stop = min(start + chunk, params['rents'])
+            cur.execute(RENTS_SQL, dict(params, start=start, stop=stop))
+            conn.commit()
+            if progress:
+                progress(stop)
+        if params['reviews'] and params['rents']:
+            cur.execute(REVIEWS_SQL, dict(params, reviews=min(params['reviews'], params['rents']),
+                                          step=max(params['rents'] // params['reviews'], 1)))
+        cur.execute("ANALYZE")
+        conn.commit()
+        return params
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        # The connection goes back to the pool
+        cur.execute("RESET taxi.outbox_suppress")
+        conn.commit()
+        cur.close()
+
+
+def reset(conn):
+    cur = conn.cursor()
+    try:
+        cur.execute("TRUNCATE %s RESTART IDENTITY CASCADE" % ', '.join(TABLES))
+        analytics.refresh(conn)
+    finally:
+        cur.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Seed the database with a synthetic fleet")
+    parser.add_argument('--drivers', type=int, default=1000)
+    parser.add_argument('--models', type=int, help="Defaults to one model per driver")
+    parser.add_argument('--models-per-driver', type=int, default=3)
+    parser.add_argument('--clients', type=int, default=10000)
+    parser.add_argument('--rents', type=int, default=100000)
+    parser.add_argument('--reviews', type=int, help="Defaults to one review per ten rents")
+    parser.add_argument('--cities', type=int, default=20)
+    parser.add_argument('--chunk', type=int, default=500000, help="Rents per INSERT statement")
+    parser.add_argument('--reset', action='store_true', help="Empty every table first (destroys existing data)")
+    args = parser.parse_args()
+
+    params = scale(drivers=args.drivers, models=args.models, models_per_driver=args.models_per_driver,
+                   clients=args.clients, rents=args.rents, reviews=args.reviews, cities=args.cities)
+
+    conn = get_connection()
+    try:
+        schema.migrate(conn)
+        cur = conn.cursor()
+        cur.execute("SELECT EXISTS (SELECT 1 FROM Driver) OR EXISTS (SELECT 1 FROM Client)")
+        has_data = cur.fetchone()[0]
+        cur.close()
+        conn.rollback()
+        if has_data and not args.reset:
+            print("The database already has drivers or clients; rerun with --reset to replace them")
+            return 2
+        if args.reset:
+            reset(conn)
+
+        started = time.perf_counter()
+
+        def progress(done):
+            print("  %d/%d rents (%.0fs)" % (done, params['rents'], time.perf_counter() - started))
+
+        params = seed(conn, params, progress=progress)
+        print("Seeded %(drivers)d drivers, %(models)d models, %(clients)d clients, %(rents)d rents "
+              "and %(reviews)d reviews over %(days)d days from %(first_day)s" % params)
+        print("Done in %.0fs" % (time.perf_counter() - started))
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,302 @@
+# bench/workload.py
+#
+# Open-loop workload driver. Sends a weighted mix of client logins,
+# availability lookups, bookings, rent history pages and manager dashboards
+# to a running server at a fixed target rate, then reports throughput,
+# p50/p95/p99 latency per endpoint and how bookings turned out.
+#
+#   python bench/seed.py --drivers 1000 --rents 10000000 --reset
+#   TAXI_ADMISSION=0 python serve.py &
+#   python bench/workload.py --rps 300 --duration 60
+#
+# Requests are scheduled at fixed intervals whether or not earlier ones have
+# answered, and latency is measured from the scheduled send time, so a
+# server that falls behind shows it in the tail instead of being hidden by a
+# slower request rate. Request arguments (clients, models, cities) are
+# sampled from the database the server uses. Requests carry no session, so
+# run the server without admission control: rejections (429, 503) count as
+# errors, not as answered requests.
+
+import argparse
+import http.client
+import json
+import os
+import queue
+import random
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import date, timedelta
+from urllib.parse import urlencode, urlsplit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from database import get_connection
+
+DEFAULT_MIX = 'login=20,available=25,book=10,rents=30,dashboards=15'
+
+DASHBOARDS = ('top_k_clients', 'model_usage', 'driver_stats', 'clients_by_city', 'clients_by_cities')
+
+
+def load_fixture(sample):
+    conn = get_connection()
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT email_address FROM Client ORDER BY random() LIMIT %s", (sample,))
+        clients = [row[0] for row in cur.fetchall()]
+        cur.execute("SELECT DISTINCT model_id, car_id FROM Driver_Model")
+        models = cur.fetchall()
+        cur.execute("SELECT DISTINCT city FROM Driver")
+        cities = [row[0] for row in cur.fetchall()]
+        return {'clients': clients, 'models': models, 'cities': cities}
+    finally:
+        cur.close()
+        conn.close()
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        kind, _, weight = part.partition('=')
+        if kind not in OPERATIONS:
+            raise ValueError(f"Unknown operation {kind!r}; choose from {', '.join(OPERATIONS)}")
+        mix[kind] = float(weight or 1)
+    return mix
+
+
+# ----- Operations -----
+# Each returns (endpoint label, method, path, JSON body or None)
+
+def op_login(fixture, rng, args):
+    return '/client/login', 'POST', '/client/login', {'email_address': rng.choice(fixture['clients'])}
+
+
+def op_available(fixture, rng, args):
+    day = date.today() + timedelta(days=rng.randrange(args.booking_days))
+    return '/client/view_available_models', 'POST', '/client/view_available_models', {'rent_date': day.isoformat()}
+
+
+def op_book(fixture, rng, args):
+    day = date.today() + timedelta(days=rng.randrange(args.booking_days))
+    model_id, car_id = rng.choice(fixture['models'])
+    # Ids as strings, the way Main.html sends them
+    body = {'rent_date': day.isoformat(), 'client_email': rng.choice(fixture['clients']),
+            'model_id': str(model_id), 'car_id': str(car_id)}
+    return '/client/book_rent', 'POST', '/client/book_rent', body
+
+
+def op_rents(fixture, rng, args):
+    return '/client/view_rents', 'POST', '/client/view_rents', {'client_email': rng.choice(fixture['clients']),
+                                                                 'limit': args.page_size}
+
+
+def op_dashboards(fixture, rng, args):
+    name = rng.choice(DASHBOARDS)
+    query = {}
+    if name == 'top_k_clients':
+        query = {'k': 10}
+    elif name == 'driver_stats':
+        query = {'limit': 50}
+        if fixture['cities'] and rng.random() < 0.5:
+            query['city'] = rng.choice(fixture['cities'])
+    elif name == 'clients_by_city' and fixture['cities']:
+        query = {'c1': rng.choice(fixture['cities']), 'c2': rng.choice(fixture['cities'])}
+    elif name == 'clients_by_cities' and fixture['cities']:
+        sample = min(5, len(fixture['cities']))
+        query = {'client_cities': ','.join(rng.sample(fixture['cities'], sample)),
+                 'driver_cities': ','.join(rng.sample(fixture['cities'], sample))}
+    path = '/manager/' + name
+    return path, 'GET', path + ('?' + urlencode(query) if query else ''), None
+
+
+OPERATIONS = {
+    'login': op_login,
+    'available': op_available,
+    'book': op_book,
+    'rents': op_rents,
+    'dashboards': op_dashboards,
+}
+
+
+# ----- Load generation -----
+
+class Results:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(Counter)
+        self.bookings = Counter()
+
+    def record(self, endpoint, status, latency, body):
+        with self.lock:
+            self.latencies[endpoint].append(latency)
+            self.statuses[endpoint][status] += 1
+            if endpoint == '/client/book_rent':
+                if status == 200:
+                    self.bookings['booked'] += 1
+                elif is_error(status):
+                    self.bookings['failed'] += 1
+                else:
+                    try:
+                        reason = json.loads(body).get('reason') or 'error'
+                    except (ValueError, AttributeError):
+                        reason = 'error'
+                    self.bookings[reason] += 1
+
+
+def worker(target, jobs, results, timeout):
+    conn = None
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        scheduled, measured, (endpoint, method, path, body) = job
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        if conn is None:
+            conn = http.client.HTTPConnection(target.hostname, target.port or 80, timeout=timeout)
+        try:
+            if body is None:
+                conn.request(method, path)
+            else:
+                conn.request(method, path, json.dumps(body), {'Content-Type': 'application/json'})
+            response = conn.getresponse()
+            payload = response.read()
+            status = response.status
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            conn = None
+            payload, status = b'', 'io'
+        if measured:
+            results.record(endpoint, status, time.perf_counter() - scheduled, payload)
+    if conn is not None:
+        conn.close()
+
+
+def run(target, rps, duration, warmup, concurrency, mix, fixture, args):
+    rng = random.Random(args.seed)
+    kinds = list(mix)
+    weights = [mix[kind] for kind in kinds]
+    jobs = queue.Queue()
+    results = Results()
+    threads = [threading.Thread(target=worker, args=(target, jobs, results, args.timeout), daemon=True)
+               for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+
+    started = time.perf_counter()
+    skip = int(rps * warmup)
+    for i in range(skip + int(rps * duration)):
+        scheduled = started + i / rps
+        # Stay at most a second ahead of the schedule so the queue stays short
+        ahead = scheduled - time.perf_counter() - 1.0
+        if ahead > 0:
+            time.sleep(ahead)
+        kind = rng.choices(kinds, weights)[0]
+        jobs.put((scheduled, i >= skip, OPERATIONS[kind](fixture, rng, args)))
+    for _ in threads:
+        jobs.put(None)
+    for t in threads:
+        t.join()
+    return results, time.perf_counter() - started - warmup
+
+
+def percentile(values, p):
+    # values sorted; nearest-rank
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(int(round(p / 100.0 * len(values))) - 1, 0))]
+
+
+def is_error(status):
+    # Shed by admission control (429, 503) or failed outright; not an answer
+    return status == 'io' or status == 429 or status >= 500
+
+
+def summarize(results, elapsed):
+    endpoints = {}
+    for endpoint, latencies in sorted(results.latencies.items()):
+        latencies.sort()
+        statuses = results.statuses[endpoint]
+        endpoints[endpoint] = {
+            'requests': len(latencies),
+            'rps': len(latencies) / elapsed,
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p95_ms': percentile(latencies, 95) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+            'max_ms': latencies[-1] * 1000,
+            'errors': sum(n for status, n in statuses.items() if is_error(status)),
+            'statuses': {str(status): n for status, n in statuses.items()},
+        }
+    attempts = sum(results.bookings.values())
+    return {
+        'elapsed_s': elapsed,
+        'requests': sum(e['requests'] for e in endpoints.values()),
+        'rps': sum(e['requests'] for e in endpoints.values()) / elapsed,
+        'endpoints': endpoints,
+        'bookings': {
+            'attempts': attempts,
+            'outcomes': dict(results.bookings),
+            'conflict_rate': ((attempts - results.bookings['booked'] - results.bookings['failed']) / attempts
+                              if attempts else 0.0),
+        },
+    }
+
+
+def report(summary, target_rps):
+    print("target %.0f req/s, achieved %.1f req/s over %.1fs (%d requests)" % (
+        target_rps, summary['rps'], summary['elapsed_s'], summary['requests']))
+    print("%-34s %8s %8s %9s %9s %9s %9s %7s" % (
+        'endpoint', 'requests', 'req/s', 'p50(ms)', 'p95(ms)', 'p99(ms)', 'max(ms)', 'errors'))
+    for endpoint, e in summary['endpoints'].items():
+        print("%-34s %8d %8.1f %9.2f %9.2f %9.2f %9.2f %7d" % (
+            endpoint, e['requests'], e['rps'], e['p50_ms'], e['p95_ms'], e['p99_ms'], e['max_ms'], e['errors']))
+    bookings = summary['bookings']
+    if bookings['attempts']:
+        outcomes = ', '.join('%s=%d' % item for item in sorted(bookings['outcomes'].items()))
+        print("bookings: %d attempts, conflict rate %.1f%% (%s)" % (
+            bookings['attempts'], bookings['conflict_rate'] * 100, outcomes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Drive a running server with a mixed workload at a target rate")
+    parser.add_argument('--url', default='http://127.0.0.1:5050', help="Server to load")
+    parser.add_argument('--rps', type=float, default=100, help="Target requests per second")
+    parser.add_argument('--duration', type=float, default=30, help="Seconds to measure for")
+    parser.add_argument('--warmup', type=float, default=5,
+                        help="Seconds of load before measuring (index loads, pool growth)")
+    parser.add_argument('--concurrency', type=int, default=64, help="Maximum requests in flight")
+    parser.add_argument('--mix', default=DEFAULT_MIX, help="Weighted operations (default %(default)s)")
+    parser.add_argument('--booking-days', type=int, default=30,
+                        help="Bookings and availability lookups pick dates this many days ahead")
+    parser.add_argument('--page-size', type=int, default=20, help="Rent history page size")
+    parser.add_argument('--clients', type=int, default=1000, help="Clients to sample as request arguments")
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--seed', type=int, help="Random seed; fixed seeds repeat the same bookings")
+    parser.add_argument('--json', metavar='PATH', help="Also write the summary as JSON")
+    args = parser.parse_args()
+
+    try:
+        mix = parse_mix(args.mix)
+    except ValueError as e:
+        parser.error(str(e))
+    target = urlsplit(args.url)
+
+    fixture = load_fixture(args.clients)
+    if not fixture['clients'] or not fixture['models']:
+        print("Need Client and Driver_Model rows to run; seed them with bench/seed.py")
+        return 2
+
+    results, elapsed = run(target, args.rps, args.duration, args.warmup, args.concurrency, mix, fixture, args)
+    summary = summarize(results, elapsed)
+    report(summary, args.rps)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(summary, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
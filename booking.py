@@ -0,0 +1,344 @@
+# booking.py
+
+import random
+import time
+
+import psycopg2
+import psycopg2.errors
+import psycopg2.extras
+
+import queries
+from availability import to_date
+
+MAX_ATTEMPTS = 5
+MAX_BATCH_SIZE = 200
+
+# Unique indexes that make a double booking impossible at the storage layer:
+# a model can be rented once per day and a driver can drive once per day.
+BOOKING_CONSTRAINTS = """
+    CREATE UNIQUE INDEX IF NOT EXISTS rent_model_date_uniq ON Rent (model_id, car_id, rent_date);
+    CREATE UNIQUE INDEX IF NOT EXISTS rent_driver_date_uniq ON Rent (name, rent_date);
+"""
+
+# Checks the model, picks a free driver and inserts the rent in one statement.
+# ON CONFLICT DO NOTHING turns a lost race into "no row inserted" instead of
+# an error, and the diagnostic columns tell us why nothing was inserted.
+BOOK_RENT_SQL = """
+    WITH model AS (
+        SELECT m.model_id, m.car_id
+        FROM Model m
+        WHERE m.model_id = %(model_id)s AND m.car_id = %(car_id)s
+    ),
+    model_taken AS (
+        SELECT 1
+        FROM Rent r
+        WHERE r.model_id = %(model_id)s AND r.car_id = %(car_id)s
+          AND r.rent_date = %(rent_date)s
+    ),
+    driver AS (
+        SELECT dm.name
+        FROM Driver_Model dm
+        WHERE dm.model_id = %(model_id)s AND dm.car_id = %(car_id)s
+          AND NOT EXISTS (
+              SELECT 1 FROM Rent r
+              WHERE r.name = dm.name
+                AND r.rent_date = %(rent_date)s
+          )
+        ORDER BY array_position(%(preferred_drivers)s::text[], dm.name::text), dm.name
+        LIMIT 1
+    ),
+    inserted AS (
+        INSERT INTO Rent (rent_date, client_email, name, model_id, car_id)
+        SELECT %(rent_date)s, %(client_email)s, driver.name, model.model_id, model.car_id
+        FROM model, driver
+        WHERE NOT EXISTS (SELECT 1 FROM model_taken)
+        ON CONFLICT DO NOTHING
+        RETURNING rent_id, name
+    )
+    SELECT
+        EXISTS (SELECT 1 FROM model) AS model_exists,
+        EXISTS (SELECT 1 FROM model_taken) AS model_taken,
+        (SELECT name FROM driver) AS candidate_driver,
+        (SELECT rent_id FROM inserted) AS rent_id,
+        (SELECT name FROM inserted) AS driver_name
+"""
+
+queries.register('book_rent', BOOK_RENT_SQL)
+
+# Lookups that plan a batch: which models exist, who can drive them, and
+# what is already booked on the batch's dates
+queries.register('batch_existing_models', """
+    SELECT m.model_id, m.car_id
+    FROM Model m
+    JOIN unnest(%s::int[], %s::int[]) AS req(model_id, car_id)
+      ON m.model_id = req.model_id AND m.car_id = req.car_id
+""")
+queries.register('batch_capable_drivers', """
+    SELECT dm.model_id, dm.car_id, dm.name
+    FROM Driver_Model dm
+    JOIN unnest(%s::int[], %s::int[]) AS req(model_id, car_id)
+      ON dm.model_id = req.model_id AND dm.car_id = req.car_id
+    ORDER BY dm.name
+""")
+queries.register('batch_booked', "SELECT rent_date, model_id, car_id, name FROM Rent WHERE rent_date = ANY(%s)")
+
+CONFLICT_MESSAGES = {
+    'model_not_found': "Car model does not exist",
+    'model_booked': "Car model is not available on selected date",
+    'no_driver': "No available driver for this model on selected date",
+    'contention': "Too many concurrent bookings for this model, please retry",
+    'invalid': "rent_date, model_id and car_id are required",
+    'duplicate_in_batch': "Car model is requested more than once for this date",
+    'batch_aborted': "Not booked because another item in the batch failed",
+}
+
+# Errors that mean "another transaction got in the way, try again".
+RETRYABLE_ERRORS = (
+    psycopg2.errors.SerializationFailure,
+    psycopg2.errors.DeadlockDetected,
+    psycopg2.errors.UniqueViolation,
+)
+
+
+def backoff_delay(attempt):
+    return random.uniform(0, 0.005 * (2 ** attempt))
+
+
+def _backoff(attempt):
+    time.sleep(backoff_delay(attempt))
+
+
+def book_rent(conn, rent_date, client_email, model_id, car_id, preferred_drivers=None,
+              max_attempts=MAX_ATTEMPTS):
+    """Atomically claim a model and a free driver for rent_date.
+
+    The first free driver in preferred_drivers wins (see assignment.py);
+    drivers missing from it come last, alphabetically.
+
+    Commits on success and rolls back otherwise. Returns a dict with
+    'booked' set; on success it carries 'rent_id' and 'driver_name', on
+    failure a 'reason' key from CONFLICT_MESSAGES and its 'error' text.
+    """
+    params = {
+        'rent_date': rent_date,
+        'client_email': client_email,
+        'model_id': model_id,
+        'car_id': car_id,
+        'preferred_drivers': list(preferred_drivers or []),
+    }
+    cur = conn.cursor()
+    try:
+        for attempt in range(1, max_attempts + 1):
+            try:
+                queries.execute(cur, 'book_rent', params)
+                model_exists, model_taken, candidate, rent_id, driver_name = cur.fetchone()
+            except RETRYABLE_ERRORS:
+                conn.rollback()
+                _backoff(attempt)
+                continue
+
+            result = booking_outcome(model_exists, model_taken, candidate, rent_id, driver_name, attempt)
+            if result is not None and result['booked']:
+                conn.commit()
+                return result
+            conn.rollback()
+            if result is not None:
+                return result
+            _backoff(attempt)
+
+        return contention_result(max_attempts)
+    finally:
+        cur.close()
+
+
+def booking_outcome(model_exists, model_taken, candidate, rent_id, driver_name, attempt):
+    """Turn the diagnostic row of BOOK_RENT_SQL into a result, or None to retry."""
+    if rent_id is not None:
+        return {'booked': True, 'rent_id': rent_id, 'driver_name': driver_name, 'attempts': attempt}
+    if not model_exists:
+        reason = 'model_not_found'
+    elif model_taken:
+        reason = 'model_booked'
+    elif candidate is None:
+        reason = 'no_driver'
+    else:
+        # The model and a driver looked free, but a concurrent booking
+        # claimed one of them first. Re-read and try again.
+        return None
+    return {'booked': False, 'reason': reason, 'error': CONFLICT_MESSAGES[reason], 'attempts': attempt}
+
+
+def contention_result(attempts):
+    return {'booked': False, 'reason': 'contention', 'error': CONFLICT_MESSAGES['contention'], 'attempts': attempts}
+
+
+# -------------------- Batch booking --------------------
+
+def _match_drivers(items, candidates):
+    """Maximum bipartite matching of items to drivers (Kuhn's algorithm).
+
+    items is a list of item keys, candidates maps each key to the drivers
+    who could take it. Returns {item: driver} for as many items as possible,
+    so an early item never starves a later one by grabbing the only driver
+    the later item could use.
+    """
+    owner = {}  # driver -> item
+
+    def augment(item, seen):
+        for driver in candidates[item]:
+            if driver in seen:
+                continue
+            seen.add(driver)
+            if driver not in owner or augment(owner[driver], seen):
+                owner[driver] = item
+                return True
+        return False
+
+    for item in items:
+        augment(item, set())
+    return {item: driver for driver, item in owner.items()}
+
+
+def _plan_batch(cur, items, rank=None):
+    """Decide which items can be booked and by whom, from one snapshot.
+
+    Returns (assignments, failures): assignments maps item index to driver
+    name, failures maps item index to a reason. rank(drivers, rent_date,
+    model_id, car_id), if given, orders each item's candidate drivers so the
+    matching tries preferred drivers first.
+    """
+    dates = sorted({item['rent_date'] for item in items})
+    models = sorted({(item['model_id'], item['car_id']) for item in items})
+
+    queries.execute(cur, 'batch_existing_models', ([m[0] for m in models], [m[1] for m in models]))
+    existing = set(cur.fetchall())
+
+    queries.execute(cur, 'batch_capable_drivers', ([m[0] for m in models], [m[1] for m in models]))
+    capable = {}
+    for model_id, car_id, name in cur.fetchall():
+        capable.setdefault((model_id, car_id), []).append(name)
+
+    queries.execute(cur, 'batch_booked', (dates,))
+    booked_models = set()
+    busy_drivers = set()
+    for rent_date, model_id, car_id, name in cur.fetchall():
+        booked_models.add((rent_date, model_id, car_id))
+        busy_drivers.add((rent_date, name))
+
+    failures = {}
+    by_date = {}
+    seen = set()
+    for i, item in enumerate(items):
+        key = (item['rent_date'], item['model_id'], item['car_id'])
+        if (item['model_id'], item['car_id']) not in existing:
+            failures[i] = 'model_not_found'
+        elif key in booked_models:
+            failures[i] = 'model_booked'
+        elif key in seen:
+            failures[i] = 'duplicate_in_batch'
+        else:
+            seen.add(key)
+            by_date.setdefault(item['rent_date'], []).append(i)
+
+    # Drivers can only be shared between items on the same day, so each
+    # date is an independent matching problem.
+    assignments = {}
+    for rent_date, indexes in by_date.items():
+        candidates = {}
+        for i in indexes:
+            model_id, car_id = items[i]['model_id'], items[i]['car_id']
+            free = [name for name in capable.get((model_id, car_id), []) if (rent_date, name) not in busy_drivers]
+            candidates[i] = rank(free, rent_date, model_id, car_id) if rank else free
+        matched = _match_drivers(indexes, candidates)
+        for i in indexes:
+            if i in matched:
+                assignments[i] = matched[i]
+            else:
+                failures[i] = 'no_driver'
+    return assignments, failures
+
+
+def book_batch(conn, client_email, rents, all_or_nothing=True, rank=None, max_attempts=MAX_ATTEMPTS):
+    """Book several (rent_date, model_id, car_id) items in one transaction.
+
+    Drivers are assigned by a maximum matching over the whole batch. With
+    all_or_nothing nothing is written unless every item can be booked;
+    otherwise every bookable item is booked. Returns one result dict per
+    input item, in input order, shaped like book_rent()'s result.
+    """
+    items = []
+    results = [None] * len(rents)
+    for i, rent in enumerate(rents):
+        try:
+            items.append({
+                'index': i,
+                'rent_date': to_date(rent['rent_date']),
+                'model_id': int(rent['model_id']),
+                'car_id': int(rent['car_id']),
+            })
+        except (KeyError, TypeError, ValueError):
+            results[i] = {'booked': False, 'reason': 'invalid', 'error': CONFLICT_MESSAGES['invalid']}
+
+    def fail(i, reason):
+        results[items[i]['index']] = {'booked': False, 'reason': reason, 'error': CONFLICT_MESSAGES[reason]}
+
+    if all_or_nothing and any(r is not None for r in results):
+        for i in range(len(items)):
+            fail(i, 'batch_aborted')
+        return results
+    if not items:
+        return results
+
+    cur = conn.cursor()
+    try:
+        for attempt in range(1, max_attempts + 1):
+            try:
+                assignments, failures = _plan_batch(cur, items, rank)
+
+                if failures and all_or_nothing:
+                    conn.rollback()
+                    for i in range(len(items)):
+                        fail(i, failures.get(i, 'batch_aborted'))
+                    return results
+
+                rows = [(items[i]['rent_date'], client_email, driver, items[i]['model_id'], items[i]['car_id'])
+                        for i, driver in sorted(assignments.items())]
+                inserted = []
+                if rows:
+                    inserted = psycopg2.extras.execute_values(cur, """
+                        INSERT INTO Rent (rent_date, client_email, name, model_id, car_id)
+                        VALUES %s
+                        ON CONFLICT DO NOTHING
+                        RETURNING rent_id, rent_date, name
+                    """, rows, fetch=True, page_size=len(rows))
+            except RETRYABLE_ERRORS:
+                conn.rollback()
+                _backoff(attempt)
+                continue
+
+            if len(inserted) < len(rows):
+                # A concurrent booking took a model or driver we planned to
+                # use; re-plan against a fresh snapshot.
+                conn.rollback()
+                _backoff(attempt)
+                continue
+
+            conn.commit()
+            rent_ids = {(rent_date, name): rent_id for rent_id, rent_date, name in inserted}
+            for i, driver in assignments.items():
+                item = items[i]
+                results[item['index']] = {
+                    'booked': True,
+                    'rent_id': rent_ids[(item['rent_date'], driver)],
+                    'driver_name': driver,
+                    'attempts': attempt,
+                }
+            for i, reason in failures.items():
+                fail(i, reason)
+            return results
+
+        for i in range(len(items)):
+            fail(i, 'contention')
+        return results
+    finally:
+        cur.close()
@@ -0,0 +1,494 @@
+# bulk.py
+#
+# Bulk import and export of cars, models, drivers, driver model declarations
+# and clients through COPY. An import streams CSV (with a header row) or
+# NDJSON straight into a temporary staging table, then merges it into the
+# real tables with a handful of set-based statements, all in one
+# transaction:
+#
+#   - addresses used by drivers and clients are created once each, however
+#     many rows share them, and existing ones are reused; a driver row that
+#     is skipped creates none
+#   - rows whose key already exists are skipped, or updated with
+#     on_conflict='update'; when a key repeats within the file the last
+#     row wins
+#   - rows missing a required field, or referencing a car, model or driver
+#     that does not exist, are rejected and reported by line number
+#   - cars and models without an id get a new one from their sequence
+#   - a single BulkImported outbox event is recorded instead of one per row
+#
+# Malformed input (a bad number, broken JSON) aborts the whole import with
+# the line Postgres complained about. Exports stream COPY TO STDOUT in the
+# same formats, so an export can be imported back as is.
+#
+#   python bulk.py import drivers drivers.csv
+#   python bulk.py import clients clients.ndjson --on-conflict update
+#   python bulk.py export models --format ndjson > models.ndjson
+
+import argparse
+import csv
+import io
+import os
+import queue
+import sys
+import threading
+
+import psycopg2
+
+import outbox
+
+FORMATS = ('csv', 'ndjson')
+CONFLICT_MODES = ('skip', 'update')
+MAX_REPORTED_LINES = 20
+
+
+class BulkError(ValueError):
+    """The import was rejected as a whole (bad header, malformed data)."""
+
+
+# Staging columns per entity, (name, type). Listed first are the required ones.
+ENTITIES = {
+    'cars': {
+        'columns': [('brand', 'varchar(50)'), ('car_id', 'integer')],
+        'required': ['brand'],
+        'export': "SELECT car_id, brand FROM Car ORDER BY car_id",
+    },
+    'models': {
+        'columns': [('car_id', 'integer'), ('model_id', 'integer'), ('color', 'varchar(30)'),
+                    ('construction_year', 'integer'), ('transmission_type', 'varchar(20)')],
+        'required': ['car_id'],
+        'export': """
+            SELECT model_id, car_id, color, construction_year, transmission_type
+            FROM Model ORDER BY model_id, car_id
+        """,
+    },
+    'drivers': {
+        'columns': [('name', 'varchar(100)'), ('nameofroad', 'varchar(100)'), ('number', 'integer'),
+                    ('city', 'varchar(50)')],
+        'required': ['name', 'nameofroad', 'number', 'city'],
+        'export': "SELECT name, nameofroad, number, city FROM Driver ORDER BY name",
+    },
+    'driver_models': {
+        'columns': [('name', 'varchar(100)'), ('model_id', 'integer'), ('car_id', 'integer')],
+        'required': ['name', 'model_id', 'car_id'],
+        'export': "SELECT name, model_id, car_id FROM Driver_Model ORDER BY name, model_id, car_id",
+    },
+    'clients': {
+        # The address is optional; a client with several addresses is one row per address
+        'columns': [('email_address', 'varchar(100)'), ('name', 'varchar(100)'), ('nameofroad', 'varchar(100)'),
+                    ('number', 'integer'), ('city', 'varchar(50)')],
+        'required': ['email_address', 'name'],
+        'export': """
+            SELECT c.email_address, c.name, ca.nameofroad, ca.number, ca.city
+            FROM Client c
+            LEFT JOIN Client_Address ca ON ca.client_email = c.email_address
+            ORDER BY c.email_address, ca.nameofroad, ca.number, ca.city
+        """,
+    },
+}
+
+# Rows that can be merged, per entity; everything else staged is rejected
+VALID_ROWS = {
+    'cars': "brand IS NOT NULL",
+    'models': "car_id IS NOT NULL AND EXISTS (SELECT 1 FROM Car c WHERE c.car_id = s.car_id)",
+    'drivers': "name IS NOT NULL AND nameofroad IS NOT NULL AND number IS NOT NULL AND city IS NOT NULL",
+    'driver_models': """
+        EXISTS (SELECT 1 FROM Driver d WHERE d.name = s.name)
+        AND EXISTS (SELECT 1 FROM Model m WHERE m.model_id = s.model_id AND m.car_id = s.car_id)
+    """,
+    'clients': """
+        email_address IS NOT NULL AND name IS NOT NULL
+        AND (nameofroad IS NULL) = (number IS NULL) AND (number IS NULL) = (city IS NULL)
+    """,
+}
+
+# Each statement reads the valid staged rows from bulk_valid and returns
+# (inserted, updated). {conflict} is filled in from CONFLICT_ACTIONS.
+MERGE_SQL = {
+    'cars': [
+        """
+        WITH merged AS (
+            INSERT INTO Car (car_id, brand)
+            SELECT DISTINCT ON (car_id) car_id, brand FROM bulk_valid
+            WHERE car_id IS NOT NULL ORDER BY car_id, line DESC
+            ON CONFLICT (car_id) DO {conflict}
+            RETURNING xmax = 0 AS inserted
+        )
+        SELECT COUNT(*) FILTER (WHERE inserted), COUNT(*) FILTER (WHERE NOT inserted) FROM merged
+        """,
+        """
+        WITH merged AS (
+            INSERT INTO Car (brand) SELECT brand FROM bulk_valid WHERE car_id IS NULL ORDER BY line
+            RETURNING 1
+        )
+        SELECT COUNT(*), 0 FROM merged
+        """,
+    ],
+    'models': [
+        """
+        WITH merged AS (
+            INSERT INTO Model (model_id, car_id, color, construction_year, transmission_type)
+            SELECT DISTINCT ON (model_id, car_id) model_id, car_id, color, construction_year, transmission_type
+            FROM bulk_valid WHERE model_id IS NOT NULL ORDER BY model_id, car_id, line DESC
+            ON CONFLICT (model_id, car_id) DO {conflict}
+            RETURNING xmax = 0 AS inserted
+        )
+        SELECT COUNT(*) FILTER (WHERE inserted), COUNT(*) FILTER (WHERE NOT inserted) FROM merged
+        """,
+        """
+        WITH merged AS (
+            INSERT INTO Model (car_id, color, construction_year, transmission_type)
+            SELECT car_id, color, construction_year, transmission_type
+            FROM bulk_valid WHERE model_id IS NULL ORDER BY line
+            RETURNING 1
+        )
+        SELECT COUNT(*), 0 FROM merged
+        """,
+    ],
+    'drivers': [
+        """
+        WITH merged AS (
+            INSERT INTO Driver (name, nameofroad, number, city)
+            SELECT DISTINCT ON (name) name, nameofroad, number, city FROM bulk_valid ORDER BY name, line DESC
+            ON CONFLICT (name) DO {conflict}
+            RETURNING xmax = 0 AS inserted
+        )
+        SELECT COUNT(*) FILTER (WHERE inserted), COUNT(*) FILTER (WHERE NOT inserted) FROM merged
+        """,
+    ],
+    'driver_models': [
+        """
+        WITH merged AS (
+            INSERT INTO Driver_Model (name, model_id, car_id)
+            SELECT DISTINCT name, model_id, car_id FROM bulk_valid
+            ON CONFLICT DO NOTHING
+            RETURNING 1
+        )
+        SELECT COUNT(*), 0 FROM merged
+        """,
+    ],
+    'clients': [
+        """
+        WITH merged AS (
+            INSERT INTO Client (email_address, name)
+            SELECT DISTINCT ON (email_address) email_address, name FROM bulk_valid
+            ORDER BY email_address, line DESC
+            ON CONFLICT (email_address) DO {conflict}
+            RETURNING xmax = 0 AS inserted
+        )
+        SELECT COUNT(*) FILTER (WHERE inserted), COUNT(*) FILTER (WHERE NOT inserted) FROM merged
+        """,
+    ],
+}
+
+# Client address links are only ever added; they carry no data to update
+CLIENT_ADDRESS_SQL = """
+    WITH linked AS (
+        INSERT INTO Client_Address (client_email, nameofroad, number, city)
+        SELECT DISTINCT email_address, nameofroad, number, city FROM bulk_valid WHERE city IS NOT NULL
+        ON CONFLICT DO NOTHING
+        RETURNING 1
+    )
+    SELECT COUNT(*) FROM linked
+"""
+
+CONFLICT_ACTIONS = {
+    'cars': "UPDATE SET brand = EXCLUDED.brand",
+    'models': """UPDATE SET color = EXCLUDED.color, construction_year = EXCLUDED.construction_year,
+                            transmission_type = EXCLUDED.transmission_type""",
+    'drivers': "UPDATE SET nameofroad = EXCLUDED.nameofroad, number = EXCLUDED.number, city = EXCLUDED.city",
+    'clients': "UPDATE SET name = EXCLUDED.name",
+}
+
+# Entities whose rows reference Address. {rows} are the staged rows whose
+# address gets used, from ADDRESS_ROWS.
+ADDRESS_SQL = """
+    WITH created AS (
+        INSERT INTO Address (nameofroad, number, city)
+        SELECT DISTINCT nameofroad, number, city FROM {rows} WHERE city IS NOT NULL
+        ON CONFLICT DO NOTHING
+        RETURNING 1
+    )
+    SELECT COUNT(*) FROM created
+"""
+
+# Per entity and conflict mode. A driver is written from the last row for
+# its name, and with on_conflict='skip' not at all if the name exists, so
+# only those rows' addresses are created; any other would be referenced by
+# nothing. Every valid client row links its address.
+ADDRESS_ROWS = {
+    'drivers': {
+        'skip': """(
+            SELECT DISTINCT ON (name) * FROM bulk_valid s
+            WHERE NOT EXISTS (SELECT 1 FROM Driver d WHERE d.name = s.name)
+            ORDER BY name, line DESC
+        ) written""",
+        'update': "(SELECT DISTINCT ON (name) * FROM bulk_valid ORDER BY name, line DESC) written",
+    },
+    'clients': {'skip': "bulk_valid", 'update': "bulk_valid"},
+}
+
+# Serial keys an import may set explicitly, so the sequence must be moved past them
+SEQUENCES = {'cars': ('car', 'car_id'), 'models': ('model', 'model_id')}
+
+
+def _columns(entity):
+    try:
+        return ENTITIES[entity]['columns']
+    except KeyError:
+        raise BulkError(f"Unknown entity {entity!r}; choose from {', '.join(ENTITIES)}")
+
+
+def _create_staging(cur, entity):
+    columns = ', '.join(f'{name} {type}' for name, type in _columns(entity))
+    cur.execute(f"CREATE TEMP TABLE bulk_stage (line bigint GENERATED ALWAYS AS IDENTITY, {columns}) "
+                "ON COMMIT DROP")
+
+
+def _copy_csv(cur, entity, stream):
+    header = stream.readline()
+    if isinstance(header, bytes):
+        header = header.decode('utf-8-sig')
+    columns = [name.strip() for name in next(csv.reader([header]), [])]
+    known = [name for name, _ in _columns(entity)]
+    unknown = [name for name in columns if name not in known]
+    if unknown or not columns:
+        raise BulkError(f"Unknown CSV columns {unknown}; expected some of {known}")
+    missing = [name for name in ENTITIES[entity]['required'] if name not in columns]
+    if missing:
+        raise BulkError(f"CSV header is missing required columns {missing}")
+    if len(set(columns)) != len(columns):
+        raise BulkError("CSV header repeats a column")
+    cur.copy_expert(f"COPY bulk_stage ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", stream)
+    return 1   # staged rows are numbered from the line after the header
+
+
+def _copy_ndjson(cur, entity, stream):
+    # Each line is loaded whole as one jsonb value (CSV mode with quote and
+    # delimiter characters that never occur in JSON text), then expanded
+    # into the staging columns by Postgres.
+    cur.execute("CREATE TEMP TABLE bulk_raw (line bigint GENERATED ALWAYS AS IDENTITY, doc jsonb) ON COMMIT DROP")
+    cur.copy_expert("COPY bulk_raw (doc) FROM STDIN WITH (FORMAT csv, QUOTE e'\\x01', DELIMITER e'\\x02')", stream)
+    columns = ', '.join(name for name, _ in _columns(entity))
+    cur.execute(f"""
+        INSERT INTO bulk_stage (line, {columns}) OVERRIDING SYSTEM VALUE
+        SELECT raw.line, {', '.join('r.' + name for name, _ in _columns(entity))}
+        FROM bulk_raw raw, jsonb_populate_record(NULL::bulk_stage, raw.doc) r
+        WHERE raw.doc IS NOT NULL
+    """)
+    return 0
+
+
+def _bump_sequence(cur, table, column):
+    cur.execute("SELECT pg_get_serial_sequence(%s, %s)", (table, column))
+    sequence = cur.fetchone()[0]
+    cur.execute(f"SELECT setval(%s, GREATEST((SELECT MAX({column}) FROM {table}), last_value)) FROM {sequence}",
+                (sequence,))
+
+
+def import_rows(conn, entity, stream, fmt='csv', on_conflict='skip'):
+    """COPY stream into entity and merge it; returns the counts.
+
+    Commits on success and rolls back on any error. Raises BulkError for
+    input that cannot be loaded at all.
+    """
+    if fmt not in FORMATS:
+        raise BulkError(f"format must be one of {', '.join(FORMATS)}")
+    if on_conflict not in CONFLICT_MODES:
+        raise BulkError(f"on_conflict must be one of {', '.join(CONFLICT_MODES)}")
+    _columns(entity)
+
+    cur = conn.cursor()
+    try:
+        _create_staging(cur, entity)
+        try:
+            if fmt == 'csv':
+                header_lines = _copy_csv(cur, entity, stream)
+            else:
+                header_lines = _copy_ndjson(cur, entity, stream)
+        except (psycopg2.DataError, psycopg2.IntegrityError) as e:
+            raise BulkError(str(e).strip())
+
+        cur.execute(f"""
+            CREATE TEMP TABLE bulk_valid ON COMMIT DROP AS
+            SELECT * FROM bulk_stage s WHERE {VALID_ROWS[entity]}
+        """)
+        cur.execute("SELECT (SELECT COUNT(*) FROM bulk_stage), (SELECT COUNT(*) FROM bulk_valid)")
+        staged, valid = cur.fetchone()
+        cur.execute(f"""
+            SELECT line FROM bulk_stage s WHERE NOT ({VALID_ROWS[entity]}) IS TRUE ORDER BY line LIMIT %s
+        """, (MAX_REPORTED_LINES,))
+        rejected_lines = [row[0] + header_lines for row in cur.fetchall()]
+
+        result = {'entity': entity, 'staged': staged, 'inserted': 0, 'updated': 0}
+        # One BulkImported event for the load instead of one per row
+        outbox.suppress(cur)
+        if entity in ADDRESS_ROWS:
+            cur.execute(ADDRESS_SQL.format(rows=ADDRESS_ROWS[entity][on_conflict]))
+            result['addresses_created'] = cur.fetchone()[0]
+        for sql in MERGE_SQL[entity]:
+            action = CONFLICT_ACTIONS.get(entity) if on_conflict == 'update' else None
+            cur.execute(sql.format(conflict=action or 'NOTHING'))
+            inserted, updated = cur.fetchone()
+            result['inserted'] += inserted
+            result['updated'] += updated
+        if entity == 'clients':
+            cur.execute(CLIENT_ADDRESS_SQL)
+            result['addresses_linked'] = cur.fetchone()[0]
+        if entity in SEQUENCES:
+            _bump_sequence(cur, *SEQUENCES[entity])
+
+        result['rejected'] = staged - valid
+        result['skipped'] = valid - result['inserted'] - result['updated']
+        result['rejected_lines'] = rejected_lines
+        outbox.record(cur, 'BulkImported', {'entity': entity, 'inserted': result['inserted'],
+                                            'updated': result['updated']})
+        conn.commit()
+        return result
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+
+
+# ----- Export -----
+
+class _Cancelled(Exception):
+    pass
+
+
+class _ChunkWriter:
+    """File-like target for COPY TO STDOUT handing ~64KB chunks to a reader thread."""
+
+    CHUNK_SIZE = 65536
+
+    def __init__(self):
+        self.chunks = queue.Queue(maxsize=16)
+        self.cancelled = False
+        self._buffer = io.BytesIO()
+
+    def write(self, data):
+        if self.cancelled:
+            raise _Cancelled()
+        self._buffer.write(data if isinstance(data, bytes) else data.encode())
+        if self._buffer.tell() >= self.CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self._buffer.tell():
+            self._put(self._buffer.getvalue())
+            self._buffer = io.BytesIO()
+
+    def _put(self, item):
+        while not self.cancelled:
+            try:
+                self.chunks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+        raise _Cancelled()
+
+
+def export_sql(entity, fmt='csv'):
+    if fmt not in FORMATS:
+        raise BulkError(f"format must be one of {', '.join(FORMATS)}")
+    _columns(entity)
+    select = ENTITIES[entity]['export']
+    if fmt == 'csv':
+        return f"COPY ({select}) TO STDOUT WITH (FORMAT csv, HEADER true)"
+    # row_to_json escapes control characters, so each value is one raw line
+    return (f"COPY (SELECT row_to_json(t) FROM ({select}) t) TO STDOUT "
+            "WITH (FORMAT csv, QUOTE e'\\x01', DELIMITER e'\\x02')")
+
+
+def export_rows(conn, entity, fmt='csv'):
+    """Generator of byte chunks of entity exported with COPY TO STDOUT.
+
+    COPY runs on a helper thread while the caller consumes chunks, so memory
+    stays flat. Closing the generator early cancels the COPY; conn is left
+    in an aborted transaction for the caller to roll back.
+    """
+    sql = export_sql(entity, fmt)
+    writer = _ChunkWriter()
+    errors = []
+    done = object()
+
+    def copy():
+        cur = conn.cursor()
+        try:
+            cur.copy_expert(sql, writer)
+            writer.flush()
+        except Exception as e:
+            errors.append(e)
+        finally:
+            cur.close()
+            try:
+                writer._put(done)
+            except _Cancelled:
+                pass
+
+    thread = threading.Thread(target=copy, daemon=True)
+    thread.start()
+    try:
+        while True:
+            chunk = writer.chunks.get()
+            if chunk is done:
+                break
+            yield chunk
+        if errors:
+            raise errors[0]
+    finally:
+        if thread.is_alive():
+            writer.cancelled = True
+            conn.cancel()
+            thread.join()
+
+
+def main():
+    from database import get_connection
+
+    parser = argparse.ArgumentParser(description="Bulk import or export fleet and client data with COPY")
+    sub = parser.add_subparsers(dest='command', required=True)
+    importer = sub.add_parser('import', help="Load a CSV or NDJSON file")
+    importer.add_argument('entity', choices=list(ENTITIES))
+    importer.add_argument('file', help="Path, or - for stdin")
+    importer.add_argument('--format', choices=FORMATS, help="Defaults to the file extension, else csv")
+    importer.add_argument('--on-conflict', choices=CONFLICT_MODES, default='skip')
+    exporter = sub.add_parser('export', help="Write an entity to stdout")
+    exporter.add_argument('entity', choices=list(ENTITIES))
+    exporter.add_argument('--format', choices=FORMATS, default='csv')
+    args = parser.parse_args()
+
+    conn = get_connection()
+    try:
+        if args.command == 'export':
+            chunks = export_rows(conn, args.entity, args.format)
+            try:
+                for chunk in chunks:
+                    sys.stdout.buffer.write(chunk)
+                sys.stdout.flush()
+            except BrokenPipeError:
+                # Reader went away (| head); stop quietly
+                chunks.close()
+                os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+            return 0
+
+        fmt = args.format or ('ndjson' if args.file.endswith(('.ndjson', '.jsonl')) else 'csv')
+        stream = sys.stdin.buffer if args.file == '-' else open(args.file, 'rb')
+        try:
+            result = import_rows(conn, args.entity, stream, fmt, args.on_conflict)
+        except BulkError as e:
+            print(f"Import failed: {e}", file=sys.stderr)
+            return 1
+        finally:
+            stream.close()
+        print(result)
+        return 0
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
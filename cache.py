@@ -0,0 +1,114 @@
+# cache.py
+
+import functools
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from flask import Response, request
+
+CACHE_TTL = float(os.environ.get('TAXI_CACHE_TTL', '30'))               # seconds an entry stays valid
+CACHE_MAX_ENTRIES = int(os.environ.get('TAXI_CACHE_MAX_ENTRIES', '256'))
+
+
+class ResponseCache:
+    """TTL + LRU cache of rendered GET responses, keyed by endpoint and query string.
+
+    Writers call invalidate() after committing. Each process has its own
+    cache, so in multi-worker deployments the TTL bounds how stale another
+    worker's copy can get.
+    """
+
+    def __init__(self, ttl=CACHE_TTL, max_entries=CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # key -> (body, mimetype, etag, expires_at)
+        self._generation = 0            # bumped by invalidate()
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[3] < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, body, mimetype, generation):
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        entry = (body, mimetype, etag, time.monotonic() + self.ttl)
+        with self._lock:
+            # Don't store a response computed before an invalidation
+            if generation == self._generation:
+                self._entries[key] = entry
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+        return entry
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+            self.invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else None,
+                'not_modified': self.not_modified,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+    def cached(self, view):
+        """Serve a GET view from the cache, answering If-None-Match with 304."""
+
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            key = (view.__name__, request.query_string)
+            entry = self.get(key)
+            if entry is None:
+                with self._lock:
+                    self.misses += 1
+                    generation = self._generation
+                response = view(*args, **kwargs)
+                if isinstance(response, tuple) or response.status_code != 200:
+                    return response   # errors are not cached
+                entry = self.put(key, response.get_data(), response.mimetype, generation)
+            else:
+                with self._lock:
+                    self.hits += 1
+
+            body, mimetype, etag, _ = entry
+            if request.if_none_match.contains_weak(etag[1:-1]):
+                with self._lock:
+                    self.not_modified += 1
+                response = Response(status=304)
+            else:
+                response = Response(body, mimetype=mimetype)
+            response.headers['ETag'] = etag
+            response.headers['Cache-Control'] = 'no-cache'
+            return response
+
+        return wrapper
+
+
+catalog_cache = ResponseCache()
@@ -1,12 +1,254 @@
 # database.py
 
+import os
+import threading
+import time
+from collections import deque
+
 import psycopg2
+import psycopg2.extensions
+
+# Connection settings. The defaults are the local development values; every
+# one of them can be overridden from the environment.
+DB_CONFIG = {
+    'dbname': os.environ.get('TAXI_DB_NAME', 'postgres'),        # <-- Put your DB name here
+    'user': os.environ.get('TAXI_DB_USER', 'postgres'),          # <-- DB username (e.g., postgres)
+    'password': os.environ.get('TAXI_DB_PASSWORD', 'Star@1237'), # <-- DB password
+    'host': os.environ.get('TAXI_DB_HOST', 'localhost'),         # <-- Usually localhost
+    'port': os.environ.get('TAXI_DB_PORT', '5432'),              # <-- Default PostgreSQL port
+}
+
+# Pool settings
+POOL_MIN_SIZE = int(os.environ.get('TAXI_DB_POOL_MIN', '2'))
+POOL_MAX_SIZE = int(os.environ.get('TAXI_DB_POOL_MAX', '20'))
+POOL_TIMEOUT = float(os.environ.get('TAXI_DB_POOL_TIMEOUT', '5'))          # seconds to wait for a free connection
+POOL_HEALTH_CHECK_AFTER = float(os.environ.get('TAXI_DB_POOL_HEALTH_CHECK', '30'))  # ping connections idle longer than this
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection could be checked out within the pool timeout."""
+
+
+class PooledConnection(psycopg2.extensions.connection):
+    """A psycopg2 connection whose close() hands it back to its pool.
+
+    Handlers keep calling conn.close() in their finally blocks exactly as
+    before; the physical connection is only closed when the pool discards it.
+    """
+
+    _pool = None
+    _checked_out = False
+
+    def close(self):
+        if self._pool is None:
+            super().close()
+        elif self._checked_out:
+            self._pool.putconn(self)
+
+    def discard(self):
+        super().close()
+
+
+class ConnectionPool:
+    def __init__(self, minconn=POOL_MIN_SIZE, maxconn=POOL_MAX_SIZE, timeout=POOL_TIMEOUT,
+                 health_check_after=POOL_HEALTH_CHECK_AFTER, **connect_kwargs):
+        if minconn < 0 or maxconn < 1 or minconn > maxconn:
+            raise ValueError("Invalid pool size: min=%s max=%s" % (minconn, maxconn))
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.health_check_after = health_check_after
+        self.connect_kwargs = connect_kwargs
+        self.pid = os.getpid()
+
+        self._cond = threading.Condition()
+        self._idle = deque()      # (connection, returned_at)
+        self._size = 0            # open connections, idle + in use
+        self._closed = False
+
+        # Metrics
+        self._checkouts = 0
+        self._checkout_failures = 0
+        self._waits = 0
+        self._wait_time_total = 0.0
+        self._wait_time_max = 0.0
+        self._health_check_failures = 0
+
+        for _ in range(minconn):
+            self._idle.append((self._connect(), time.monotonic()))
+            self._size += 1
+
+    def _connect(self):
+        conn = psycopg2.connect(connection_factory=PooledConnection, **self.connect_kwargs)
+        conn._pool = self
+        return conn
+
+    def _discard(self, conn):
+        # Caller holds self._cond.
+        self._size -= 1
+        try:
+            conn.discard()
+        except Exception:
+            pass
+
+    def _healthy(self, conn, returned_at):
+        if conn.closed:
+            return False
+        if time.monotonic() - returned_at < self.health_check_after:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.close()
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def getconn(self, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        started = time.monotonic()
+        deadline = started + timeout
+        waited = False
+        while True:
+            conn = None
+            with self._cond:
+                while True:
+                    if self._closed:
+                        raise PoolTimeout("Connection pool is closed")
+                    if self._idle:
+                        conn, returned_at = self._idle.pop()
+                        break
+                    if self._size < self.maxconn:
+                        # Reserve the slot, then connect outside the lock.
+                        self._size += 1
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._checkout_failures += 1
+                        if waited:
+                            self._record_wait(started)
+                        raise PoolTimeout(
+                            "No database connection available within %.1fs (%d in use)" % (timeout, self._size)
+                        )
+                    waited = True
+                    self._cond.wait(remaining)
+
+            if conn is None:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._checkout_failures += 1
+                        self._cond.notify()
+                    raise
+            elif not self._healthy(conn, returned_at):
+                with self._cond:
+                    self._health_check_failures += 1
+                    self._discard(conn)
+                continue
+
+            with self._cond:
+                self._checkouts += 1
+                if waited:
+                    self._record_wait(started)
+            conn._checked_out = True
+            return conn
+
+    def _record_wait(self, started):
+        elapsed = time.monotonic() - started
+        self._waits += 1
+        self._wait_time_total += elapsed
+        self._wait_time_max = max(self._wait_time_max, elapsed)
+
+    def putconn(self, conn):
+        conn._checked_out = False
+        # Reset the session so the next borrower starts from a clean slate.
+        try:
+            if not conn.closed:
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                if conn.autocommit:
+                    conn.autocommit = False
+        except Exception:
+            pass
+
+        with self._cond:
+            if conn.closed or self._closed or len(self._idle) >= self.maxconn:
+                self._discard(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def closeall(self):
+        with self._cond:
+            self._closed = True
+            while self._idle:
+                conn, _ = self._idle.pop()
+                self._discard(conn)
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            idle = len(self._idle)
+            return {
+                'min_size': self.minconn,
+                'max_size': self.maxconn,
+                'size': self._size,
+                'in_use': self._size - idle,
+                'idle': idle,
+                'checkouts': self._checkouts,
+                'checkout_failures': self._checkout_failures,
+                'health_check_failures': self._health_check_failures,
+                'waits': self._waits,
+                'wait_time_total': round(self._wait_time_total, 6),
+                'wait_time_max': round(self._wait_time_max, 6),
+            }
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Return the process-wide pool, creating it on first use.
+
+    The pool is keyed to the current pid so a forked worker never reuses
+    sockets inherited from its parent.
+    """
+    global _pool
+    pool = _pool
+    if pool is not None and pool.pid == os.getpid():
+        return pool
+    with _pool_lock:
+        if _pool is None or _pool.pid != os.getpid():
+            _pool = ConnectionPool(**DB_CONFIG)
+        return _pool
+
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None and _pool.pid == os.getpid():
+            _pool.closeall()
+        _pool = None
+
+
+def pool_stats():
+    return get_pool().stats()
+
+
+# Called as listener(elapsed) after every checkout attempt, including ones
+# that time out; metrics.py uses this for connection acquisition time.
+checkout_listeners = []
+
 
 def get_connection():
-    return psycopg2.connect(
-        dbname='postgres',      # <-- Put your DB name here
-        user='postgres',    # <-- DB username (e.g., postgres)
-        password='Star@1237',# <-- DB password
-        host='localhost',           # <-- Usually localhost
-        port='5432'                 # <-- Default PostgreSQL port
-    )
+    started = time.perf_counter()
+    try:
+        return get_pool().getconn()
+    finally:
+        elapsed = time.perf_counter() - started
+        for listener in checkout_listeners:
+            listener(elapsed)
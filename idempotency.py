@@ -0,0 +1,308 @@
+# idempotency.py
+#
+# Idempotency keys for the write endpoints clients retry (booking, reviews,
+# credit cards, registration). A request carrying an Idempotency-Key header
+# runs once; a retry with the same key gets the stored response back,
+# marked Idempotent-Replayed: true, without running the handler again.
+#
+# Keys are scoped to the route and the session identity (see sessions.py),
+# and bound to the request body: reusing a key for a different request is
+# answered 422, and a retry that arrives while the first attempt is still
+# running is answered 409 with Retry-After. Responses a retry could change
+# (5xx, 408, 409 contention, 429) are not stored, so the retry runs.
+#
+# Each process keeps the keys in a TTL + LRU store in memory. With
+# TAXI_IDEMPOTENCY_STORE=postgres they are also written to the
+# idempotency_keys table, so a retry that lands on another worker or host
+# is recognised too.
+
+import functools
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from flask import Response, g, make_response, request
+
+from database import get_connection
+
+IDEMPOTENCY_TTL = float(os.environ.get('TAXI_IDEMPOTENCY_TTL', str(24 * 3600)))       # seconds a key is kept
+IDEMPOTENCY_MAX_ENTRIES = int(os.environ.get('TAXI_IDEMPOTENCY_MAX_ENTRIES', '10000'))
+IDEMPOTENCY_STORE = os.environ.get('TAXI_IDEMPOTENCY_STORE', 'memory')                # memory | postgres
+# A key claimed longer ago than this without a response (the worker died) may be claimed again
+PENDING_TIMEOUT = float(os.environ.get('TAXI_IDEMPOTENCY_PENDING_TIMEOUT', '60'))
+
+log = logging.getLogger('taxi.idempotency')
+
+HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 255
+UNSTORED_STATUSES = frozenset([408, 409, 429])
+
+IDEMPOTENCY_TABLE = """
+    CREATE TABLE IF NOT EXISTS idempotency_keys (
+        key TEXT PRIMARY KEY,
+        request_hash TEXT NOT NULL,
+        status INTEGER,
+        body BYTEA,
+        mimetype TEXT,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        expires_at TIMESTAMPTZ NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idempotency_keys_expires_idx ON idempotency_keys (expires_at);
+"""
+
+# status is None while the first request is still running
+Entry = namedtuple('Entry', 'request_hash status body mimetype expires_at claimed_at')
+
+
+def scope_key(key, path, subject=None):
+    return hashlib.sha256('\0'.join([subject or '', path, key]).encode()).hexdigest()
+
+
+def request_hash(method, path, body):
+    return hashlib.sha256(b'\0'.join([method.encode(), path.encode(), body or b''])).hexdigest()
+
+
+def storable(status):
+    return status < 500 and status not in UNSTORED_STATUSES
+
+
+class MemoryStore:
+    """Keys of this process, expired after ttl and evicted LRU past max_entries."""
+
+    def __init__(self, ttl=IDEMPOTENCY_TTL, max_entries=IDEMPOTENCY_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # key -> Entry
+        self.evictions = 0
+
+    def claim(self, key, req_hash):
+        """None if key is now claimed by the caller, else the existing Entry."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry.expires_at < now or
+                                      entry.status is None and entry.claimed_at + PENDING_TIMEOUT < now):
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry
+            self._put(key, Entry(req_hash, None, None, None, now + self.ttl, now))
+            return None
+
+    def complete(self, key, req_hash, status, body, mimetype):
+        now = time.monotonic()
+        with self._lock:
+            self._put(key, Entry(req_hash, status, body, mimetype, now + self.ttl, now))
+
+    def remember(self, key, entry):
+        with self._lock:
+            self._put(key, entry)
+
+    def release(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.status is None:
+                del self._entries[key]
+
+    def _put(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class PostgresStore:
+    """Keys shared by every process through the idempotency_keys table."""
+
+    # Take the key if it is new, expired, or left pending by a dead worker
+    CLAIM_SQL = """
+        INSERT INTO idempotency_keys AS k (key, request_hash, expires_at)
+        VALUES (%(key)s, %(request_hash)s, now() + %(ttl)s * interval '1 second')
+        ON CONFLICT (key) DO UPDATE
+            SET request_hash = EXCLUDED.request_hash, status = NULL, body = NULL, mimetype = NULL,
+                created_at = now(), expires_at = EXCLUDED.expires_at
+            WHERE k.expires_at < now()
+               OR (k.status IS NULL AND k.created_at < now() - %(pending_timeout)s * interval '1 second')
+        RETURNING true
+    """
+    LOOKUP_SQL = "SELECT request_hash, status, body, mimetype FROM idempotency_keys WHERE key = %s"
+    COMPLETE_SQL = """
+        UPDATE idempotency_keys SET status = %s, body = %s, mimetype = %s
+        WHERE key = %s AND request_hash = %s
+    """
+    RELEASE_SQL = "DELETE FROM idempotency_keys WHERE key = %s AND status IS NULL"
+    PURGE_SQL = "DELETE FROM idempotency_keys WHERE expires_at < now()"
+
+    def __init__(self, ttl=IDEMPOTENCY_TTL, purge_every=300):
+        self.ttl = ttl
+        self.purge_every = purge_every
+        self._next_purge = 0.0
+
+    def _run(self, sql, params, fetch=False):
+        conn = get_connection()
+        cur = conn.cursor()
+        try:
+            cur.execute(sql, params)
+            row = cur.fetchone() if fetch else None
+            conn.commit()
+            return row
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cur.close()
+            conn.close()
+
+    def claim(self, key, req_hash):
+        if time.monotonic() >= self._next_purge:
+            self._next_purge = time.monotonic() + self.purge_every
+            self._run(self.PURGE_SQL, ())
+        if self._run(self.CLAIM_SQL, {'key': key, 'request_hash': req_hash, 'ttl': self.ttl,
+                                      'pending_timeout': PENDING_TIMEOUT}, fetch=True):
+            return None
+        row = self._run(self.LOOKUP_SQL, (key,), fetch=True)
+        if row is None:
+            return None   # purged in between; nothing to replay
+        body = bytes(row[2]) if row[2] is not None else None
+        now = time.monotonic()
+        return Entry(row[0], row[1], body, row[3], now + self.ttl, now)
+
+    def complete(self, key, req_hash, status, body, mimetype):
+        self._run(self.COMPLETE_SQL, (status, body, mimetype, key, req_hash))
+
+    def release(self, key):
+        self._run(self.RELEASE_SQL, (key,))
+
+
+class IdempotencyStore:
+    """The in-memory tier, backed by a shared tier when one is configured."""
+
+    def __init__(self, memory, shared=None):
+        self.memory = memory
+        self.shared = shared
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.replays = 0
+        self.mismatches = 0
+        self.in_progress = 0
+
+    def begin(self, key, req_hash):
+        """('new', None) if the caller should run the request, otherwise
+        ('replay' | 'mismatch' | 'in_progress', entry)."""
+        entry = self.memory.claim(key, req_hash)
+        if entry is None and self.shared is not None:
+            try:
+                entry = self.shared.claim(key, req_hash)
+            except Exception as e:
+                # Keep serving with this process's keys while the shared tier is down
+                log.warning("Shared idempotency store unavailable: %s", e)
+            if entry is not None:
+                if entry.status is None:
+                    self.memory.release(key)
+                else:
+                    self.memory.remember(key, entry)
+        if entry is None:
+            outcome = 'new'
+        elif entry.request_hash != req_hash:
+            outcome = 'mismatch'
+        elif entry.status is None:
+            outcome = 'in_progress'
+        else:
+            outcome = 'replay'
+        with self._lock:
+            self.requests += 1
+            if outcome == 'replay':
+                self.replays += 1
+            elif outcome == 'mismatch':
+                self.mismatches += 1
+            elif outcome == 'in_progress':
+                self.in_progress += 1
+        return outcome, entry
+
+    def finish(self, key, req_hash, status, body, mimetype):
+        """Store the response of a claimed key, or free the key if a retry should run."""
+        if not storable(status):
+            self.abandon(key)
+            return
+        self.memory.complete(key, req_hash, status, body, mimetype)
+        self._shared('complete', key, req_hash, status, body, mimetype)
+
+    def abandon(self, key):
+        self.memory.release(key)
+        self._shared('release', key)
+
+    def _shared(self, method, *args):
+        # The response is already decided; a shared tier failure must not change it
+        if self.shared is not None:
+            try:
+                getattr(self.shared, method)(*args)
+            except Exception as e:
+                log.warning("Shared idempotency store unavailable: %s", e)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'store': 'postgres' if self.shared is not None else 'memory',
+                'entries': len(self.memory),
+                'max_entries': self.memory.max_entries,
+                'ttl': self.memory.ttl,
+                'requests': self.requests,
+                'replays': self.replays,
+                'mismatches': self.mismatches,
+                'in_progress': self.in_progress,
+                'evictions': self.memory.evictions,
+            }
+
+
+store = IdempotencyStore(MemoryStore(), PostgresStore() if IDEMPOTENCY_STORE == 'postgres' else None)
+
+# (status, message) answered for each outcome other than 'new' and 'replay'
+OUTCOME_ERRORS = {
+    'mismatch': (422, "Idempotency-Key was already used for a different request"),
+    'in_progress': (409, "A request with this Idempotency-Key is still in progress"),
+}
+
+
+def idempotent(view):
+    """Run a POST view at most once per Idempotency-Key; replay its response after."""
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get(HEADER)
+        if not key:
+            return view(*args, **kwargs)
+        if len(key) > MAX_KEY_LENGTH:
+            return make_response({'error': f"{HEADER} must be at most {MAX_KEY_LENGTH} characters"}, 400)
+
+        session = g.get('session')
+        key = scope_key(key, request.path, session['sub'] if session else None)
+        req_hash = request_hash(request.method, request.path, request.get_data())
+        outcome, entry = store.begin(key, req_hash)
+        if outcome == 'replay':
+            response = Response(entry.body, status=entry.status, mimetype=entry.mimetype)
+            response.headers['Idempotent-Replayed'] = 'true'
+            return response
+        if outcome in OUTCOME_ERRORS:
+            status, message = OUTCOME_ERRORS[outcome]
+            response = make_response({'error': message}, status)
+            if outcome == 'in_progress':
+                response.headers['Retry-After'] = '1'
+            return response
+
+        try:
+            response = make_response(view(*args, **kwargs))
+        except BaseException:
+            store.abandon(key)
+            raise
+        store.finish(key, req_hash, response.status_code, response.get_data(), response.mimetype)
+        return response
+
+    return wrapper
@@ -0,0 +1,265 @@
+# metrics.py
+#
+# Request instrumentation for the Flask app, exposed in the Prometheus text
+# format at GET /metrics. The native async routes of asgi.py feed the same
+# series through start_request()/finish_request() and, for asyncpg
+# statements, query_logger. Every request records, per route:
+#   - total latency, and how much of it went to Postgres (statements run
+#     through queries.py), to waiting for a pooled connection, and to
+#     everything else (Python and JSON serialization)
+#   - statements run and rows they returned
+#   - status codes, with 4xx/5xx also counted as errors
+# A request is finished when its response is closed, so streamed responses
+# are measured to their last byte.
+#
+# TAXI_SLOW_QUERY_MS turns on the slow-query log: statements slower than
+# that many milliseconds are logged to the 'taxi.slow_queries' logger with
+# their name, route, duration and the shape of their parameters (types and
+# list lengths, never values).
+#
+# Values are per process. Under serve.py each worker keeps its own, so
+# scrape the workers individually or run a single worker per instance.
+
+import contextvars
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+
+from flask import Response, request
+
+import database
+import queries
+
+SLOW_QUERY_MS = float(os.environ.get('TAXI_SLOW_QUERY_MS', '0'))   # 0 disables the log
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+slow_query_log = logging.getLogger('taxi.slow_queries')
+
+_lock = threading.Lock()
+# The request being timed; a context variable so it follows async handlers too
+_timer = contextvars.ContextVar('taxi_request_timer', default=None)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=''):
+    pairs = ['%s="%s"' % (name, _escape(value)) for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{%s}' % ','.join(pairs) if pairs else ''
+
+
+class Counter:
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+
+    def inc(self, labels, amount=1):
+        # Caller holds _lock
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s counter' % self.name]
+        for labels, value in sorted(self._values.items()):
+            lines.append('%s%s %s' % (self.name, _labels(self.labels, labels), _number(value)))
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labels, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}   # labels -> [count per bucket..., count above the last, sum]
+
+    def observe(self, labels, value):
+        # Caller holds _lock
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s histogram' % self.name]
+        for labels, series in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), series):
+                cumulative += count
+                le = 'le="%s"' % (bound if bound == '+Inf' else _number(bound))
+                lines.append('%s_bucket%s %d' % (self.name, _labels(self.labels, labels, le), cumulative))
+            lines.append('%s_sum%s %s' % (self.name, _labels(self.labels, labels), _number(series[-1])))
+            lines.append('%s_count%s %d' % (self.name, _labels(self.labels, labels), cumulative))
+        return lines
+
+
+def _number(value):
+    return repr(round(value, 6)) if isinstance(value, float) else str(value)
+
+
+requests_total = Counter('taxi_http_requests_total', "Requests by route, method and status",
+                         ('route', 'method', 'status'))
+errors_total = Counter('taxi_http_errors_total', "Responses with a 4xx or 5xx status, by route",
+                       ('route', 'class'))
+request_seconds = Histogram('taxi_http_request_duration_seconds', "Request latency", ('route',))
+db_seconds = Histogram('taxi_http_db_duration_seconds', "Time per request spent in database statements",
+                       ('route',))
+app_seconds = Histogram('taxi_http_app_duration_seconds',
+                        "Time per request outside the database and pool (Python, serialization)", ('route',))
+acquire_seconds = Histogram('taxi_db_connection_acquire_seconds', "Time to check out a pooled connection",
+                            ('route',))
+statements_total = Counter('taxi_http_db_statements_total', "Database statements run, by route", ('route',))
+rows_total = Counter('taxi_http_db_rows_total', "Rows returned or affected by database statements, by route",
+                     ('route',))
+
+REQUEST_METRICS = (requests_total, errors_total, request_seconds, db_seconds, app_seconds, acquire_seconds,
+                   statements_total, rows_total)
+
+
+class RequestTimer:
+    __slots__ = ('route', 'method', 'started', 'db_time', 'acquire_time', 'statements', 'rows')
+
+    def __init__(self, route, method):
+        self.route = route
+        self.method = method
+        self.started = time.perf_counter()
+        self.db_time = 0.0
+        self.acquire_time = 0.0
+        self.statements = 0
+        self.rows = 0
+
+
+def params_shape(params):
+    """Describe parameters without their values, for the slow-query log."""
+    def shape(value):
+        if isinstance(value, (list, tuple)):
+            return 'list[%d]' % len(value)
+        return type(value).__name__
+
+    if params is None:
+        return None
+    if isinstance(params, dict):
+        return {key: shape(value) for key, value in params.items()}
+    return [shape(value) for value in params]
+
+
+def _on_statement(name, elapsed, rows, params, failed):
+    timer = _timer.get()
+    if timer is not None:
+        timer.db_time += elapsed
+        timer.statements += 1
+        if rows > 0:
+            timer.rows += rows
+    if SLOW_QUERY_MS and elapsed * 1000 >= SLOW_QUERY_MS:
+        slow_query_log.warning("slow query %s %.1fms route=%s failed=%s params=%s", name, elapsed * 1000,
+                               timer.route if timer else None, failed, params_shape(params))
+
+
+def checkout_listener(elapsed):
+    # Seconds spent waiting for a pooled connection, from database.py or asgi.py
+    timer = _timer.get()
+    if timer is not None:
+        timer.acquire_time += elapsed
+
+
+def _start():
+    rule = request.url_rule
+    start_request(rule.rule if rule is not None else '<unmatched>', request.method)
+
+
+def start_request(route, method):
+    """Start timing a request; statements and checkouts from here on count towards it."""
+    timer = RequestTimer(route, method)
+    _timer.set(timer)
+    return timer
+
+
+def finish_request(timer, status):
+    """Record a request started with start_request() once its response is sent."""
+    total = time.perf_counter() - timer.started
+    route = (timer.route,)
+    with _lock:
+        requests_total.inc((timer.route, timer.method, str(status)))
+        if status >= 400:
+            errors_total.inc((timer.route, '%dxx' % (status // 100)))
+        request_seconds.observe(route, total)
+        db_seconds.observe(route, timer.db_time)
+        app_seconds.observe(route, max(total - timer.db_time - timer.acquire_time, 0.0))
+        acquire_seconds.observe(route, timer.acquire_time)
+        statements_total.inc(route, timer.statements)
+        rows_total.inc(route, timer.rows)
+    if _timer.get() is timer:
+        _timer.set(None)
+
+
+def _after(response):
+    timer = _timer.get()
+    if timer is not None:
+        status = response.status_code
+        response.call_on_close(lambda: finish_request(timer, status))
+    return response
+
+
+def query_logger(record):
+    # asyncpg query logger (Connection.add_query_logger), for asgi.py's pool.
+    # asyncpg calls it from the event loop in the querying task's context.
+    name = ' '.join(record.query.split())[:80]
+    _on_statement(name, record.elapsed, 0, record.args, record.exception is not None)
+
+
+def _statement_lines():
+    stats = queries.stats()['statements']
+    lines = []
+    for name, help, key, scale in (
+        ('taxi_db_statement_calls_total', "Calls per registered statement", 'calls', 1),
+        ('taxi_db_statement_errors_total', "Failed calls per registered statement", 'errors', 1),
+        ('taxi_db_statement_seconds_total', "Cumulative time per registered statement", 'total_ms', 0.001),
+    ):
+        lines += ['# HELP %s %s' % (name, help), '# TYPE %s counter' % name]
+        for s in stats:
+            lines.append('%s{statement="%s"} %s' % (name, _escape(s['name']), _number(s[key] * scale)))
+    return lines
+
+
+def _pool_lines():
+    try:
+        stats = database.pool_stats()
+    except Exception:
+        return []   # database unreachable; the request metrics are still useful
+    lines = []
+    for key in ('size', 'in_use', 'idle'):
+        name = 'taxi_db_pool_%s' % key
+        lines += ['# TYPE %s gauge' % name, '%s %d' % (name, stats[key])]
+    for key in ('checkouts', 'checkout_failures', 'waits'):
+        name = 'taxi_db_pool_%s_total' % key
+        lines += ['# TYPE %s counter' % name, '%s %d' % (name, stats[key])]
+    return lines
+
+
+def render():
+    with _lock:
+        lines = [line for metric in REQUEST_METRICS for line in metric.render()]
+    lines += _statement_lines()
+    lines += _pool_lines()
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_view():
+    return Response(render(), mimetype='text/plain; version=0.0.4')
+
+
+def install(app):
+    """Instrument every route of app and serve GET /metrics."""
+    queries.listeners.append(_on_statement)
+    database.checkout_listeners.append(checkout_listener)
+    app.before_request(_start)
+    app.after_request(_after)
+    app.add_url_rule('/metrics', 'metrics', metrics_view, methods=['GET'])
@@ -0,0 +1,117 @@
+# offboarding.py
+#
+# Bulk driver offboarding. A whole list of drivers is removed in one
+# transaction: they are locked and checked for active (today or later)
+# rentals in one statement, and their reviews, declared models, rents and
+# finally the drivers themselves are deleted with one `= ANY(...)` statement
+# per table, so offboarding a depot takes five statements whatever its size.
+# Drivers that are missing or still have active rentals are reported and
+# left alone; the others are removed. With dry_run nothing is deleted and
+# the counts are what a real run would remove.
+
+import queries
+
+MAX_BATCH_SIZE = 500
+
+FAILURE_MESSAGES = {
+    'invalid': "A valid driver name is required",
+    'duplicate': "Driver is listed more than once",
+    'not_found': "Driver not found",
+    'active_rentals': "Driver has active rentals. Cancel rentals first",
+}
+
+STATUS_SQL = """
+    SELECT d.name,
+           EXISTS (SELECT 1 FROM Rent r WHERE r.name = d.name AND r.rent_date >= CURRENT_DATE) AS active
+    FROM Driver d
+    WHERE d.name = ANY(%(names)s::text[])
+    ORDER BY d.name
+"""
+queries.register('offboard_status', STATUS_SQL)
+# Locked in name order so concurrent offboardings cannot deadlock
+queries.register('offboard_lock', STATUS_SQL + " FOR UPDATE OF d")
+
+queries.register('offboard_counts', """
+    WITH n AS (SELECT unnest(%(names)s::text[]) AS name)
+    SELECT n.name, COALESCE(rv.count, 0), COALESCE(dm.count, 0), COALESCE(r.count, 0)
+    FROM n
+    LEFT JOIN (SELECT name, count(*) FROM Review WHERE name = ANY(%(names)s::text[]) GROUP BY name) rv
+        USING (name)
+    LEFT JOIN (SELECT name, count(*) FROM Driver_Model WHERE name = ANY(%(names)s::text[]) GROUP BY name) dm
+        USING (name)
+    LEFT JOIN (SELECT name, count(*) FROM Rent WHERE name = ANY(%(names)s::text[]) GROUP BY name) r
+        USING (name)
+""")
+
+# Dependents first: Rent and Review reference Driver
+DELETE_SQL = """
+    WITH deleted AS (DELETE FROM {table} WHERE name = ANY(%(names)s::text[]) RETURNING name)
+    SELECT name, count(*) FROM deleted GROUP BY name
+"""
+queries.register('offboard_reviews', DELETE_SQL.format(table='Review'))
+queries.register('offboard_models', DELETE_SQL.format(table='Driver_Model'))
+queries.register('offboard_rents', DELETE_SQL.format(table='Rent'))
+queries.register('offboard_drivers', DELETE_SQL.format(table='Driver'))
+
+
+def offboard_drivers(conn, names, dry_run=False):
+    """Delete every driver of names that has no active rentals, and commit.
+
+    Returns one result per name, in order: {'name', 'deleted': True,
+    'stats': {'reviews_deleted', 'models_unlinked', 'rentals_canceled'}}
+    ('deleted' is False on a dry run) or {'name', 'deleted': False, 'reason',
+    'error'} with a reason from FAILURE_MESSAGES.
+    """
+    results = [None] * len(names)
+    positions = {}
+    for i, name in enumerate(names):
+        if not isinstance(name, str) or not name.strip():
+            results[i] = _failure(name, 'invalid')
+        elif name.strip() in positions:
+            results[i] = _failure(name.strip(), 'duplicate')
+        else:
+            positions[name.strip()] = i
+    if not positions:
+        return results
+
+    cur = conn.cursor()
+    try:
+        queries.execute(cur, 'offboard_status' if dry_run else 'offboard_lock', {'names': list(positions)})
+        active = dict(cur.fetchall())
+        removable = [name for name in positions if active.get(name) is False]
+
+        stats = {name: {'reviews_deleted': 0, 'models_unlinked': 0, 'rentals_canceled': 0} for name in removable}
+        if removable and dry_run:
+            queries.execute(cur, 'offboard_counts', {'names': removable})
+            for name, reviews, models, rents in cur.fetchall():
+                stats[name] = {'reviews_deleted': reviews, 'models_unlinked': models, 'rentals_canceled': rents}
+        elif removable:
+            for statement, key in (('offboard_reviews', 'reviews_deleted'), ('offboard_models', 'models_unlinked'),
+                                   ('offboard_rents', 'rentals_canceled')):
+                queries.execute(cur, statement, {'names': removable})
+                for name, count in cur.fetchall():
+                    stats[name][key] = count
+            queries.execute(cur, 'offboard_drivers', {'names': removable})
+            cur.fetchall()
+        if dry_run:
+            conn.rollback()
+        else:
+            conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+
+    for name, i in positions.items():
+        if name not in active:
+            results[i] = _failure(name, 'not_found')
+        elif active[name]:
+            results[i] = _failure(name, 'active_rentals')
+        else:
+            results[i] = {'name': name, 'deleted': not dry_run, 'stats': stats[name]}
+    return results
+
+
+def _failure(name, reason):
+    return {'name': name, 'deleted': False, 'reason': reason, 'error': FAILURE_MESSAGES[reason]}
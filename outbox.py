@@ -0,0 +1,383 @@
+# outbox.py
+#
+# Transactional outbox. Statement-level triggers append a domain event to
+# outbox_events for every row written to the main tables (RentBooked,
+# DriverDeleted, ModelAdded, ReviewAdded, ...), in the same transaction as
+# the write, so an event exists exactly when its change committed. The
+# payload is the row as JSON (CreditCard without the card number).
+# record() adds application-level events the same way.
+#
+# A dispatcher thread per subscription delivers the events in batches to
+# in-process subscribers:
+#
+#   outbox.subscribe('catalog_cache', ['ModelAdded', 'CarDeleted'], handle)
+#
+# handle(events) gets a list of Event tuples in commit-safe order. Delivery
+# is at least once: a batch is redelivered, after a backoff, until handle
+# returns without raising. Each subscriber pulls its next batch only after
+# the previous one is handled, so a slow subscriber falls behind (see
+# stats()) instead of queueing events in memory, and writers never wait.
+#
+# Events are read only once every transaction that could still add an
+# earlier one has finished (txid below the snapshot xmin), so no event is
+# skipped when transactions commit out of order. Subscriptions start at the
+# tail when the dispatcher starts in a process; a durable subscription keeps
+# its position in outbox_cursors instead, and resumes there in whichever
+# process holds its cursor row. Anything rebuilt from the tables that a
+# subscriber keeps current (the availability index) must be rebuilt after
+# ensure_started(), so no event falls between its snapshot and the tail. Events older than TAXI_OUTBOX_RETENTION days are deleted.
+
+import json
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+
+from flask import request
+
+from database import get_connection
+
+POLL_INTERVAL = float(os.environ.get('TAXI_OUTBOX_POLL', '0.5'))        # seconds between polls when idle
+BATCH_SIZE = int(os.environ.get('TAXI_OUTBOX_BATCH', '500'))
+RETENTION_DAYS = float(os.environ.get('TAXI_OUTBOX_RETENTION', '7'))
+DISPATCH = os.environ.get('TAXI_OUTBOX_DISPATCH', '1') != '0'
+MAX_BACKOFF = 30.0
+
+log = logging.getLogger('taxi.outbox')
+
+Event = namedtuple('Event', 'event_id event_type payload created_at')
+
+# (table, operation, event type, payload columns left out)
+CAPTURED = [
+    ('Rent', 'INSERT', 'RentBooked', ()),
+    ('Rent', 'DELETE', 'RentDeleted', ()),
+    ('Review', 'INSERT', 'ReviewAdded', ()),
+    ('Review', 'DELETE', 'ReviewDeleted', ()),
+    ('Driver', 'INSERT', 'DriverAdded', ()),
+    ('Driver', 'DELETE', 'DriverDeleted', ()),
+    ('Driver_Model', 'INSERT', 'DriverModelDeclared', ()),
+    ('Driver_Model', 'DELETE', 'DriverModelRemoved', ()),
+    ('Car', 'INSERT', 'CarAdded', ()),
+    ('Car', 'DELETE', 'CarDeleted', ()),
+    ('Model', 'INSERT', 'ModelAdded', ()),
+    ('Model', 'DELETE', 'ModelDeleted', ()),
+    ('Client', 'INSERT', 'ClientRegistered', ()),
+    ('Client_Address', 'INSERT', 'ClientAddressAdded', ()),
+    ('CreditCard', 'INSERT', 'CreditCardAdded', ('ccnum',)),
+]
+
+OUTBOX_TABLES = """
+    CREATE TABLE IF NOT EXISTS outbox_events (
+        event_id BIGSERIAL PRIMARY KEY,
+        txid XID8 NOT NULL DEFAULT pg_current_xact_id(),
+        event_type TEXT NOT NULL,
+        payload JSONB NOT NULL,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+    CREATE INDEX IF NOT EXISTS outbox_events_txid_idx ON outbox_events (txid, event_id);
+    CREATE INDEX IF NOT EXISTS outbox_events_created_idx ON outbox_events (created_at);
+
+    CREATE TABLE IF NOT EXISTS outbox_cursors (
+        subscriber TEXT PRIMARY KEY,
+        txid XID8 NOT NULL,
+        event_id BIGINT NOT NULL,
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+"""
+
+# Bulk loads (bulk.py, bench/seed.py) set taxi.outbox_suppress for their
+# transaction and record one summary event instead of one per row.
+TRIGGERS = """
+    CREATE OR REPLACE FUNCTION outbox_on_insert() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        IF current_setting('taxi.outbox_suppress', true) IS DISTINCT FROM 'on' THEN
+            INSERT INTO outbox_events (event_type, payload)
+            SELECT TG_ARGV[0], to_jsonb(t) - TG_ARGV[1:] FROM new_rows t;
+        END IF;
+        RETURN NULL;
+    END $$;
+
+    CREATE OR REPLACE FUNCTION outbox_on_delete() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        IF current_setting('taxi.outbox_suppress', true) IS DISTINCT FROM 'on' THEN
+            INSERT INTO outbox_events (event_type, payload)
+            SELECT TG_ARGV[0], to_jsonb(t) - TG_ARGV[1:] FROM old_rows t;
+        END IF;
+        RETURN NULL;
+    END $$;
+
+    CREATE OR REPLACE FUNCTION outbox_driver_on_update() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        IF current_setting('taxi.outbox_suppress', true) IS DISTINCT FROM 'on' THEN
+            INSERT INTO outbox_events (event_type, payload)
+            SELECT 'DriverUpdated', to_jsonb(n) || jsonb_build_object('old_city', o.city)
+            FROM new_rows n JOIN old_rows o ON o.name = n.name
+            WHERE to_jsonb(n) IS DISTINCT FROM to_jsonb(o);
+        END IF;
+        RETURN NULL;
+    END $$;
+
+    DROP TRIGGER IF EXISTS outbox_driver_update ON Driver;
+    CREATE TRIGGER outbox_driver_update AFTER UPDATE ON Driver
+        REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION outbox_driver_on_update();
+"""
+
+CAPTURE_TRIGGER = """
+    DROP TRIGGER IF EXISTS {name} ON {table};
+    CREATE TRIGGER {name} AFTER {operation} ON {table}
+        REFERENCING {transition} TABLE AS {rows}
+        FOR EACH STATEMENT EXECUTE FUNCTION {function}({args});
+"""
+
+# Events whose transaction is finished, after a (txid, event_id) position
+FETCH_SQL = """
+    SELECT event_id, txid::text, event_type, payload, created_at
+    FROM outbox_events
+    WHERE (txid, event_id) > (%(txid)s::xid8, %(event_id)s)
+      AND txid < pg_snapshot_xmin(pg_current_snapshot())
+      AND (%(types)s::text[] IS NULL OR event_type = ANY(%(types)s::text[]))
+    ORDER BY txid, event_id
+    LIMIT %(limit)s
+"""
+TAIL_SQL = "SELECT pg_snapshot_xmin(pg_current_snapshot())::text"
+PURGE_SQL = "DELETE FROM outbox_events WHERE created_at < now() - %s * interval '1 day'"
+
+
+def create(cur):
+    """Create the outbox tables and capture triggers.
+
+    Runs as a schema.py migration.
+    """
+    cur.execute(OUTBOX_TABLES)
+    cur.execute(TRIGGERS)
+    for table, operation, event_type, dropped in CAPTURED:
+        insert = operation == 'INSERT'
+        cur.execute(CAPTURE_TRIGGER.format(
+            name='outbox_%s_%s' % (table.lower(), operation.lower()),
+            table=table,
+            operation=operation,
+            transition='NEW' if insert else 'OLD',
+            rows='new_rows' if insert else 'old_rows',
+            function='outbox_on_insert' if insert else 'outbox_on_delete',
+            args=', '.join("'%s'" % arg for arg in (event_type,) + dropped),
+        ))
+
+
+def record(cur, event_type, payload):
+    """Add an application event to the outbox in cur's transaction."""
+    cur.execute("INSERT INTO outbox_events (event_type, payload) VALUES (%s, %s)",
+                (event_type, json.dumps(payload, default=str)))
+
+
+def suppress(cur):
+    """Stop the capture triggers for the rest of cur's transaction."""
+    cur.execute("SET LOCAL taxi.outbox_suppress = 'on'")
+
+
+# -------------------- Dispatcher --------------------
+
+class Subscription:
+    def __init__(self, name, event_types, handler, durable=False, batch_size=BATCH_SIZE):
+        self.name = name
+        self.event_types = list(event_types) if event_types else None
+        self.handler = handler
+        self.durable = durable
+        self.batch_size = batch_size
+        self.position = None    # (txid, event_id) delivered up to, for non-durable subscriptions
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.delivered = 0
+        self.batches = 0
+        self.failures = 0
+        self.last_error = None
+        self.last_event_at = None
+
+    def start(self):
+        try:
+            self.mark_tail()
+        except Exception as e:
+            # deliver_batch() takes the tail itself once the database is back
+            log.warning("Outbox subscriber %s could not read the tail: %s", self.name, e)
+        self.thread = threading.Thread(target=self._run, name='outbox-' + self.name, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        backoff = 0.0
+        while True:
+            try:
+                delivered = self.deliver_batch()
+                backoff = 0.0
+            except Exception as e:
+                self.failures += 1
+                self.last_error = str(e)
+                backoff = min(max(backoff * 2, POLL_INTERVAL), MAX_BACKOFF)
+                log.warning("Outbox subscriber %s failed, retrying in %.1fs: %s", self.name, backoff, e)
+                time.sleep(backoff)
+                continue
+            # A full batch means there is more waiting; otherwise sleep until woken or the next poll
+            if delivered < self.batch_size:
+                self.wakeup.wait(POLL_INTERVAL)
+                self.wakeup.clear()
+
+    def mark_tail(self):
+        """Start a non-durable subscription at the current tail."""
+        if self.durable or self.position is not None:
+            return
+        conn = get_connection()
+        cur = conn.cursor()
+        try:
+            cur.execute(TAIL_SQL)
+            self.position = (cur.fetchone()[0], 0)
+            conn.commit()
+        finally:
+            cur.close()
+            conn.close()
+
+    def deliver_batch(self):
+        """Deliver the next batch; returns how many events it held."""
+        conn = get_connection()
+        cur = conn.cursor()
+        try:
+            if self.durable:
+                # The row lock makes one process at a time deliver this subscription
+                cur.execute("SELECT txid::text, event_id FROM outbox_cursors WHERE subscriber = %s "
+                            "FOR UPDATE SKIP LOCKED", (self.name,))
+                row = cur.fetchone()
+                if row is None:
+                    conn.rollback()
+                    return 0
+                position = (row[0], row[1])
+            else:
+                if self.position is None:
+                    cur.execute(TAIL_SQL)
+                    self.position = (cur.fetchone()[0], 0)
+                position = self.position
+
+            cur.execute(FETCH_SQL, {'txid': position[0], 'event_id': position[1],
+                                    'types': self.event_types, 'limit': self.batch_size})
+            rows = cur.fetchall()
+            if rows:
+                self.handler([Event(row[0], row[2], row[3], row[4]) for row in rows])
+                position = (rows[-1][1], rows[-1][0])
+                if self.durable:
+                    cur.execute("UPDATE outbox_cursors SET txid = %s::xid8, event_id = %s, updated_at = now() "
+                                "WHERE subscriber = %s", (position[0], position[1], self.name))
+                else:
+                    self.position = position
+                self.delivered += len(rows)
+                self.batches += 1
+                self.last_event_at = rows[-1][4]
+            conn.commit()
+            return len(rows)
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cur.close()
+            conn.close()
+
+    def stats(self):
+        return {
+            'event_types': self.event_types,
+            'durable': self.durable,
+            'running': bool(self.thread and self.thread.is_alive()),
+            'delivered': self.delivered,
+            'batches': self.batches,
+            'failures': self.failures,
+            'last_error': self.last_error,
+            'last_event_at': self.last_event_at.isoformat() if self.last_event_at else None,
+        }
+
+
+class Dispatcher:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.subscriptions = {}
+        self._pid = None
+        self._purger = None
+
+    def subscribe(self, name, event_types, handler, durable=False, batch_size=BATCH_SIZE):
+        """Deliver events of event_types (None for all) to handler(events).
+
+        A durable subscription starts at the current tail the first time and
+        then resumes from its stored position.
+        """
+        subscription = Subscription(name, event_types, handler, durable, batch_size)
+        with self._lock:
+            if name in self.subscriptions:
+                raise ValueError("Outbox subscriber %r already exists" % name)
+            self.subscriptions[name] = subscription
+            running = self._pid == os.getpid()
+        if durable:
+            self._create_cursor(name)
+        if running:
+            subscription.start()
+        return subscription
+
+    def _create_cursor(self, name):
+        conn = get_connection()
+        cur = conn.cursor()
+        try:
+            cur.execute("INSERT INTO outbox_cursors (subscriber, txid, event_id) "
+                        "VALUES (%s, pg_snapshot_xmin(pg_current_snapshot()), 0) "
+                        "ON CONFLICT (subscriber) DO NOTHING", (name,))
+            conn.commit()
+        finally:
+            cur.close()
+            conn.close()
+
+    def ensure_started(self):
+        # Threads do not survive a fork, so a preloaded app starts them per worker
+        if not DISPATCH or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            for subscription in self.subscriptions.values():
+                subscription.start()
+            self._purger = threading.Thread(target=self._purge_loop, name='outbox-purge', daemon=True)
+            self._purger.start()
+
+    def wake(self):
+        for subscription in list(self.subscriptions.values()):
+            subscription.wakeup.set()
+
+    def _purge_loop(self):
+        while True:
+            try:
+                conn = get_connection()
+                cur = conn.cursor()
+                try:
+                    cur.execute(PURGE_SQL, (RETENTION_DAYS,))
+                    conn.commit()
+                finally:
+                    cur.close()
+                    conn.close()
+            except Exception as e:
+                log.warning("Could not purge old outbox events: %s", e)
+            time.sleep(3600)
+
+    def stats(self):
+        with self._lock:
+            return {'running': self._pid == os.getpid(),
+                    'subscribers': {name: s.stats() for name, s in self.subscriptions.items()}}
+
+
+dispatcher = Dispatcher()
+subscribe = dispatcher.subscribe
+
+
+def _after(response):
+    dispatcher.ensure_started()
+    # Deliver this process's own writes without waiting for the next poll
+    if response.status_code < 400 and request.method not in ('GET', 'HEAD', 'OPTIONS'):
+        dispatcher.wake()
+    return response
+
+
+def install(app):
+    """Start the dispatcher in each serving process and wake it after writes."""
+    app.after_request(_after)
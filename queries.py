@@ -0,0 +1,375 @@
+# queries.py
+#
+# Named registry of the statements the route handlers run. On each pooled
+# connection a statement is PREPAREd the first time it is used and then run
+# with EXECUTE, so Postgres parses and plans it once per connection instead
+# of once per request. Per-statement call counts and timings are served at
+# /manager/query_stats.
+#
+# Set TAXI_PREPARE_STATEMENTS=0 to send the SQL text instead, e.g. behind a
+# transaction-pooling PgBouncer, where a server-side prepared statement does
+# not follow the client from one transaction to the next.
+
+import os
+import re
+import threading
+import time
+
+PREPARE_STATEMENTS = os.environ.get('TAXI_PREPARE_STATEMENTS', '1') != '0'
+
+# "prepared statement does not exist" (e.g. after DISCARD ALL), "already
+# exists" and "cached plan must not change result type" (a SELECT * table
+# gained a column): the connection's prepared set no longer matches the server.
+STALE_PREPARED_CODES = ('26000', '42P05', '0A000')
+
+_PLACEHOLDER = re.compile(r'%\((\w+)\)s|%s|%%')
+
+
+def to_numbered(sql):
+    """Convert psycopg2 placeholders to Postgres $n parameters.
+
+    Returns the converted SQL and the parameter keys in $n order: names for
+    %(name)s statements, positions for %s ones. A name used twice maps to one
+    $n, so params[key] for each key gives the argument list in either case.
+    """
+    keys = []
+
+    def number(match):
+        if match.group(0) == '%%':
+            return '%'
+        key = match.group(1) if match.group(1) else len(keys)
+        if key not in keys:
+            keys.append(key)
+        return '$%d' % (keys.index(key) + 1)
+
+    return _PLACEHOLDER.sub(number, sql), keys
+
+
+class Statement:
+    def __init__(self, name, sql):
+        self.name = name
+        self.sql = sql
+        numbered, keys = to_numbered(sql)
+        self.prepare_sql = "PREPARE %s AS %s" % (name, numbered)
+        placeholders = ', '.join('%%(%s)s' % key if isinstance(key, str) else '%s' for key in keys)
+        self.execute_sql = "EXECUTE %s (%s)" % (name, placeholders) if keys else "EXECUTE %s" % name
+        self.calls = 0
+        self.errors = 0
+        self.rows = 0
+        self.prepares = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+
+_lock = threading.Lock()
+_statements = {}
+
+# Called as listener(name, elapsed, rows, params, failed) after every
+# statement; metrics.py uses this for per-request DB time.
+listeners = []
+
+
+def register(name, sql):
+    """Add a statement to the registry; returns its name."""
+    with _lock:
+        if name in _statements and _statements[name].sql != sql:
+            raise ValueError("Statement %r is already registered with different SQL" % name)
+        _statements.setdefault(name, Statement(name, sql))
+    return name
+
+
+def sql(name):
+    return _statements[name].sql
+
+
+def _record(statement, elapsed, rows, params, failed=False, prepared=False):
+    for listener in listeners:
+        listener(statement.name, elapsed, rows, params, failed)
+    with _lock:
+        statement.calls += 1
+        statement.total_time += elapsed
+        statement.max_time = max(statement.max_time, elapsed)
+        if rows > 0:
+            statement.rows += rows
+        if failed:
+            statement.errors += 1
+        if prepared:
+            statement.prepares += 1
+
+
+def _prepared_on(cur):
+    conn = cur.connection
+    prepared = getattr(conn, 'prepared_statements', None)
+    if prepared is None:
+        # First use on this connection, or its prepared set went stale
+        if getattr(conn, 'prepared_stale', False):
+            cur.execute("DEALLOCATE ALL")
+            conn.prepared_stale = False
+        prepared = conn.prepared_statements = set()
+    return prepared
+
+
+def execute(cur, name, params=None):
+    """Run a registered statement on cur, preparing it on first use per connection."""
+    statement = _statements[name]
+    prepared_now = False
+    started = time.perf_counter()
+    try:
+        if PREPARE_STATEMENTS:
+            prepared = _prepared_on(cur)
+            if name not in prepared:
+                cur.execute(statement.prepare_sql)
+                prepared.add(name)
+                prepared_now = True
+            cur.execute(statement.execute_sql, params)
+        else:
+            cur.execute(statement.sql, params)
+    except Exception as e:
+        if getattr(e, 'pgcode', None) in STALE_PREPARED_CODES:
+            cur.connection.prepared_statements = None
+            cur.connection.prepared_stale = True
+        _record(statement, time.perf_counter() - started, 0, params, failed=True, prepared=prepared_now)
+        raise
+    _record(statement, time.perf_counter() - started, cur.rowcount, params, prepared=prepared_now)
+
+
+def stream(cur, name, params=None):
+    """Run a registered statement on a named (server-side) cursor.
+
+    DECLARE cannot wrap EXECUTE, so streamed statements are always sent as
+    text; their timing covers opening the cursor, not fetching from it.
+    """
+    statement = _statements[name]
+    started = time.perf_counter()
+    try:
+        cur.execute(statement.sql, params)
+    except Exception:
+        _record(statement, time.perf_counter() - started, 0, params, failed=True)
+        raise
+    _record(statement, time.perf_counter() - started, 0, params)
+
+
+def stats():
+    with _lock:
+        rows = [{
+            'name': s.name,
+            'calls': s.calls,
+            'errors': s.errors,
+            'rows': s.rows,
+            'prepares': s.prepares,
+            'total_ms': round(s.total_time * 1000, 3),
+            'mean_ms': round(s.total_time * 1000 / s.calls, 3) if s.calls else None,
+            'max_ms': round(s.max_time * 1000, 3),
+        } for s in _statements.values()]
+    rows.sort(key=lambda r: r['total_ms'], reverse=True)
+    return {'prepared': PREPARE_STATEMENTS, 'statements': rows}
+
+
+# -------------------- Manager --------------------
+
+register('register_manager', "INSERT INTO Manager (ssn, name, email) VALUES (%s, %s, %s)")
+register('manager_login', "SELECT * FROM Manager WHERE ssn = %s")
+register('delete_car_brand', "DELETE FROM Car WHERE brand = %s")
+register('add_car', "INSERT INTO Car (brand) VALUES (%s)")
+register('add_model', """
+    INSERT INTO Model (car_id, color, construction_year, transmission_type)
+    VALUES (%s, %s, %s, %s)
+""")
+register('delete_car', "DELETE FROM Car WHERE car_id = %s")
+register('delete_model', "DELETE FROM Model WHERE car_id = %s AND model_id = %s")
+register('get_cars', "SELECT car_id, brand FROM Car ORDER BY car_id")
+register('catalog_models', """
+    SELECT c.car_id, m.model_id, c.brand, m.color, m.construction_year, m.transmission_type
+    FROM Model m
+    JOIN Car c ON m.car_id = c.car_id
+    ORDER BY c.car_id, m.model_id
+""")
+register('insert_address', "INSERT INTO Address (nameofroad, number, city) VALUES (%s, %s, %s)")
+register('ensure_address', """
+    INSERT INTO Address (nameofroad, number, city)
+    VALUES (%s, %s, %s)
+    ON CONFLICT (nameofroad, number, city) DO NOTHING
+""")
+register('find_address', "SELECT * FROM Address WHERE nameofroad = %s AND number = %s AND city = %s")
+register('insert_driver', "INSERT INTO Driver (name, nameofroad, number, city) VALUES (%s, %s, %s, %s)")
+register('lock_driver', "SELECT 1 FROM Driver WHERE name = %s FOR UPDATE")
+register('driver_active_rent', "SELECT rent_id FROM Rent WHERE name = %s AND rent_date >= CURRENT_DATE LIMIT 1")
+register('delete_driver_reviews', "DELETE FROM Review WHERE name = %s")
+register('delete_driver_models', "DELETE FROM Driver_Model WHERE name = %s")
+register('delete_driver_rents', "DELETE FROM Rent WHERE name = %s")
+register('delete_driver', "DELETE FROM Driver WHERE name = %s")
+
+# -------------------- Dashboards --------------------
+
+register('top_k_clients', """
+    SELECT c.name, c.email_address, s.rent_count, CURRENT_TIMESTAMP
+    FROM client_rent_stats s
+    JOIN Client c ON c.email_address = s.client_email
+    WHERE s.rent_count > 0
+    ORDER BY s.rent_count DESC
+    LIMIT %s
+""")
+register('model_usage', """
+    SELECT m.model_id, m.color, m.construction_year, COALESCE(s.times_rented, 0) AS times_rented,
+           CURRENT_TIMESTAMP
+    FROM Model m
+    LEFT JOIN model_rent_stats s ON s.model_id = m.model_id AND s.car_id = m.car_id
+    ORDER BY times_rented DESC
+""")
+
+# Rents and reviews are aggregated separately and joined one row per driver,
+# never rents x reviews. Without a date window the rent count comes straight
+# from the summary table; with one, Rent is aggregated over just that window.
+# Ratings are all-time plus the recent average kept by analytics.py; neither
+# depends on the date window.
+DRIVER_STATS_SQL = """
+    SELECT d.name, {total_rents} AS total_rents,
+           ROUND(s.rating_sum::numeric / NULLIF(s.rating_count, 0), 2) AS avg_rating,
+           ROUND((s.recent_rating_sum / NULLIF(s.recent_rating_weight, 0))::numeric, 2) AS recent_avg_rating,
+           CURRENT_TIMESTAMP
+    FROM Driver d
+    LEFT JOIN driver_rent_stats s ON s.name = d.name
+    {rents_join}
+    WHERE (%(city)s::text IS NULL OR d.city = %(city)s)
+    ORDER BY total_rents DESC, d.name
+    LIMIT %(limit)s OFFSET %(offset)s
+"""
+register('driver_stats', DRIVER_STATS_SQL.format(total_rents="COALESCE(s.total_rents, 0)", rents_join=""))
+register('driver_stats_window', DRIVER_STATS_SQL.format(total_rents="COALESCE(r.total_rents, 0)", rents_join="""
+    LEFT JOIN (
+        SELECT name, COUNT(*) AS total_rents
+        FROM Rent
+        WHERE (%(from_date)s::date IS NULL OR rent_date >= %(from_date)s)
+          AND (%(to_date)s::date IS NULL OR rent_date <= %(to_date)s)
+        GROUP BY name
+    ) r ON r.name = d.name
+"""))
+
+# Find the matching emails through the city index and the client x
+# driver-city matrix (analytics.py), then look up Client by primary key for
+# just those, instead of joining Rent and Driver
+register('clients_by_city', """
+    SELECT cl.name, cl.email_address
+    FROM (
+        SELECT DISTINCT ca.client_email
+        FROM Client_Address ca
+        JOIN driver_city_rent_stats s ON s.client_email = ca.client_email
+        WHERE ca.city = %s AND s.driver_city = %s AND s.rent_count > 0
+    ) matches
+    JOIN Client cl ON cl.email_address = matches.client_email
+""")
+
+# /manager/clients_by_cities: one row per (client city, driver city, client)
+# with the client's rent count. A client with addresses in several of the
+# requested cities counts under each of them. Without a date window the
+# counts come from the matrix; with one, Rent is aggregated over the window.
+CITY_PAIRS_SQL = """
+    WITH client_cities AS (
+        SELECT DISTINCT client_email, city
+        FROM Client_Address
+        WHERE city = ANY(%(client_cities)s::text[])
+    ),
+    pairs AS ({pairs})
+    {select}
+"""
+CITY_PAIRS = """
+    SELECT ca.city AS client_city, s.driver_city, s.client_email, s.rent_count
+    FROM client_cities ca
+    JOIN driver_city_rent_stats s ON s.client_email = ca.client_email
+    WHERE s.driver_city = ANY(%(driver_cities)s::text[]) AND s.rent_count > 0
+"""
+CITY_PAIRS_WINDOW = """
+    SELECT ca.city AS client_city, d.city AS driver_city, r.client_email, COUNT(*) AS rent_count
+    FROM client_cities ca
+    JOIN Rent r ON r.client_email = ca.client_email
+    JOIN Driver d ON d.name = r.name
+    WHERE d.city = ANY(%(driver_cities)s::text[])
+      AND (%(from_date)s::date IS NULL OR r.rent_date >= %(from_date)s)
+      AND (%(to_date)s::date IS NULL OR r.rent_date <= %(to_date)s)
+    GROUP BY ca.city, d.city, r.client_email
+"""
+CITY_PAIR_COUNTS = """
+    SELECT client_city, driver_city, COUNT(*) AS clients, SUM(rent_count)::bigint AS rents, CURRENT_TIMESTAMP
+    FROM pairs
+    GROUP BY client_city, driver_city
+    ORDER BY client_city, driver_city
+"""
+CITY_PAIR_CLIENTS = """
+    SELECT p.client_city, p.driver_city, c.name, c.email_address, p.rent_count, CURRENT_TIMESTAMP
+    FROM pairs p
+    JOIN Client c ON c.email_address = p.client_email
+    ORDER BY p.client_city, p.driver_city, c.email_address
+    LIMIT %(limit)s OFFSET %(offset)s
+"""
+register('city_pair_counts', CITY_PAIRS_SQL.format(pairs=CITY_PAIRS, select=CITY_PAIR_COUNTS))
+register('city_pair_counts_window', CITY_PAIRS_SQL.format(pairs=CITY_PAIRS_WINDOW, select=CITY_PAIR_COUNTS))
+register('city_pair_clients', CITY_PAIRS_SQL.format(pairs=CITY_PAIRS, select=CITY_PAIR_CLIENTS))
+register('city_pair_clients_window', CITY_PAIRS_SQL.format(pairs=CITY_PAIRS_WINDOW, select=CITY_PAIR_CLIENTS))
+
+# -------------------- Driver --------------------
+
+register('driver_login', "SELECT * FROM Driver WHERE name = %s")
+register('update_driver_address', """
+    UPDATE Driver
+    SET nameofroad = %s, number = %s, city = %s
+    WHERE name = %s
+""")
+register('list_models', "SELECT * FROM Model")
+register('declare_driver_model', "INSERT INTO Driver_Model (name, model_id, car_id) VALUES (%s, %s, %s)")
+
+# -------------------- Client --------------------
+
+register('register_client', "INSERT INTO Client (email_address, name) VALUES (%s, %s)")
+register('link_client_address', """
+    INSERT INTO Client_Address (client_email, nameofroad, number, city)
+    VALUES (%s, %s, %s, %s)
+    ON CONFLICT (client_email, nameofroad, number, city) DO NOTHING
+    RETURNING *
+""")
+register('add_creditcard', """
+    INSERT INTO CreditCard (ccnum, client_email, nameofroad, number, city)
+    VALUES (%s, %s, %s, %s, %s)
+""")
+register('client_login', "SELECT * FROM Client WHERE email_address = %s")
+
+# One set-based pass over the whole window: rents are aggregated once per
+# (day, model) and (day, driver) instead of probed per day.
+register('available_models_range', """
+    WITH days AS (
+        SELECT d::date AS day
+        FROM generate_series(%(start_date)s::date, %(end_date)s::date, interval '1 day') d
+    ),
+    booked AS (
+        SELECT DISTINCT rent_date, model_id, car_id
+        FROM Rent
+        WHERE rent_date BETWEEN %(start_date)s AND %(end_date)s
+    ),
+    busy AS (
+        SELECT DISTINCT rent_date, name
+        FROM Rent
+        WHERE rent_date BETWEEN %(start_date)s AND %(end_date)s
+    ),
+    candidates AS (
+        SELECT m.model_id, m.car_id, c.brand, m.color, m.construction_year, m.transmission_type
+        FROM Model m
+        JOIN Car c ON m.car_id = c.car_id
+        WHERE (%(brand)s::text IS NULL OR c.brand = %(brand)s)
+          AND (%(transmission_type)s::text IS NULL OR m.transmission_type = %(transmission_type)s)
+          AND (%(color)s::text IS NULL OR m.color = %(color)s)
+    )
+    SELECT days.day, cm.model_id, cm.car_id, cm.brand, cm.color,
+           cm.construction_year, cm.transmission_type,
+           COUNT(*) FILTER (WHERE busy.name IS NULL) AS free_drivers
+    FROM days
+    CROSS JOIN candidates cm
+    JOIN Driver_Model dm ON dm.model_id = cm.model_id AND dm.car_id = cm.car_id
+    LEFT JOIN busy ON busy.rent_date = days.day AND busy.name = dm.name
+    WHERE NOT EXISTS (
+        SELECT 1 FROM booked b
+        WHERE b.rent_date = days.day AND b.model_id = cm.model_id AND b.car_id = cm.car_id
+    )
+    GROUP BY days.day, cm.model_id, cm.car_id, cm.brand, cm.color,
+             cm.construction_year, cm.transmission_type
+    HAVING COUNT(*) FILTER (WHERE busy.name IS NULL) > 0
+    ORDER BY days.day, cm.model_id, cm.car_id
+""")
@@ -0,0 +1,119 @@
+# request_log.py
+#
+# Request capture for bench/replay.py. With TAXI_REQUEST_LOG set to a file
+# path, every request is appended to it as one JSON line:
+#
+#   {"ts": 1760774400.123, "method": "POST", "path": "/client/book_rent",
+#    "query": "", "body": {...}, "status": 200, "duration_ms": 4.1,
+#    "response": {...}}
+#
+# "response" is the JSON response body, or null for streamed, non-JSON or
+# larger than TAXI_REQUEST_LOG_MAX_BODY bytes responses. Values of
+# SECRET_FIELDS (card numbers, session tokens) in bodies and query strings
+# are replaced by a keyed hash, so a replay still sees distinct values but
+# the log never holds the real ones. Identities (SSNs, email addresses) are
+# kept, since a replay has to log in as and book for the clients that exist
+# in the restored database. With TAXI_REQUEST_LOG_PSEUDONYMIZE=1 they are
+# hashed too; such a log only replays against a copy of the database whose
+# identities were hashed the same way. The key is TAXI_REQUEST_LOG_KEY, so
+# that all workers, and restarts, hash a value alike; without it each
+# process draws a random one.
+#
+# Each worker process appends whole lines with O_APPEND, so several workers
+# can share one log file. asgi.py logs its native async routes the same way.
+
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import time
+from urllib.parse import parse_qsl, urlencode
+
+from flask import g, request
+
+LOG_PATH = os.environ.get('TAXI_REQUEST_LOG')
+MAX_BODY = int(os.environ.get('TAXI_REQUEST_LOG_MAX_BODY', '65536'))
+
+SECRET_FIELDS = frozenset(['ccnum', 'token'])
+IDENTITY_FIELDS = frozenset(['ssn', 'email', 'email_address', 'client_email'])
+PSEUDONYMIZE = os.environ.get('TAXI_REQUEST_LOG_PSEUDONYMIZE', '0') == '1'
+
+REDACTED_FIELDS = SECRET_FIELDS | IDENTITY_FIELDS if PSEUDONYMIZE else SECRET_FIELDS
+
+_key = os.environ.get('TAXI_REQUEST_LOG_KEY', '').encode() or secrets.token_bytes(16)
+_fd = None
+_fd_pid = None
+
+
+def redact(value):
+    if isinstance(value, dict):
+        return {k: _token(v) if k in REDACTED_FIELDS and v is not None else redact(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [redact(v) for v in value]
+    return value
+
+
+def redact_query(query):
+    pairs = parse_qsl(query, keep_blank_values=True)
+    if not any(k in REDACTED_FIELDS for k, _ in pairs):
+        return query
+    return urlencode([(k, _token(v) if k in REDACTED_FIELDS else v) for k, v in pairs])
+
+
+def _token(value):
+    # Short enough for the VARCHAR(20) card number column
+    return 'r-' + hmac.new(_key, str(value).encode(), hashlib.sha256).hexdigest()[:16]
+
+
+def _write(entry):
+    global _fd, _fd_pid
+    # Opened lazily so a preloaded app gets one descriptor per forked worker
+    if _fd is None or _fd_pid != os.getpid():
+        _fd = os.open(LOG_PATH, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        _fd_pid = os.getpid()
+    os.write(_fd, (json.dumps(entry, default=str) + '\n').encode())
+
+
+def _start():
+    g.request_log_started = (time.time(), time.perf_counter())
+
+
+def _after(response):
+    started = g.pop('request_log_started', None)
+    if started is None:
+        return response
+    body = request.get_json(silent=True) if request.is_json else None
+    captured = None
+    if not response.is_streamed and response.is_json and (response.content_length or 0) <= MAX_BODY:
+        captured = response.get_json(silent=True)
+    record(started, request.method, request.path, request.query_string.decode(), body,
+           response.status_code, captured)
+    return response
+
+
+def record(started, method, path, query, body, status, response):
+    """Append one request, started at started = (time.time(), time.perf_counter()).
+
+    Also called by asgi.py for its native routes.
+    """
+    try:
+        _write({
+            'ts': round(started[0], 3),
+            'method': method,
+            'path': path,
+            'query': redact_query(query),
+            'body': redact(body),
+            'status': status,
+            'duration_ms': round((time.perf_counter() - started[1]) * 1000, 3),
+            'response': redact(response),
+        })
+    except OSError:
+        pass   # never fail a request because the log is unwritable
+
+
+def install(app):
+    """Log every request of app to TAXI_REQUEST_LOG, if it is set."""
+    if LOG_PATH:
+        app.before_request(_start)
+        app.after_request(_after)
@@ -0,0 +1,103 @@
+# reviews.py
+#
+# Review ingestion. Eligibility (the client has rented the driver before) is
+# checked for the whole batch in the statement that inserts the eligible
+# reviews, so adding one review or five hundred is a single round trip. The
+# Review insert trigger (analytics.py) folds the new ratings into each
+# driver's all-time and recent averages in the same transaction.
+
+import queries
+
+MAX_BATCH_SIZE = 500
+
+FAILURE_MESSAGES = {
+    'invalid': "client_email and driver_name are required and rating must be between 1 and 5",
+    'no_rent': "You cannot review this driver. No previous rent found.",
+}
+
+# Review ids are drawn in the eligible CTE so each can be reported against
+# its input position.
+ADD_REVIEWS_SQL = """
+    WITH input AS (
+        SELECT *
+        FROM unnest(%(positions)s::int[], %(client_emails)s::text[], %(driver_names)s::text[],
+                    %(messages)s::text[], %(ratings)s::int[])
+            AS t(position, client_email, name, message, rating)
+    ),
+    eligible AS MATERIALIZED (
+        SELECT nextval(pg_get_serial_sequence('review', 'review_id')) AS review_id, i.*
+        FROM input i
+        WHERE EXISTS (SELECT 1 FROM Rent r WHERE r.client_email = i.client_email AND r.name = i.name)
+        ORDER BY i.position
+    ),
+    inserted AS (
+        INSERT INTO Review (review_id, name, client_email, message, rating)
+        SELECT review_id, name, client_email, message, rating FROM eligible
+    )
+    SELECT position, review_id FROM eligible
+"""
+queries.register('add_reviews', ADD_REVIEWS_SQL)
+
+
+def normalize(review):
+    """(client_email, driver_name, message, rating) for a valid review dict, else None."""
+    if not isinstance(review, dict):
+        return None
+    client_email = review.get('client_email')
+    driver_name = review.get('driver_name')
+    rating = review.get('rating')
+    if not client_email or not driver_name:
+        return None
+    if rating is not None and rating != '':
+        try:
+            rating = int(rating)
+        except (TypeError, ValueError):
+            return None
+        if not 1 <= rating <= 5:
+            return None
+    else:
+        rating = None
+    return client_email, driver_name, review.get('message'), rating
+
+
+def add_reviews(conn, reviews):
+    """Insert every eligible review of the batch in one statement and commit.
+
+    Returns one result per review, in order: {'added': True, 'review_id',
+    'driver_name', 'rating'} or {'added': False, 'reason', 'error'} with a
+    reason from FAILURE_MESSAGES. Ineligible reviews do not stop the others.
+    """
+    results = [None] * len(reviews)
+    valid = {}
+    for i, review in enumerate(reviews):
+        fields = normalize(review)
+        if fields is None:
+            results[i] = {'added': False, 'reason': 'invalid', 'error': FAILURE_MESSAGES['invalid']}
+        else:
+            valid[i] = fields
+
+    if valid:
+        positions = list(valid)
+        cur = conn.cursor()
+        try:
+            queries.execute(cur, 'add_reviews', {
+                'positions': positions,
+                'client_emails': [valid[i][0] for i in positions],
+                'driver_names': [valid[i][1] for i in positions],
+                'messages': [valid[i][2] for i in positions],
+                'ratings': [valid[i][3] for i in positions],
+            })
+            added = dict(cur.fetchall())
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cur.close()
+        for i in positions:
+            if i in added:
+                results[i] = {'added': True, 'review_id': added[i], 'driver_name': valid[i][1],
+                              'rating': valid[i][3]}
+            else:
+                results[i] = {'added': False, 'reason': 'no_rent', 'error': FAILURE_MESSAGES['no_rent']}
+    return results
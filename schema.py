@@ -0,0 +1,230 @@
+# schema.py
+#
+# Versioned schema for the taxi database. Each migration runs once, in its
+# own transaction, and is recorded in schema_migrations. Every step is
+# written with IF NOT EXISTS / OR REPLACE, so a database created by hand
+# before this file existed is brought up to date without errors.
+#
+#   python schema.py            # apply pending migrations
+#   python schema.py --status   # list applied and pending migrations
+#
+# bench/check_plans.py seeds a large dataset and fails if any hot query
+# plans a sequential scan, so add the index here when adding a new lookup.
+
+import sys
+
+import admission
+import analytics
+import booking
+import idempotency
+import outbox
+from database import get_connection
+
+# Serialises migration runs across processes (app.py, serve.py, workers)
+MIGRATION_LOCK_ID = 0x7a11
+
+MIGRATIONS_TABLE = """
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        version INTEGER PRIMARY KEY,
+        description TEXT NOT NULL,
+        applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    )
+"""
+
+BASE_TABLES = """
+    CREATE TABLE IF NOT EXISTS Manager (
+        ssn VARCHAR(20) PRIMARY KEY,
+        name VARCHAR(100) NOT NULL,
+        email VARCHAR(100) NOT NULL
+    );
+
+    CREATE TABLE IF NOT EXISTS Car (
+        car_id SERIAL PRIMARY KEY,
+        brand VARCHAR(50) NOT NULL
+    );
+
+    CREATE TABLE IF NOT EXISTS Model (
+        model_id SERIAL,
+        car_id INTEGER NOT NULL REFERENCES Car (car_id) ON DELETE CASCADE,
+        color VARCHAR(30),
+        construction_year INTEGER,
+        transmission_type VARCHAR(20),
+        PRIMARY KEY (model_id, car_id)
+    );
+
+    CREATE TABLE IF NOT EXISTS Address (
+        nameofroad VARCHAR(100),
+        number INTEGER,
+        city VARCHAR(50),
+        PRIMARY KEY (nameofroad, number, city)
+    );
+
+    CREATE TABLE IF NOT EXISTS Driver (
+        name VARCHAR(100) PRIMARY KEY,
+        nameofroad VARCHAR(100) NOT NULL,
+        number INTEGER NOT NULL,
+        city VARCHAR(50) NOT NULL,
+        FOREIGN KEY (nameofroad, number, city) REFERENCES Address (nameofroad, number, city)
+    );
+
+    CREATE TABLE IF NOT EXISTS Driver_Model (
+        name VARCHAR(100) REFERENCES Driver (name),
+        model_id INTEGER,
+        car_id INTEGER,
+        PRIMARY KEY (name, model_id, car_id),
+        FOREIGN KEY (model_id, car_id) REFERENCES Model (model_id, car_id) ON DELETE CASCADE
+    );
+
+    CREATE TABLE IF NOT EXISTS Client (
+        email_address VARCHAR(100) PRIMARY KEY,
+        name VARCHAR(100) NOT NULL
+    );
+
+    CREATE TABLE IF NOT EXISTS Client_Address (
+        client_email VARCHAR(100) REFERENCES Client (email_address),
+        nameofroad VARCHAR(100),
+        number INTEGER,
+        city VARCHAR(50),
+        PRIMARY KEY (client_email, nameofroad, number, city),
+        FOREIGN KEY (nameofroad, number, city) REFERENCES Address (nameofroad, number, city)
+    );
+
+    CREATE TABLE IF NOT EXISTS CreditCard (
+        ccnum VARCHAR(20) PRIMARY KEY,
+        client_email VARCHAR(100) NOT NULL REFERENCES Client (email_address),
+        nameofroad VARCHAR(100) NOT NULL,
+        number INTEGER NOT NULL,
+        city VARCHAR(50) NOT NULL,
+        FOREIGN KEY (nameofroad, number, city) REFERENCES Address (nameofroad, number, city)
+    );
+
+    CREATE TABLE IF NOT EXISTS Rent (
+        rent_id SERIAL PRIMARY KEY,
+        rent_date DATE NOT NULL,
+        client_email VARCHAR(100) NOT NULL REFERENCES Client (email_address),
+        name VARCHAR(100) NOT NULL REFERENCES Driver (name),
+        model_id INTEGER NOT NULL,
+        car_id INTEGER NOT NULL,
+        FOREIGN KEY (model_id, car_id) REFERENCES Model (model_id, car_id) ON DELETE CASCADE
+    );
+
+    CREATE TABLE IF NOT EXISTS Review (
+        review_id SERIAL PRIMARY KEY,
+        name VARCHAR(100) NOT NULL REFERENCES Driver (name),
+        client_email VARCHAR(100) NOT NULL REFERENCES Client (email_address),
+        message TEXT,
+        rating INTEGER CHECK (rating BETWEEN 1 AND 5)
+    );
+"""
+
+# Reviews written before this column existed are dated to the migration
+REVIEW_TIMESTAMPS = """
+    ALTER TABLE Review ADD COLUMN IF NOT EXISTS created_at TIMESTAMPTZ NOT NULL DEFAULT now();
+"""
+
+# One index per lookup the handlers make. booking.BOOKING_CONSTRAINTS
+# already covers Rent (model_id, car_id, rent_date) and Rent (name, rent_date).
+HOT_QUERY_INDEXES = """
+    -- /client/view_rents: keyset pages by (rent_date, rent_id) DESC per client;
+    -- INCLUDE lets the page come from the index without heap lookups for the join keys
+    CREATE INDEX IF NOT EXISTS rent_client_date_idx
+        ON Rent (client_email, rent_date DESC, rent_id DESC) INCLUDE (name, model_id, car_id);
+
+    -- /client/available_models_range and the weekly assignment counters scan a date range
+    CREATE INDEX IF NOT EXISTS rent_date_idx
+        ON Rent (rent_date) INCLUDE (name, model_id, car_id);
+
+    -- Drivers capable of a model (booking, availability); also the Model delete cascade
+    CREATE INDEX IF NOT EXISTS driver_model_model_idx
+        ON Driver_Model (model_id, car_id) INCLUDE (name);
+
+    -- Car delete cascade and Model JOIN Car
+    CREATE INDEX IF NOT EXISTS model_car_idx ON Model (car_id);
+
+    -- /manager/delete_car_brand and the brand filter on available_models_range
+    CREATE INDEX IF NOT EXISTS car_brand_idx ON Car (brand);
+
+    -- /manager/driver_stats city filter and /manager/clients_by_city
+    CREATE INDEX IF NOT EXISTS driver_city_idx ON Driver (city);
+    CREATE INDEX IF NOT EXISTS client_address_city_idx ON Client_Address (city) INCLUDE (client_email);
+
+    -- Driver ratings and /manager/delete_driver
+    CREATE INDEX IF NOT EXISTS review_name_idx ON Review (name) INCLUDE (rating);
+
+    -- Client foreign keys
+    CREATE INDEX IF NOT EXISTS review_client_idx ON Review (client_email);
+    CREATE INDEX IF NOT EXISTS creditcard_client_idx ON CreditCard (client_email);
+"""
+
+# (version, description, step). A step is SQL text or a function taking a cursor.
+# Never edit a migration that has shipped; append a new one instead.
+MIGRATIONS = [
+    (1, "base tables", BASE_TABLES),
+    (2, "booking uniqueness constraints", booking.BOOKING_CONSTRAINTS),
+    (3, "dashboard summary tables and triggers", analytics.create),
+    (4, "indexes for hot queries", HOT_QUERY_INDEXES + "ANALYZE Rent, Driver_Model, Review;"),
+    (5, "review timestamps", REVIEW_TIMESTAMPS),
+    (6, "recent driver rating average", analytics.add_rating_window),
+    (7, "client x driver-city rent matrix", analytics.add_city_matrix),
+    (8, "idempotency keys", idempotency.IDEMPOTENCY_TABLE),
+    (9, "transactional outbox", outbox.create),
+    (10, "shared rate limit buckets", admission.RATE_LIMIT_TABLE),
+]
+
+
+def applied_versions(cur):
+    cur.execute(MIGRATIONS_TABLE)
+    cur.execute("SELECT version FROM schema_migrations")
+    return {row[0] for row in cur.fetchall()}
+
+
+def migrate(conn):
+    """Apply pending migrations in order. Returns the versions applied."""
+    applied = []
+    cur = conn.cursor()
+    try:
+        for version, description, step in MIGRATIONS:
+            cur.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATION_LOCK_ID,))
+            if version in applied_versions(cur):
+                conn.rollback()
+                continue
+            if callable(step):
+                step(cur)
+            else:
+                cur.execute(step)
+            cur.execute("INSERT INTO schema_migrations (version, description) VALUES (%s, %s)",
+                        (version, description))
+            conn.commit()
+            applied.append(version)
+        return applied
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+
+
+def status(conn):
+    """Return (version, description, applied_at or None) for every known migration."""
+    cur = conn.cursor()
+    try:
+        cur.execute(MIGRATIONS_TABLE)
+        cur.execute("SELECT version, applied_at FROM schema_migrations")
+        applied = dict(cur.fetchall())
+        conn.commit()
+        return [(version, description, applied.get(version)) for version, description, _ in MIGRATIONS]
+    finally:
+        cur.close()
+
+
+if __name__ == '__main__':
+    conn = get_connection()
+    try:
+        if '--status' in sys.argv:
+            for version, description, applied_at in status(conn):
+                print("%3d  %-40s %s" % (version, description, applied_at or 'pending'))
+        else:
+            applied = migrate(conn)
+            print("Applied migrations: %s" % (applied or 'none, schema is up to date'))
+    finally:
+        conn.close()
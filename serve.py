@@ -0,0 +1,102 @@
+# serve.py
+#
+# Production entry point: pre-forked gunicorn workers running the same `app`
+# object as app.py, with the Werkzeug debugger and reloader off.
+#
+#   python serve.py
+#   TAXI_WORKERS=8 TAXI_BIND=0.0.0.0:5050 python serve.py
+#
+# Signals, sent to the master process:
+#   TERM / INT   graceful shutdown: stop accepting, let in-flight requests drain
+#   HUP          replace every worker with a fresh one without dropping requests
+#   USR2         start a new master running the current code next to the old
+#                one; then send TERM to the old master for a zero-downtime deploy
+
+import multiprocessing
+import os
+
+BIND = os.environ.get('TAXI_BIND', '127.0.0.1:5050')
+WORKERS = int(os.environ.get('TAXI_WORKERS', str(multiprocessing.cpu_count() * 2 + 1)))
+THREADS = int(os.environ.get('TAXI_THREADS', '4'))
+MAX_REQUESTS = int(os.environ.get('TAXI_MAX_REQUESTS', '10000'))          # recycle a worker after this many
+MAX_REQUESTS_JITTER = int(os.environ.get('TAXI_MAX_REQUESTS_JITTER', str(MAX_REQUESTS // 10)))
+GRACEFUL_TIMEOUT = int(os.environ.get('TAXI_GRACEFUL_TIMEOUT', '30'))     # seconds to drain on shutdown
+TIMEOUT = int(os.environ.get('TAXI_WORKER_TIMEOUT', '60'))
+
+# Each worker gets its own pool; size it to the worker's threads unless told
+# otherwise so WORKERS x pool size stays under Postgres max_connections.
+os.environ.setdefault('TAXI_DB_POOL_MIN', '1')
+os.environ.setdefault('TAXI_DB_POOL_MAX', str(THREADS + 1))
+
+from gunicorn.app.base import BaseApplication
+
+import database
+
+
+def when_ready(server):
+    # Runs once in the master, after the app has been preloaded
+    from app import install_schema
+    install_schema()
+    # Close the master's connections so no worker inherits its sockets
+    database.close_pool()
+
+
+def post_fork(server, worker):
+    # get_pool() is pid-aware, so this only drops the reference; the worker
+    # opens its own connections on first use.
+    database.close_pool()
+
+
+def post_worker_init(worker):
+    # Fresh in-memory indexes per worker, including workers recycled after
+    # MAX_REQUESTS, so none of them starts from a stale copy. The outbox
+    # dispatcher takes its start position first, so events committed during
+    # the rebuild are still delivered to the index afterwards.
+    import outbox
+    from app import availability_index, assignment
+    outbox.dispatcher.ensure_started()
+    try:
+        availability_index.rebuild()
+        assignment.counters.rebuild()
+    except Exception as e:
+        worker.log.warning("Could not build in-memory indexes: %s", e)
+
+
+def worker_exit(server, worker):
+    database.close_pool()
+
+
+class TaxiApplication(BaseApplication):
+    def __init__(self, options):
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        from app import app
+        return app
+
+
+def options():
+    return {
+        'bind': BIND,
+        'workers': WORKERS,
+        'worker_class': 'gthread',
+        'threads': THREADS,
+        'preload_app': True,
+        'max_requests': MAX_REQUESTS,
+        'max_requests_jitter': MAX_REQUESTS_JITTER,
+        'graceful_timeout': GRACEFUL_TIMEOUT,
+        'timeout': TIMEOUT,
+        'when_ready': when_ready,
+        'post_fork': post_fork,
+        'post_worker_init': post_worker_init,
+        'worker_exit': worker_exit,
+    }
+
+
+if __name__ == '__main__':
+    TaxiApplication(options()).run()
@@ -0,0 +1,185 @@
+# sessions.py
+#
+# Signed, stateless session tokens. The login routes issue one per manager,
+# driver or client; it carries the role and identity and is checked with an
+# HMAC over its payload, so verifying it takes no database round trip:
+#
+#   Authorization: Bearer <base64url payload>.<base64url HMAC-SHA256>
+#   payload: {"role": "client", "sub": "a@b.com", "iat": ..., "exp": ..., "jti": ...}
+#
+# The payload is signed, not encrypted, so anyone holding a token can read
+# it. Managers log in with their SSN, and their tokens carry subject_id(ssn),
+# an opaque id derived from it, rather than the SSN itself.
+#
+# require(role) guards a route group. A request that presents a token must
+# present a valid, unrevoked one for that role, and the identity field it
+# sends (client_email, a driver's name) must be the token's; a JSON body that
+# leaves the field out gets the token's identity filled in. Only routes that
+# name an identity field have their body parsed, so routes that read the raw
+# request stream (bulk import) must not name one. Requests without
+# a token are let through unless TAXI_REQUIRE_SESSION=1, so clients that do
+# not send tokens yet keep working.
+#
+# Set TAXI_SESSION_SECRET to the same value on every host. Without it each
+# master process signs with its own random key (shared by its forked
+# workers), and tokens stop verifying after a restart. Revoked token ids are
+# held in memory per process until the token would have expired anyway.
+
+import base64
+import binascii
+import functools
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import threading
+import time
+
+from flask import g, jsonify, request
+
+SECRET = os.environ.get('TAXI_SESSION_SECRET', '').encode() or secrets.token_bytes(32)
+SESSION_TTL = int(os.environ.get('TAXI_SESSION_TTL', str(12 * 3600)))     # seconds a token stays valid
+REQUIRE_SESSION = os.environ.get('TAXI_REQUIRE_SESSION', '0') == '1'
+
+ROLES = ('manager', 'driver', 'client')
+
+
+class SessionError(Exception):
+    pass
+
+
+def _b64encode(raw):
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode()
+
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+def _sign(payload):
+    return hmac.new(SECRET, payload.encode(), hashlib.sha256).digest()
+
+
+class RevocationSet:
+    """Token ids revoked before expiry, forgotten once the token expires."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._revoked = {}   # jti -> exp
+        self._next_prune = 0.0
+
+    def add(self, jti, exp):
+        now = time.time()
+        with self._lock:
+            self._revoked[jti] = exp
+            if now >= self._next_prune:
+                self._revoked = {k: v for k, v in self._revoked.items() if v > now}
+                self._next_prune = now + 60
+
+    def __contains__(self, jti):
+        return jti in self._revoked
+
+    def __len__(self):
+        return len(self._revoked)
+
+
+revoked = RevocationSet()
+
+
+def subject_id(secret_value):
+    """A stable, opaque subject for an identity that must not appear in tokens."""
+    digest = hmac.new(SECRET, b'subject:' + secret_value.encode(), hashlib.sha256).digest()
+    return _b64encode(digest[:12])
+
+
+def issue(role, identity, ttl=None):
+    """A new token for identity in role, as {'token', 'expires_at'}."""
+    if role not in ROLES:
+        raise ValueError("Unknown role %r" % role)
+    now = int(time.time())
+    claims = {'role': role, 'sub': identity, 'iat': now, 'exp': now + (ttl or SESSION_TTL),
+              'jti': secrets.token_hex(8)}
+    payload = _b64encode(json.dumps(claims, separators=(',', ':')).encode())
+    return {'token': payload + '.' + _b64encode(_sign(payload)), 'expires_at': claims['exp']}
+
+
+def verify(token):
+    """The claims of a valid token; raises SessionError otherwise."""
+    payload, _, signature = token.partition('.')
+    try:
+        valid = hmac.compare_digest(_b64decode(signature), _sign(payload))
+        claims = json.loads(_b64decode(payload)) if valid else None
+    except (binascii.Error, ValueError):
+        raise SessionError("Malformed session token")
+    if not valid or not isinstance(claims, dict):
+        raise SessionError("Invalid session token")
+    if claims.get('exp', 0) <= time.time():
+        raise SessionError("Session expired")
+    if claims.get('jti') in revoked:
+        raise SessionError("Session revoked")
+    return claims
+
+
+def revoke(claims):
+    revoked.add(claims['jti'], claims['exp'])
+
+
+def bearer_token(headers):
+    scheme, _, token = headers.get('Authorization', '').partition(' ')
+    return token.strip() if scheme.lower() == 'bearer' and token.strip() else None
+
+
+def current():
+    """Claims of this request's verified session, or None."""
+    return g.get('session')
+
+
+def authorize(role, token, identity=None, data=None, query=None):
+    """Check a request's token for a route of role.
+
+    Returns (claims, None) or (None, (message, status)); claims is None for
+    an anonymous request that is let through. identity names the field of
+    the JSON body data or query string query that must match the subject;
+    it is filled in from the token when data leaves it out.
+    """
+    if token is None:
+        return None, (("Login required", 401) if REQUIRE_SESSION else None)
+    try:
+        claims = verify(token)
+    except SessionError as e:
+        return None, (str(e), 401)
+    if claims.get('role') != role:
+        return None, ("This route needs a %s session" % role, 403)
+    if identity:
+        subject = claims['sub']
+        mismatch = (query or {}).get(identity, subject) != subject
+        if isinstance(data, dict):
+            if data.get(identity) is None:
+                data[identity] = subject
+            elif str(data[identity]) != subject:
+                mismatch = True
+        if mismatch:
+            return None, ("%s does not match the logged in %s" % (identity, role), 403)
+    return claims, None
+
+
+def require(role, identity=None):
+    """Decorator: the route needs a session of role; see authorize()."""
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            # get_json() caches the body, so the view sees a filled-in identity.
+            # Without an identity field the body is left unread for the view.
+            data = request.get_json(silent=True) if identity and request.is_json else None
+            claims, error = authorize(role, bearer_token(request.headers), identity, data, request.args)
+            if error:
+                response = jsonify({'error': error[0]})
+                response.status_code = error[1]
+                if error[1] == 401:
+                    response.headers['WWW-Authenticate'] = 'Bearer'
+                return response
+            g.session = claims
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
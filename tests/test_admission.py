@@ -0,0 +1,160 @@
+# Unit tests for admission control's buckets, gates and identities; no
+# database needed.
+#
+#   python -m pytest tests
+
+import threading
+import time
+
+import pytest
+
+import admission
+from admission import Controller, Gate, MemoryBuckets, Rejected
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(admission.time, 'monotonic', clock)
+    return clock
+
+
+# -------------------- MemoryBuckets --------------------
+
+def test_bucket_starts_full_and_empties(clock):
+    buckets = MemoryBuckets()
+    assert [buckets.take('k', rate=1, burst=3)[0] for _ in range(4)] == [True, True, True, False]
+
+
+def test_bucket_refills_at_rate(clock):
+    buckets = MemoryBuckets()
+    for _ in range(2):
+        buckets.take('k', rate=2, burst=2)
+    allowed, retry_after = buckets.take('k', rate=2, burst=2)
+    assert not allowed and retry_after == pytest.approx(0.5)
+    clock.now += 0.5
+    assert buckets.take('k', rate=2, burst=2) == (True, 0.0)
+    clock.now += 60   # refill stops at the burst
+    assert [buckets.take('k', rate=2, burst=2)[0] for _ in range(3)] == [True, True, False]
+
+
+def test_buckets_are_per_key(clock):
+    buckets = MemoryBuckets()
+    assert buckets.take('a', rate=1, burst=1)[0]
+    assert not buckets.take('a', rate=1, burst=1)[0]
+    assert buckets.take('b', rate=1, burst=1)[0]
+
+
+def test_prune_keeps_the_bucket_count_bounded(clock):
+    buckets = MemoryBuckets(max_buckets=3)
+    for key in 'abcde':
+        buckets.take(key, rate=1, burst=1)
+    assert len(buckets) <= 3
+
+
+# -------------------- Gate --------------------
+
+def test_gate_admits_up_to_limit_then_sheds_a_full_queue():
+    gate = Gate('read', limit=1, queue=0, queue_timeout=1.0)
+    gate.enter()
+    with pytest.raises(Rejected) as e:
+        gate.enter()
+    assert e.value.status == 503
+    assert gate.shed_queue_full == 1
+    gate.leave()
+    gate.enter()
+    assert gate.admitted == 2
+
+
+def test_gate_sheds_after_the_queue_deadline():
+    gate = Gate('write', limit=1, queue=1, queue_timeout=0.05)
+    gate.enter()
+    started = time.monotonic()
+    with pytest.raises(Rejected) as e:
+        gate.enter()
+    assert e.value.status == 503
+    assert time.monotonic() - started >= 0.05
+    assert (gate.shed_deadline, gate.waiting, gate.in_flight) == (1, 0, 1)
+
+
+def test_gate_hands_a_freed_slot_to_a_waiter():
+    gate = Gate('read', limit=1, queue=1, queue_timeout=5.0)
+    gate.enter()
+    entered = threading.Event()
+
+    def waiter():
+        gate.enter()
+        entered.set()
+
+    thread = threading.Thread(target=waiter)
+    thread.start()
+    while not gate.waiting:
+        time.sleep(0.001)
+    assert not entered.is_set()
+    gate.leave()
+    thread.join(5)
+    assert entered.is_set()
+    assert (gate.in_flight, gate.queued, gate.admitted) == (1, 1, 2)
+
+
+def test_rejected_retry_after_is_whole_seconds():
+    assert Rejected(429, 'slow down', 0.2).headers() == {'Retry-After': '1'}
+    assert Rejected(503, 'busy', 2.5).headers() == {'Retry-After': '3'}
+
+
+# -------------------- Controller and identities --------------------
+
+def test_check_rate_raises_429_per_identity(clock):
+    controller = Controller(MemoryBuckets())
+    burst = int(admission.CLASS_LIMITS['analytics'].burst)
+    for _ in range(burst):
+        controller.check_rate('analytics', '/manager/driver_stats', 'manager:x')
+    with pytest.raises(Rejected) as e:
+        controller.check_rate('analytics', '/manager/driver_stats', 'manager:x')
+    assert e.value.status == 429
+    assert controller.rate_limited['analytics'] == 1
+    controller.check_rate('analytics', '/manager/driver_stats', 'manager:y')
+
+
+def test_requests_without_identity_are_not_rate_limited(clock):
+    controller = Controller(MemoryBuckets())
+    for _ in range(1000):
+        controller.check_rate('analytics', '/manager/driver_stats', None)
+    assert controller.rate_limited['analytics'] == 0
+
+
+def test_anonymous_requests_are_limited_by_address(monkeypatch):
+    monkeypatch.setattr(admission, 'RATE_LIMIT_ADDRESSES', True)
+    assert admission.identity({}, '10.0.0.1') == 'addr:10.0.0.1'
+    # Leaving a bad token on does not escape the address's bucket
+    headers = {'Authorization': 'Bearer not-a-token'}
+    assert admission.identity(headers, '10.0.0.1') == 'addr:10.0.0.1'
+
+
+def test_address_limits_can_be_turned_off(monkeypatch):
+    monkeypatch.setattr(admission, 'RATE_LIMIT_ADDRESSES', False)
+    assert admission.identity({}, '10.0.0.1') is None
+
+
+def test_forwarded_for_is_only_trusted_through_known_proxies(monkeypatch):
+    headers = {'X-Forwarded-For': 'spoofed, 203.0.113.7'}
+    monkeypatch.setattr(admission, 'TRUSTED_PROXIES', 0)
+    assert admission.client_address(headers, '10.0.0.1') == '10.0.0.1'
+    monkeypatch.setattr(admission, 'TRUSTED_PROXIES', 1)
+    assert admission.client_address(headers, '10.0.0.1') == '203.0.113.7'
+    assert admission.client_address({}, '10.0.0.1') == '10.0.0.1'
+
+
+def test_route_classes():
+    assert admission.route_class('/metrics', 'GET') is None
+    assert admission.route_class('/manager/top_k_clients', 'GET') == 'analytics'
+    assert admission.route_class('/client/view_rents', 'POST') == 'read'
+    assert admission.route_class('/client/book_rent', 'POST') == 'write'
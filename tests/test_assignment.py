@@ -0,0 +1,83 @@
+# Unit tests for the kept driver orderings of assignment.py, against an
+# availability index filled by hand; no database needed.
+#
+#   python -m pytest tests
+
+import datetime
+import random
+
+import pytest
+
+import assignment
+from availability import AvailabilityIndex
+
+DAY = datetime.date(2030, 1, 1)
+
+
+@pytest.fixture
+def index():
+    index = AvailabilityIndex()
+    index.loaded = True
+    for model_id in range(3):
+        index._add_model((model_id, 1, 'brand', 'black', 2020, 'auto'))
+    return index
+
+
+@pytest.fixture
+def counters(monkeypatch):
+    counters = assignment.DriverCounters()
+    counters.loaded = True
+    monkeypatch.setattr(assignment, 'counters', counters)
+    return counters
+
+
+def book(index, counters, rent_id, rent_date, name, model_id):
+    index.record_rent(rent_date, name, model_id, 1)
+    counters.record_rent(name, rent_id, rent_date, model_id, 1)
+
+
+@pytest.mark.parametrize('strategy', sorted(assignment.STRATEGIES))
+def test_best_drivers_match_a_full_ranking(index, counters, strategy):
+    rng = random.Random(7)
+    names = ['driver_%02d' % i for i in range(30)]
+    for name in names:
+        for model_id in rng.sample(range(3), 2):
+            index.declare(name, model_id, 1)
+    for rent_id in range(1, 300):
+        rent_date = DAY + datetime.timedelta(days=rng.randrange(10))
+        model_id = rng.randrange(3)
+        free = [name for name in assignment.rank_drivers(index.capable_drivers(model_id, 1), rent_date,
+                                                         model_id, 1, strategy)
+                if index.is_free(rent_date, name)]
+        best = assignment.best_drivers(index, rent_date, model_id, 1, strategy, limit=3)
+        assert best == free[:3]
+        if best:
+            book(index, counters, rent_id, rent_date, best[0], model_id)
+        counters.record_review(rng.choice(names), rng.randint(1, 5))
+        if rng.random() < 0.05:
+            index.undeclare(rng.choice(names), model_id, 1)
+
+
+def test_least_recent_moves_a_booked_driver_last(index, counters):
+    for name in ('a', 'b', 'c'):
+        index.declare(name, 0, 1)
+    assert assignment.best_drivers(index, DAY, 0, 1, 'least_recent') == ['a', 'b', 'c']
+    book(index, counters, 1, DAY + datetime.timedelta(days=1), 'a', 0)
+    assert assignment.best_drivers(index, DAY, 0, 1, 'least_recent') == ['b', 'c', 'a']
+
+
+def test_busy_drivers_are_skipped(index, counters):
+    for name in ('a', 'b'):
+        index.declare(name, 0, 1)
+        index.declare(name, 1, 1)
+    book(index, counters, 1, DAY, 'a', 1)
+    assert assignment.best_drivers(index, DAY, 0, 1, 'first') == ['b']
+
+
+def test_outdated_heap_entries_are_shed(index, counters):
+    index.declare('a', 0, 1)
+    assignment.best_drivers(index, DAY, 0, 1, 'highest_rated')
+    for _ in range(100):
+        counters.record_review('a', 5)
+    ranking = counters._orderings[('highest_rated', (0, 1), None)]
+    assert len(ranking.heap) <= 2 * len(ranking.drivers) + 16
@@ -0,0 +1,177 @@
+# Unit tests for the idempotency stores; no database needed.
+#
+#   python -m pytest tests
+
+import pytest
+
+import idempotency
+from idempotency import Entry, IdempotencyStore, MemoryStore
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(idempotency.time, 'monotonic', clock)
+    return clock
+
+
+class FakeShared:
+    """Stands in for PostgresStore: a claim answers with a preset entry, or raises."""
+
+    def __init__(self, entry=None, error=None):
+        self.entry = entry
+        self.error = error
+        self.calls = []
+
+    def claim(self, key, req_hash):
+        self.calls.append(('claim', key))
+        if self.error:
+            raise self.error
+        return self.entry
+
+    def complete(self, key, req_hash, status, body, mimetype):
+        self.calls.append(('complete', key, status))
+        if self.error:
+            raise self.error
+
+    def release(self, key):
+        self.calls.append(('release', key))
+        if self.error:
+            raise self.error
+
+
+# -------------------- MemoryStore --------------------
+
+def test_claim_then_pending_then_completed(clock):
+    memory = MemoryStore(ttl=60, max_entries=10)
+    assert memory.claim('k', 'h') is None
+    pending = memory.claim('k', 'h')
+    assert pending.status is None and pending.request_hash == 'h'
+    memory.complete('k', 'h', 201, b'{}', 'application/json')
+    done = memory.claim('k', 'h')
+    assert (done.status, done.body, done.mimetype) == (201, b'{}', 'application/json')
+
+
+def test_expired_key_is_claimed_again(clock):
+    memory = MemoryStore(ttl=60, max_entries=10)
+    memory.claim('k', 'h')
+    memory.complete('k', 'h', 200, b'', 'text/plain')
+    clock.now += 61
+    assert memory.claim('k', 'other') is None
+    assert memory.claim('k', 'other').request_hash == 'other'
+
+
+def test_pending_key_is_taken_over_after_timeout(clock, monkeypatch):
+    monkeypatch.setattr(idempotency, 'PENDING_TIMEOUT', 5)
+    memory = MemoryStore(ttl=60, max_entries=10)
+    memory.claim('k', 'h')
+    clock.now += 4
+    assert memory.claim('k', 'h').status is None   # still running
+    clock.now += 2
+    assert memory.claim('k', 'h') is None          # its worker is presumed dead
+
+
+def test_completed_key_is_not_taken_over(clock, monkeypatch):
+    monkeypatch.setattr(idempotency, 'PENDING_TIMEOUT', 5)
+    memory = MemoryStore(ttl=60, max_entries=10)
+    memory.claim('k', 'h')
+    memory.complete('k', 'h', 200, b'', 'text/plain')
+    clock.now += 30
+    assert memory.claim('k', 'h').status == 200
+
+
+def test_lru_eviction_keeps_recently_used(clock):
+    memory = MemoryStore(ttl=60, max_entries=2)
+    memory.claim('a', 'h')
+    memory.claim('b', 'h')
+    memory.claim('a', 'h')      # touch a, so b is the least recently used
+    memory.claim('c', 'h')
+    assert len(memory) == 2
+    assert memory.evictions == 1
+    assert memory.claim('a', 'h') is not None
+    assert memory.claim('b', 'h') is None   # evicted, so claimable again
+
+
+def test_release_drops_only_pending_entries(clock):
+    memory = MemoryStore(ttl=60, max_entries=10)
+    memory.claim('pending', 'h')
+    memory.claim('done', 'h')
+    memory.complete('done', 'h', 200, b'', 'text/plain')
+    memory.release('pending')
+    memory.release('done')
+    assert memory.claim('pending', 'h') is None
+    assert memory.claim('done', 'h').status == 200
+
+
+# -------------------- IdempotencyStore --------------------
+
+def test_outcomes(clock):
+    store = IdempotencyStore(MemoryStore(ttl=60, max_entries=10))
+    assert store.begin('k', 'h') == ('new', None)
+    outcome, entry = store.begin('k', 'h')
+    assert outcome == 'in_progress'
+    assert store.begin('k', 'different')[0] == 'mismatch'
+    store.finish('k', 'h', 201, b'{"rent_id": 1}', 'application/json')
+    outcome, entry = store.begin('k', 'h')
+    assert outcome == 'replay'
+    assert entry.body == b'{"rent_id": 1}'
+    assert store.begin('k', 'different')[0] == 'mismatch'
+    stats = store.stats()
+    assert (stats['requests'], stats['replays'], stats['mismatches'], stats['in_progress']) == (5, 1, 2, 1)
+
+
+@pytest.mark.parametrize('status', [500, 503, 408, 409, 429])
+def test_unstored_statuses_free_the_key(clock, status):
+    store = IdempotencyStore(MemoryStore(ttl=60, max_entries=10))
+    store.begin('k', 'h')
+    store.finish('k', 'h', status, b'', 'application/json')
+    assert store.begin('k', 'h') == ('new', None)
+
+
+def test_abandon_frees_the_key(clock):
+    store = IdempotencyStore(MemoryStore(ttl=60, max_entries=10))
+    store.begin('k', 'h')
+    store.abandon('k')
+    assert store.begin('k', 'h') == ('new', None)
+
+
+def test_shared_replay_is_remembered_locally(clock):
+    shared = FakeShared(Entry('h', 200, b'ok', 'text/plain', clock.now + 60, clock.now))
+    store = IdempotencyStore(MemoryStore(ttl=60, max_entries=10), shared)
+    assert store.begin('k', 'h')[0] == 'replay'
+    shared.entry = None
+    assert store.begin('k', 'h')[0] == 'replay'
+    assert shared.calls == [('claim', 'k')]   # the second answer came from memory
+
+
+def test_shared_pending_is_not_claimed_locally(clock):
+    # Another worker holds the key: answer in_progress and leave no local claim behind
+    shared = FakeShared(Entry('h', None, None, None, clock.now + 60, clock.now))
+    store = IdempotencyStore(MemoryStore(ttl=60, max_entries=10), shared)
+    assert store.begin('k', 'h')[0] == 'in_progress'
+    shared.entry = None
+    assert store.begin('k', 'h') == ('new', None)
+
+
+def test_shared_failure_falls_back_to_memory(clock):
+    shared = FakeShared(error=RuntimeError('database down'))
+    store = IdempotencyStore(MemoryStore(ttl=60, max_entries=10), shared)
+    assert store.begin('k', 'h') == ('new', None)
+    store.finish('k', 'h', 201, b'{}', 'application/json')
+    assert store.begin('k', 'h')[0] == 'replay'
+
+
+def test_scope_key_separates_routes_and_subjects():
+    keys = {idempotency.scope_key('abc', '/client/book_rent', 'a@b.com'),
+            idempotency.scope_key('abc', '/client/book_rent', 'c@d.com'),
+            idempotency.scope_key('abc', '/client/add_reviews', 'a@b.com'),
+            idempotency.scope_key('abc', '/client/book_rent')}
+    assert len(keys) == 4